@@ -4,6 +4,9 @@ DB_FILE_NAME = 'lead_scoring_data_cleaning.db'
 DATA_FILE_NAME = "leadscoring.csv"
 DATA_INFERENCE_FILE_NAME = "leadscoring_inference.csv"
 USE_INFERENCE_DATA = True
+# stream the raw csv into 'loaded_data' in chunks of LOAD_DATA_CHUNK_SIZE rows
+LOAD_DATA_IN_CHUNKS = True
+LOAD_DATA_CHUNK_SIZE = 100000
 UNIT_TEST_DB_FILE_NAME = 'test.db'
 DATA_DIRECTORY = '/Users/rpandey1/airflow/dags/Lead_scoring_data_pipeline/data'
 INTERACTION_MAPPING = '/Users/rpandey1/airflow/dags/Lead_scoring_data_pipeline/mapping/mapping/interaction_mapping.csv'
@@ -15,3 +18,58 @@ INDEX_COLUMNS_INFERENCE = ['created_date', 'city_tier', 'first_platform_c',
        'referred_lead']
 NOT_FEATURES = ['created_date', 'assistance_interaction', 'career_interaction',
                 'payment_interaction', 'social_interaction', 'syllabus_interaction']
+# run the cleaning steps as a single in-memory pass writing only 'model_input'
+USE_FUSED_CLEANING = True
+# also write 'city_tier_mapped', 'categorical_variables_mapped' and
+# 'interactions_mapped' from the fused pass, for debugging
+WRITE_INTERMEDIATE_TABLES = False
+# run the cleaning steps on this many shards of the data in parallel
+# processes, e.g. the number of cores of the worker. 1 runs them serially, as
+# do platforms without the fork start method
+CLEANING_SHARDS = 1
+# read and clean only the raw columns 'model_input' needs, see utils.plan_source_columns.
+# The interaction columns are then skipped unless BUILD_INTERACTIONS_MAPPED is
+# set, which also has the fused pass and interactions_mapping() write 'interactions_mapped'
+PRUNE_UNUSED_COLUMNS = True
+BUILD_INTERACTIONS_MAPPED = False
+# keep 'created_date' in the inference 'model_input', the inference pipeline
+# uses it as the watermark to score only the leads created since its last run
+KEEP_CREATED_DATE_FOR_INFERENCE = True
+# load and clean only the days of 'created_date' that are new or changed since
+# the last run and update 'loaded_data' and 'model_input' day by day, see
+# utils.load_new_days. The checksum of every loaded day is kept in PARTITIONS_TABLE
+INCREMENTAL_DATA_PIPELINE = False
+PARTITIONS_TABLE = 'loaded_data_partitions'
+# clean 'loaded_data' in up to DATE_SHARDS tasks mapped over ranges of days of
+# 'created_date' and merge their outputs into 'model_input' in a last task,
+# see utils.plan_date_shards. The plan is kept in DATE_SHARDS_TABLE
+USE_DATE_SHARDED_CLEANING = False
+DATE_SHARDS = 8
+DATE_SHARDS_TABLE = 'date_shards'
+# drop the duplicate rows once, as they are loaded, by a 64 bit fingerprint of
+# every row, see utils.fingerprint_rows, instead of in the categorical and
+# interactions mappings. With REMEMBER_ROW_FINGERPRINTS the fingerprints of the
+# rows loaded are kept in FINGERPRINT_INDEX_TABLE across runs and the rows an
+# earlier run loaded, e.g. leads re-delivered by a later export, are dropped
+# too. Only set it for data files that hold new deliveries, not for a file
+# loaded whole on every run. The fingerprints of the rows loaded so far are
+# held in memory, 8 bytes a row of the file, so the chunked load is no longer
+# bounded by one chunk; REMEMBER_ROW_FINGERPRINTS also holds their days
+DEDUP_ROW_FINGERPRINTS = False
+REMEMBER_ROW_FINGERPRINTS = False
+FINGERPRINT_INDEX_TABLE = 'row_fingerprints'
+# backend storing the pipeline's tables: 'sqlite' (the db file above),
+# 'parquet' (one Parquet file per table in PARQUET_DIRECTORY) or 'arrow' (one
+# memory-mapped Arrow file per table in ARROW_DIRECTORY, for the tasks of a
+# host to hand tables to each other without parsing them). With 'arrow' the
+# tables in SQLITE_EXPORT_TABLES are also written to the db file
+STORAGE_BACKEND = 'sqlite'
+PARQUET_DIRECTORY = '/Users/rpandey1/airflow/dags/Lead_scoring_data_pipeline/db/parquet'
+ARROW_DIRECTORY = '/Users/rpandey1/airflow/dags/Lead_scoring_data_pipeline/db/arrow'
+SQLITE_EXPORT_TABLES = ['model_input']
+# also check the dtypes and null rates of the raw data in raw_data_schema_check,
+# on its first RAW_DATA_CHECK_SAMPLE_ROWS rows (None for the whole file) read
+# RAW_DATA_CHECK_CHUNK_SIZE rows at a time
+RAW_DATA_CONTENT_CHECK = False
+RAW_DATA_CHECK_SAMPLE_ROWS = 100000
+RAW_DATA_CHECK_CHUNK_SIZE = 100000
@@ -8,6 +8,7 @@ import pandas as pd
 import os
 from constants import *
 from schema import *
+from storage import get_storage
 
 ###############################################################################
 # Define function to validate raw data's schema
@@ -31,6 +32,10 @@ def raw_data_schema_check():
         else prints
         'Raw datas schema is NOT in line with the schema present in schema.py'
 
+        Only the header of the file is read for this check. If
+        RAW_DATA_CONTENT_CHECK is set in constants.py the dtypes and null
+        rates of the columns are checked as well, see raw_data_content_check().
+
     
     SAMPLE USAGE
         raw_data_schema_check
@@ -41,8 +46,7 @@ def raw_data_schema_check():
         print(f"Error: File 'leadscoring.csv' not found in {DATA_DIRECTORY}")
         return
 
-    df = pd.read_csv(file_path)
-    file_columns = set(df.columns)
+    file_columns = set(pd.read_csv(file_path, nrows=0).columns)
     schema_columns = set(raw_data_schema)
 
     if file_columns == schema_columns:
@@ -57,6 +61,77 @@ def raw_data_schema_check():
         if extra_columns:
             print(f"Extra columns in data: {extra_columns}")
 
+    if RAW_DATA_CONTENT_CHECK:
+        raw_data_content_check(file_path, RAW_DATA_CHECK_SAMPLE_ROWS, RAW_DATA_CHECK_CHUNK_SIZE)
+
+###############################################################################
+# Define function to check the dtypes and null rates of the raw data
+############################################################################### 
+
+def raw_data_content_check(file_path, sample_rows, chunk_size):
+    '''
+    This function streams the csv file chunk by chunk and reports the dtype
+    and the null rate of every column. Only one chunk is in memory at a time
+    and reading stops after 'sample_rows' rows, so the check runs in bounded
+    memory on a sample of the file or, with sample_rows None, on all of it.
+
+
+    INPUTS
+        file_path : path of the csv file to be checked
+        sample_rows : number of rows to check from the top of the file, None
+                      for the whole file
+        chunk_size : number of rows read per chunk
+
+
+    OUTPUT
+        Prints the dtype and null rate of every column, and whether they are
+        in line with raw_data_dtypes and raw_data_max_null_rates in
+        schema.py. A column whose dtype changes between chunks is not in
+        line. Returns a dataframe with the 'dtype', 'null_rate',
+        'expected_dtype', 'max_null_rate' and 'in_line' of every column.
+
+
+    SAMPLE USAGE
+        raw_data_content_check(file_path, 100000, 10000)
+    '''
+    rows = 0
+    null_counts = None
+    dtypes = {}
+    mixed_dtype_columns = set()
+    for chunk in pd.read_csv(file_path, chunksize=chunk_size, nrows=sample_rows):
+        rows += len(chunk)
+        null_counts = chunk.isna().sum() if null_counts is None else null_counts + chunk.isna().sum()
+        for column, dtype in chunk.dtypes.items():
+            # a column that is all null in a chunk is read as float64 whatever it holds
+            if chunk[column].isna().all():
+                continue
+            if dtypes.setdefault(column, dtype) != dtype:
+                mixed_dtype_columns.add(column)
+
+    if not rows:
+        print("Raw data has no rows to check")
+        return
+    report = pd.DataFrame({'dtype': [str(dtypes.get(column, 'empty')) for column in null_counts.index],
+                           'null_rate': null_counts / rows}, index=null_counts.index)
+    report['expected_dtype'] = report.index.map(raw_data_dtypes)
+    report['max_null_rate'] = report.index.map(raw_data_max_null_rates)
+    # an all null column has no dtype, only its null rate is checked. The
+    # columns missing from schema.py are reported by the schema check
+    dtype_in_line = ((report['dtype'] == report['expected_dtype']) | (report['dtype'] == 'empty')
+                     | report['expected_dtype'].isna())
+    null_rate_in_line = ~(report['null_rate'] > report['max_null_rate'])
+    report['in_line'] = dtype_in_line & null_rate_in_line & ~report.index.isin(list(mixed_dtype_columns))
+    print(f"Checked dtypes and null rates on {rows} rows")
+    print(report.to_string())
+    if mixed_dtype_columns:
+        print(f"Columns with mixed dtypes in data: {mixed_dtype_columns}")
+    if report['in_line'].all():
+        print("Raw data content is in line with the dtypes and null rates present in schema.py")
+    else:
+        print("Raw data content is NOT in line with the dtypes and null rates present in schema.py")
+        print(f"Columns not in line: {report.index[~report['in_line']].tolist()}")
+    return report
+
 ###############################################################################
 # Define function to validate model's input schema
 ############################################################################### 
@@ -84,35 +159,33 @@ def model_input_schema_check():
     '''
     db_file_path = os.path.join(DB_PATH, DB_FILE_NAME)
 
-    if not os.path.exists(db_file_path):
+    if STORAGE_BACKEND == 'sqlite' and not os.path.exists(db_file_path):
         print(f"Error: Database file '{DB_FILE_NAME}' not found in {DB_PATH}")
         return
 
-    conn = connect_to_db(db_file_path)
-    if conn:
-        cursor = conn.cursor()
-        
-        # Fetch column names from 'model_input' table
-        cursor.execute("PRAGMA table_info(model_input);")
-        table_columns = {row[1] for row in cursor.fetchall()} 
-
-        schema_columns = set(model_input_schema)
-
-        if table_columns == schema_columns:
-            print("Model's input schema is in line with the schema present in schema.py")
-        else:
-            print("Model's input schema is NOT in line with the schema present in schema.py")
-            missing_columns = schema_columns - table_columns
-            extra_columns = table_columns - schema_columns
-
-            if missing_columns:
-                print(f"Missing columns in database: {missing_columns}")
-            if extra_columns:
-                print(f"Extra columns in database: {extra_columns}")
-        
-        conn.close()
+    # Fetch column names from 'model_input' table
+    storage = get_storage(STORAGE_BACKEND, db_file_path, PARQUET_DIRECTORY, ARROW_DIRECTORY, SQLITE_EXPORT_TABLES)
+    try:
+        table_columns = set(storage.table_columns("model_input"))
+    except Exception as e:
+        print(f"Unable to read the 'model_input' table: {e}")
+        return
+
+    schema_columns = set(model_input_schema)
+    if INCREMENTAL_DATA_PIPELINE or (USE_INFERENCE_DATA and KEEP_CREATED_DATE_FOR_INFERENCE):
+        schema_columns.add('created_date')
+
+    if table_columns == schema_columns:
+        print("Model's input schema is in line with the schema present in schema.py")
     else:
-        print("Unable to get DB connection")
+        print("Model's input schema is NOT in line with the schema present in schema.py")
+        missing_columns = schema_columns - table_columns
+        extra_columns = table_columns - schema_columns
+
+        if missing_columns:
+            print(f"Missing columns in database: {missing_columns}")
+        if extra_columns:
+            print(f"Extra columns in database: {extra_columns}")
 
 def connect_to_db(db_full_path):
     conn = sqlite3.connect(db_full_path)
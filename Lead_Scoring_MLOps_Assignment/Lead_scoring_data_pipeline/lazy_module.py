@@ -0,0 +1,53 @@
+'''
+filename: lazy_module.py
+functions: module_from_file, lazy_module_from_file
+version: 1
+
+Helpers the three DAG files load their task modules with. It only imports
+importlib and inspect, so that the DAG files can load it with their own
+module_from_file while they are parsed.
+'''
+
+###############################################################################
+# Import necessary modules
+# ##############################################################################
+
+import importlib.util
+import inspect
+
+
+###############################################################################
+# Define the functions to load the modules of the tasks
+# ##############################################################################
+
+def module_from_file(module_name, file_path):
+    spec = importlib.util.spec_from_file_location(module_name, file_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+class lazy_module_from_file:
+    '''
+    Stands in for module_from_file(module_name, file_path) in the tasks:
+    its attributes are python_callables which load the module and run the
+    function of the same name only when the task runs, so that parsing a
+    DAG file doesn't import utils.py and with it pandas, mlflow and
+    lightgbm. Like PythonOperator, a callable passes the function only the
+    keyword arguments it takes.
+    '''
+    def __init__(self, module_name, file_path):
+        self.module_name = module_name
+        self.file_path = file_path
+
+    def __getattr__(self, function_name):
+        if function_name.startswith("__"):
+            raise AttributeError(function_name)
+
+        def call(**kwargs):
+            function = getattr(module_from_file(self.module_name, self.file_path), function_name)
+            parameters = inspect.signature(function).parameters
+            if not any(parameter.kind == parameter.VAR_KEYWORD for parameter in parameters.values()):
+                kwargs = {name: value for name, value in kwargs.items() if name in parameters}
+            return function(**kwargs)
+        call.__name__ = function_name
+        return call
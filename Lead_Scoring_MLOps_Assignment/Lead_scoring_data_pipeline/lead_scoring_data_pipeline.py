@@ -18,11 +18,13 @@ def module_from_file(module_name, file_path):
     spec.loader.exec_module(module)
     return module
 
-utils = module_from_file("utils", "/home/airflow/dags/Lead_scoring_data_pipeline/utils.py")
+lazy_module = module_from_file("lazy_module", "/home/airflow/dags/Lead_scoring_data_pipeline/lazy_module.py")
+
+utils = lazy_module.lazy_module_from_file("utils", "/home/airflow/dags/Lead_scoring_data_pipeline/utils.py")
 constants = module_from_file("constants", "/home/airflow/dags/Lead_scoring_data_pipeline/constants.py")
 schema = module_from_file("schema", "/home/airflow/dags/Lead_scoring_data_pipeline/schema.py")
 significant_categorical_level=module_from_file("significant_categorical_level", "/home/airflow/dags/Lead_scoring_data_pipeline/mapping/significant_categorical_level.py")
-data_validation_checks=module_from_file("data_validation_checks","/home/airflow/dags/Lead_scoring_data_pipeline/data_validation_checks.py")
+data_validation_checks=lazy_module.lazy_module_from_file("data_validation_checks","/home/airflow/dags/Lead_scoring_data_pipeline/data_validation_checks.py")
 city_tier_mapping=module_from_file("data_validation_checks","/home/airflow/dags/Lead_scoring_data_pipeline/mapping/city_tier_mapping.py")
 
 default_args = {
@@ -55,32 +57,64 @@ checking_raw_data_schema= PythonOperator(task_id='checking_raw_data',python_call
 ###############################################################################
 # Create a task for load_data_into_db() function with task_id 'loading_data'
 ##############################################################################
-loading_data = PythonOperator(task_id='loading_data',python_callable=utils.load_data_into_db,dag = ML_data_cleaning_dag,
-                              op_kwargs={'db_file_name':constants.DB_FILE_NAME,'db_path':constants.DB_PATH,'data_dictionary':constants.DATA_DIRECTORY,
-                                         'data_file_name': constants.DATA_FILE_NAME,'data_inference_file_name': constants.DATA_INFERENCE_FILE_NAME,
-                                         'use_inference_data': constants.USE_INFERENCE_DATA})
+if not constants.INCREMENTAL_DATA_PIPELINE:
+    loading_data = PythonOperator(task_id='loading_data',python_callable=utils.load_data_into_db,dag = ML_data_cleaning_dag,
+                                  op_kwargs={'db_file_name':constants.DB_FILE_NAME,'db_path':constants.DB_PATH,'data_dictionary':constants.DATA_DIRECTORY,
+                                             'data_file_name': constants.DATA_FILE_NAME,'data_inference_file_name': constants.DATA_INFERENCE_FILE_NAME,
+                                             'use_inference_data': constants.USE_INFERENCE_DATA})
 
 ###############################################################################
-# Create a task for map_city_tier() function with task_id 'mapping_city_tier'
-###############################################################################
-mapping_city_tier = PythonOperator(task_id='mapping_city_tier',python_callable=utils.map_city_tier,dag = ML_data_cleaning_dag,
-                                   op_kwargs={'db_file_name':constants.DB_FILE_NAME,'db_path':constants.DB_PATH,'city_tier_mapping':city_tier_mapping.city_tier_mapping})
-
+# Create a task for load_new_days() function with task_id 'loading_new_days'
+# which loads and cleans only the new or changed days of the raw data, or
+# tasks cleaning ranges of days in parallel, or a task for clean_data()
+# function with task_id 'cleaning_data' which runs the three mapping steps
+# below in one pass, or one task per step
 ###############################################################################
-# Create a task for map_categorical_vars() function with task_id 'mapping_categorical_vars'
-###############################################################################
-mapping_categorical_vars = PythonOperator(task_id='mapping_categorical_vars',python_callable=utils.map_categorical_vars,dag = ML_data_cleaning_dag,
+if constants.INCREMENTAL_DATA_PIPELINE:
+    loading_new_days = PythonOperator(task_id='loading_new_days',python_callable=utils.load_new_days,dag=ML_data_cleaning_dag,
+                                      op_kwargs={'db_file_name':constants.DB_FILE_NAME,'db_path':constants.DB_PATH,
+                                                 'data_dictionary':constants.DATA_DIRECTORY,'partitions_table':constants.PARTITIONS_TABLE})
+elif constants.USE_DATE_SHARDED_CLEANING:
+    ###############################################################################
+    # Create a task for plan_date_shards() function with task_id 'planning_date_shards',
+    # one 'cleaning_date_shards' task mapped over every shard it returns for
+    # clean_date_shard() function, and a task for merge_date_shards() function
+    # with task_id 'merging_date_shards'
+    ###############################################################################
+    planning_date_shards = PythonOperator(task_id='planning_date_shards',python_callable=utils.plan_date_shards,dag=ML_data_cleaning_dag,
                                           op_kwargs={'db_file_name':constants.DB_FILE_NAME,'db_path':constants.DB_PATH,
-                                                     'list_platform':significant_categorical_level.list_platform,
-                                                     'list_medium':significant_categorical_level.list_medium,'list_source':significant_categorical_level.list_source})
+                                                     'date_shards':constants.DATE_SHARDS,'date_shards_table':constants.DATE_SHARDS_TABLE})
+    cleaning_date_shards = PythonOperator.partial(task_id='cleaning_date_shards',python_callable=utils.clean_date_shard,
+                                                  dag=ML_data_cleaning_dag).expand(op_kwargs=planning_date_shards.output)
+    merging_date_shards = PythonOperator(task_id='merging_date_shards',python_callable=utils.merge_date_shards,dag=ML_data_cleaning_dag,
+                                         op_kwargs={'db_file_name':constants.DB_FILE_NAME,'db_path':constants.DB_PATH,
+                                                    'date_shards_table':constants.DATE_SHARDS_TABLE})
+elif constants.USE_FUSED_CLEANING:
+    cleaning_data = PythonOperator(task_id='cleaning_data',python_callable=utils.clean_data,dag=ML_data_cleaning_dag,
+                                   op_kwargs={'db_file_name':constants.DB_FILE_NAME,'db_path':constants.DB_PATH,
+                                              'write_intermediate_tables':constants.WRITE_INTERMEDIATE_TABLES})
+else:
+    ###############################################################################
+    # Create a task for map_city_tier() function with task_id 'mapping_city_tier'
+    ###############################################################################
+    mapping_city_tier = PythonOperator(task_id='mapping_city_tier',python_callable=utils.map_city_tier,dag = ML_data_cleaning_dag,
+                                       op_kwargs={'db_file_name':constants.DB_FILE_NAME,'db_path':constants.DB_PATH,'city_tier_mapping':city_tier_mapping.city_tier_mapping})
 
-###############################################################################
-# Create a task for interactions_mapping() function with task_id 'mapping_interactions'
-###############################################################################
-mapping_interactions = PythonOperator(task_id='mapping_interactions',python_callable=utils.interactions_mapping,dag=ML_data_cleaning_dag,
-                                      op_kwargs={'db_file_name':constants.DB_FILE_NAME,'db_path':constants.DB_PATH,
-                                                 'interaction_mapping_file':constants.INTERACTION_MAPPING,'index_columns':constants.INDEX_COLUMNS_TRAINING,
-                                                 'not_features':constants.NOT_FEATURES})
+    ###############################################################################
+    # Create a task for map_categorical_vars() function with task_id 'mapping_categorical_vars'
+    ###############################################################################
+    mapping_categorical_vars = PythonOperator(task_id='mapping_categorical_vars',python_callable=utils.map_categorical_vars,dag = ML_data_cleaning_dag,
+                                              op_kwargs={'db_file_name':constants.DB_FILE_NAME,'db_path':constants.DB_PATH,
+                                                         'list_platform':significant_categorical_level.list_platform,
+                                                         'list_medium':significant_categorical_level.list_medium,'list_source':significant_categorical_level.list_source})
+
+    ###############################################################################
+    # Create a task for interactions_mapping() function with task_id 'mapping_interactions'
+    ###############################################################################
+    mapping_interactions = PythonOperator(task_id='mapping_interactions',python_callable=utils.interactions_mapping,dag=ML_data_cleaning_dag,
+                                          op_kwargs={'db_file_name':constants.DB_FILE_NAME,'db_path':constants.DB_PATH,
+                                                     'interaction_mapping_file':constants.INTERACTION_MAPPING,'index_columns':constants.INDEX_COLUMNS_TRAINING,
+                                                     'not_features':constants.NOT_FEATURES})
 
 ###############################################################################
 # Create a task for model_input_schema_check() function with task_id 'checking_model_inputs_schema'
@@ -91,8 +125,19 @@ checking_model_inputs_schema=PythonOperator(task_id='checking_model_inputs_schem
 ###############################################################################
 # Define the relation between the tasks
 ###############################################################################
-building_db.set_downstream(loading_data)
-loading_data.set_downstream(checking_raw_data_schema)
-checking_raw_data_schema.set_downstream(mapping_city_tier)
-mapping_city_tier.set_downstream(mapping_categorical_vars)
-mapping_categorical_vars.set_downstream(mapping_interactions)
\ No newline at end of file
+if constants.INCREMENTAL_DATA_PIPELINE:
+    building_db.set_downstream(checking_raw_data_schema)
+    checking_raw_data_schema.set_downstream(loading_new_days)
+else:
+    building_db.set_downstream(loading_data)
+    loading_data.set_downstream(checking_raw_data_schema)
+    if constants.USE_DATE_SHARDED_CLEANING:
+        checking_raw_data_schema.set_downstream(planning_date_shards)
+        planning_date_shards.set_downstream(cleaning_date_shards)
+        cleaning_date_shards.set_downstream(merging_date_shards)
+    elif constants.USE_FUSED_CLEANING:
+        checking_raw_data_schema.set_downstream(cleaning_data)
+    else:
+        checking_raw_data_schema.set_downstream(mapping_city_tier)
+        mapping_city_tier.set_downstream(mapping_categorical_vars)
+        mapping_categorical_vars.set_downstream(mapping_interactions)
\ No newline at end of file
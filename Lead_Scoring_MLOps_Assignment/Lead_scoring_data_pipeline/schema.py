@@ -21,3 +21,24 @@ raw_data_schema = ['created_date', 'city_mapped', 'first_platform_c',
 model_input_schema = ['total_leads_droppped', 'city_tier', 'referred_lead', 
                     'first_platform_c', 'first_utm_medium_c', 'first_utm_source_c', 
                     'app_complete_flag']
+
+
+# dtypes the lead columns are carried with through the pipeline, see
+# utils.apply_schema. The levels of the source categorical columns are only
+# fixed once the insignificant ones are collapsed to "others"
+categorical_columns = ['city_mapped', 'first_platform_c', 'first_utm_medium_c', 'first_utm_source_c']
+city_tier_levels = [1.0, 2.0, 3.0]
+interaction_count_dtype = 'UInt16'
+
+
+# dtypes and highest null rates expected of the raw data columns, checked by
+# data_validation_checks.raw_data_content_check. The interaction columns are
+# only set for the leads that had the interaction, so they may be all null
+raw_data_dtypes = {column: 'float64' for column in raw_data_schema}
+raw_data_dtypes.update({'created_date': 'object', 'city_mapped': 'object', 'first_platform_c': 'object',
+                        'first_utm_medium_c': 'object', 'first_utm_source_c': 'object',
+                        'app_complete_flag': 'int64'})
+raw_data_max_null_rates = {column: 1.0 for column in raw_data_schema}
+raw_data_max_null_rates.update({'created_date': 0.0, 'city_mapped': 0.2, 'first_platform_c': 0.05,
+                                'first_utm_medium_c': 0.05, 'first_utm_source_c': 0.05,
+                                'total_leads_droppped': 0.05, 'referred_lead': 0.05, 'app_complete_flag': 0.0})
@@ -0,0 +1,584 @@
+'''
+filename: storage.py
+functions: SQLiteStorage, ParquetStorage, ArrowStorage, get_storage
+version: 1
+'''
+
+###############################################################################
+# Import necessary modules
+# ##############################################################################
+
+import json
+import os
+import sqlite3
+import uuid
+from datetime import datetime, timezone
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+
+# pragmas set on every SQLite connection: WAL journaling so readers aren't
+# blocked while a table is rewritten, no fsync per transaction (a crash can
+# only lose the last committed tables, never corrupt the db), a 256MB page
+# cache and temporary b-trees kept in memory
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -256 * 1024,
+    "temp_store": "MEMORY",
+}
+# number of rows converted and inserted per executemany call
+SQLITE_INSERT_BATCH_SIZE = 50000
+
+
+###############################################################################
+# Define the SQLite storage backend
+# ##############################################################################
+
+class SQLiteStorage:
+    '''
+    Stores every table in the SQLite db file at db_full_path. This is the
+    default backend.
+
+    Connections are tuned for bulk writes with SQLITE_PRAGMAS. A table is
+    written by creating a new table with explicit column types, filling it
+    with executemany batches of SQLITE_INSERT_BATCH_SIZE rows and renaming
+    it over the old one, all in a single transaction, so that readers see
+    either the old or the new table.
+
+    SAMPLE USAGE
+        storage = SQLiteStorage(os.path.join(DB_PATH, DB_FILE_NAME))
+        df = storage.read_table("model_input")
+    '''
+
+    def __init__(self, db_full_path):
+        self.db_full_path = db_full_path
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_full_path)
+        for pragma, value in SQLITE_PRAGMAS.items():
+            conn.execute(f"PRAGMA {pragma}={value}")
+        print("connecting to db from path: ", self.db_full_path)
+        return conn
+
+    def read_table(self, table_name, columns=None, read_only=False):
+        '''
+        Reads the table, or only the given columns of it. read_only is there
+        for the file backends: a SQLite table is always read into new arrays.
+        '''
+        select = ", ".join(f'"{column}"' for column in columns) if columns else "*"
+        conn = self.connect()
+        try:
+            return pd.read_sql(f'SELECT {select} FROM "{table_name}"', conn)
+        finally:
+            conn.close()
+
+    def read_new_rows(self, table_name, key_column, watermark):
+        '''
+        Reads the rows of the table whose key_column is greater than watermark.
+        '''
+        conn = self.connect()
+        try:
+            return pd.read_sql(f'SELECT * FROM "{table_name}" WHERE "{key_column}" > ?', conn, params=(watermark,))
+        finally:
+            conn.close()
+
+    def read_days(self, table_name, date_column, first_day, last_day, columns=None):
+        '''
+        Reads the rows of the table, or only the given columns of them, whose
+        date_column falls on a day ('YYYY-MM-DD') from first_day to last_day.
+        A None first_day or last_day leaves the range open on that side, and
+        a None first_day also takes the rows without a date.
+        '''
+        select = ", ".join(f'"{column}"' for column in columns) if columns else "*"
+        day = f'substr("{date_column}", 1, 10)'
+        conditions, params = [f'"{date_column}" IS NOT NULL'], []
+        for bound, operator in [(first_day, ">="), (last_day, "<=")]:
+            if bound is not None:
+                conditions.append(f"{day} {operator} ?")
+                params.append(bound)
+        where = " AND ".join(conditions)
+        if first_day is None:
+            where = f'"{date_column}" IS NULL OR ({where})'
+        conn = self.connect()
+        try:
+            return pd.read_sql(f'SELECT {select} FROM "{table_name}" WHERE {where}', conn, params=params)
+        finally:
+            conn.close()
+
+    def column_max(self, table_name, column):
+        '''
+        Returns the greatest value of the column, None if the table or the
+        column doesn't exist or the table is empty.
+        '''
+        if column not in self.table_columns(table_name):
+            return None
+        conn = self.connect()
+        try:
+            return conn.execute(f'SELECT MAX("{column}") FROM "{table_name}"').fetchone()[0]
+        finally:
+            conn.close()
+
+    def write_table(self, df, table_name):
+        '''
+        Writes df to the table, replacing it if it already exists.
+        '''
+        self.write_chunks([df], table_name)
+
+    def append_table(self, df, table_name):
+        '''
+        Appends the rows of df to the table in a single transaction, creating
+        the table if it doesn't exist.
+        '''
+        conn = self.connect()
+        try:
+            conn.execute("BEGIN")
+            conn.execute(pd.io.sql.get_schema(df, table_name, con=conn).replace("CREATE TABLE", "CREATE TABLE IF NOT EXISTS", 1))
+            insert_rows(conn, table_name, df[self.columns_of(conn, table_name)])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def replace_days(self, df, table_name, date_column, days):
+        '''
+        Replaces the rows of the table whose date_column falls on one of days
+        ('YYYY-MM-DD') with the rows of df in a single transaction, creating
+        the table if it doesn't exist. The rows of the other days are left
+        untouched.
+        '''
+        conn = self.connect()
+        try:
+            conn.execute("BEGIN")
+            conn.execute(pd.io.sql.get_schema(df, table_name, con=conn).replace("CREATE TABLE", "CREATE TABLE IF NOT EXISTS", 1))
+            conn.execute("CREATE TEMP TABLE IF NOT EXISTS replaced_days (day TEXT PRIMARY KEY)")
+            conn.execute("DELETE FROM replaced_days")
+            conn.executemany("INSERT INTO replaced_days VALUES (?)", [(day,) for day in set(days)])
+            conn.execute(f'DELETE FROM "{table_name}" WHERE substr("{date_column}", 1, 10) IN (SELECT day FROM replaced_days)')
+            insert_rows(conn, table_name, df[self.columns_of(conn, table_name)])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def write_chunks(self, chunks, table_name):
+        '''
+        Writes an iterable of dataframes to the table, replacing it. The
+        chunks are appended to a new table typed after the first chunk, which
+        replaces the previous table once the last chunk is in. Returns the
+        number of rows written.
+        '''
+        swap_table_name = f"{table_name}__swap"
+        rows = 0
+        created = False
+        conn = self.connect()
+        try:
+            conn.execute("BEGIN")
+            conn.execute(f'DROP TABLE IF EXISTS "{swap_table_name}"')
+            for chunk in chunks:
+                if not created:
+                    conn.execute(pd.io.sql.get_schema(chunk, swap_table_name, con=conn))
+                    created = True
+                insert_rows(conn, swap_table_name, chunk)
+                rows += len(chunk)
+            if created:
+                conn.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+                conn.execute(f'ALTER TABLE "{swap_table_name}" RENAME TO "{table_name}"')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        return rows
+
+    def drop_table(self, table_name):
+        conn = self.connect()
+        try:
+            conn.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+            conn.commit()
+        finally:
+            conn.close()
+
+    def table_columns(self, table_name):
+        conn = self.connect()
+        try:
+            return self.columns_of(conn, table_name)
+        finally:
+            conn.close()
+
+    def columns_of(self, conn, table_name):
+        return [row[1] for row in conn.execute(f'PRAGMA table_info("{table_name}")')]
+
+
+###############################################################################
+# Define the Parquet storage backend
+# ##############################################################################
+
+class ParquetStorage:
+    '''
+    Stores every table as a columnar Parquet file '<table_name>.parquet' in
+    directory. Reads are memory-mapped and only load the requested columns;
+    writes go to a temporary file that then replaces the table, so readers
+    never see a half written table.
+
+    SAMPLE USAGE
+        storage = ParquetStorage(PARQUET_DIRECTORY)
+        df = storage.read_table("predictions", columns=["predictions"])
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def table_path(self, table_name):
+        return os.path.join(self.directory, f"{table_name}.parquet")
+
+    def read_table(self, table_name, columns=None, read_only=False):
+        '''
+        Reads the table, or only the given columns of it. With read_only
+        the columns aren't copied into consolidated blocks: the numeric
+        columns without nulls are read-only views on the Arrow buffers, for
+        the readers that don't modify the dataframe in place.
+        '''
+        print("reading table from path: ", self.table_path(table_name))
+        return self.read_arrow(table_name, columns=columns).to_pandas(split_blocks=read_only)
+
+    def read_arrow(self, table_name, columns=None, filters=None):
+        '''
+        Reads the table, or only the given columns of it, as a pyarrow Table.
+        filters are pyarrow.parquet filters, pushed down to the reader.
+        '''
+        return pq.read_table(self.table_path(table_name), columns=columns, filters=filters, memory_map=True)
+
+    def read_new_rows(self, table_name, key_column, watermark):
+        '''
+        Reads the rows of the table whose key_column is greater than
+        watermark. The filter is pushed down to the Parquet reader.
+        '''
+        return self.read_arrow(table_name, filters=[(key_column, '>', watermark)]).to_pandas()
+
+    def read_days(self, table_name, date_column, first_day, last_day, columns=None):
+        '''
+        Reads the rows of the table, or only the given columns of them, whose
+        date_column falls on a day ('YYYY-MM-DD') from first_day to last_day.
+        A None first_day or last_day leaves the range open on that side, and
+        a None first_day also takes the rows without a date.
+        '''
+        table = self.read_arrow(table_name)
+        day = pc.utf8_slice_codeunits(table[date_column], 0, 10)
+        in_range = pc.is_valid(day)
+        if first_day is not None:
+            in_range = pc.and_(in_range, pc.greater_equal(day, first_day))
+        if last_day is not None:
+            in_range = pc.and_(in_range, pc.less_equal(day, last_day))
+        if first_day is None:
+            in_range = pc.or_(in_range, pc.is_null(day))
+        table = table.filter(in_range)
+        return (table.select(columns) if columns else table).to_pandas()
+
+    def column_max(self, table_name, column):
+        '''
+        Returns the greatest value of the column, None if the table or the
+        column doesn't exist or the table is empty.
+        '''
+        if column not in self.table_columns(table_name):
+            return None
+        return pc.max(self.read_arrow(table_name, columns=[column])[column]).as_py()
+
+    def write_table(self, df, table_name):
+        '''
+        Writes df to the table, replacing it if it already exists.
+        '''
+        os.makedirs(self.directory, exist_ok=True)
+        temporary_path = self.table_path(table_name) + ".tmp"
+        df.to_parquet(temporary_path, index=False)
+        os.replace(temporary_path, self.table_path(table_name))
+
+    def append_table(self, df, table_name):
+        '''
+        Appends the rows of df to the table, creating the table if it doesn't
+        exist. Parquet files can't be appended to, so the table is rewritten
+        with the new rows and replaces the old one atomically.
+        '''
+        if self.table_columns(table_name):
+            table = self.read_arrow(table_name)
+            new_rows = pa.Table.from_pandas(df[table.column_names], schema=table.schema, preserve_index=False)
+            df = pa.concat_tables([table, new_rows]).to_pandas()
+        self.write_table(df, table_name)
+
+    def replace_days(self, df, table_name, date_column, days):
+        '''
+        Replaces the rows of the table whose date_column falls on one of days
+        ('YYYY-MM-DD') with the rows of df, creating the table if it doesn't
+        exist. The rows of the other days are kept as they are, without
+        converting them to pandas, and the table is rewritten atomically.
+        '''
+        if self.table_columns(table_name):
+            table = self.read_arrow(table_name)
+            replaced = pc.is_in(pc.utf8_slice_codeunits(table[date_column], 0, 10), value_set=pa.array(sorted(set(days)), pa.string()))
+            kept = table.filter(pc.invert(pc.fill_null(replaced, False)))
+            new_rows = pa.Table.from_pandas(df[table.column_names], schema=table.schema, preserve_index=False)
+            df = pa.concat_tables([kept, new_rows]).to_pandas()
+        self.write_table(df, table_name)
+
+    def write_chunks(self, chunks, table_name):
+        '''
+        Writes an iterable of dataframes to the table, replacing it once the
+        last chunk is written. Every chunk is cast to the schema of the first
+        one, see chunk_schema(). Returns the number of rows written.
+        '''
+        os.makedirs(self.directory, exist_ok=True)
+        temporary_path = self.table_path(table_name) + ".tmp"
+        rows = 0
+        writer = None
+        try:
+            for chunk in chunks:
+                if writer is None:
+                    schema = chunk_schema(chunk)
+                    writer = pq.ParquetWriter(temporary_path, schema)
+                writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+                rows += len(chunk)
+        except Exception:
+            if writer is not None:
+                writer.close()
+                remove_file(temporary_path)
+            raise
+        if writer is not None:
+            writer.close()
+            os.replace(temporary_path, self.table_path(table_name))
+        return rows
+
+    def drop_table(self, table_name):
+        if os.path.exists(self.table_path(table_name)):
+            os.remove(self.table_path(table_name))
+
+    def table_columns(self, table_name):
+        # no columns for a missing table, like sqlite's table_info
+        if not os.path.exists(self.table_path(table_name)):
+            return []
+        return pq.read_schema(self.table_path(table_name)).names
+
+
+###############################################################################
+# Define the Arrow storage backend
+# ##############################################################################
+
+class ArrowStorage(ParquetStorage):
+    '''
+    Stores every table as an Arrow IPC file in directory, published with a
+    manifest '<table_name>.json' holding the name of the table's current
+    file, its rows and its columns. The files are memory-mapped, so a task
+    reading a table another task of the same host wrote gets the pages of
+    the file from the page cache, with nothing to parse or decompress;
+    read_arrow returns these pages as they are, read_table copies them into
+    a writable dataframe, and read_table with read_only views its numeric
+    columns without nulls on the pages without copying. The columns of a table are read from its manifest
+    without opening the file.
+
+    A table is written to a new file which the manifest is then switched to
+    in one rename, so readers see either the old or the new table. The old
+    file is removed, a reader which mapped it keeps its pages until it's
+    done, and a reader which read the old manifest but hadn't mapped the
+    file yet reads the manifest again and maps the new file. The rows are
+    read, updated and rewritten like the Parquet tables.
+
+    The tables in sqlite_export_tables are also written to the SQLite db at
+    db_full_path every time they are written, for the consumers that read
+    them from the db.
+
+    SAMPLE USAGE
+        storage = ArrowStorage(ARROW_DIRECTORY, os.path.join(DB_PATH, DB_FILE_NAME), SQLITE_EXPORT_TABLES)
+        features = storage.read_arrow("features_inference")
+    '''
+
+    def __init__(self, directory, db_full_path=None, sqlite_export_tables=()):
+        super().__init__(directory)
+        if sqlite_export_tables and db_full_path is None:
+            raise ValueError("Exporting tables to SQLite needs the path of the db")
+        self.sqlite_storage = SQLiteStorage(db_full_path) if db_full_path else None
+        self.sqlite_export_tables = set(sqlite_export_tables)
+
+    def manifest_path(self, table_name):
+        return os.path.join(self.directory, f"{table_name}.json")
+
+    def manifest(self, table_name):
+        # None for a missing table
+        try:
+            with open(self.manifest_path(table_name)) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+    def table_path(self, table_name):
+        manifest = self.manifest(table_name)
+        if manifest is None:
+            raise FileNotFoundError(f"No table '{table_name}' in {self.directory}")
+        return os.path.join(self.directory, manifest["file"])
+
+    def read_arrow(self, table_name, columns=None, filters=None):
+        '''
+        Memory-maps the table and returns it, or only the given columns of
+        it, as a pyarrow Table backed by the pages of the file. filters are
+        pyarrow.parquet filters, the rows are filtered once mapped.
+        '''
+        try:
+            source = pa.memory_map(self.table_path(table_name))
+        except FileNotFoundError:
+            # the table was published again since its manifest was read
+            source = pa.memory_map(self.table_path(table_name))
+        table = pa.ipc.open_file(source).read_all()
+        if filters:
+            table = table.filter(pq.filters_to_expression(filters))
+        return table.select(columns) if columns else table
+
+    def write_table(self, df, table_name):
+        '''
+        Writes df to the table, replacing it if it already exists.
+        '''
+        self.write_chunks([df], table_name)
+
+    def write_chunks(self, chunks, table_name):
+        '''
+        Writes an iterable of dataframes to a new file of the table, every
+        chunk cast to the schema of the first one, see chunk_schema(), and
+        publishes it once the
+        last chunk is written. Returns the number of rows written.
+        '''
+        os.makedirs(self.directory, exist_ok=True)
+        file_name = f"{table_name}.{uuid.uuid4().hex}.arrow"
+        path = os.path.join(self.directory, file_name)
+        rows = 0
+        writer = None
+        try:
+            for chunk in chunks:
+                if writer is None:
+                    schema = chunk_schema(chunk)
+                    writer = pa.ipc.new_file(path, schema)
+                writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+                rows += len(chunk)
+        except Exception:
+            if writer is not None:
+                writer.close()
+                remove_file(path)
+            raise
+        if writer is None:
+            return rows
+        writer.close()
+        self.publish(table_name, file_name, schema, rows)
+        return rows
+
+    def publish(self, table_name, file_name, schema, rows):
+        '''
+        Switches the manifest of the table to file_name, removes the previous
+        file of the table and exports the table to SQLite if it is one of
+        sqlite_export_tables.
+        '''
+        previous = self.manifest(table_name)
+        manifest = {"table": table_name, "file": file_name, "rows": rows, "columns": schema.names,
+                    "types": [str(column_type) for column_type in schema.types],
+                    "published_at": datetime.now(timezone.utc).isoformat()}
+        temporary_path = self.manifest_path(table_name) + ".tmp"
+        with open(temporary_path, "w") as file:
+            json.dump(manifest, file)
+        os.replace(temporary_path, self.manifest_path(table_name))
+        if previous is not None and previous["file"] != file_name:
+            remove_file(os.path.join(self.directory, previous["file"]))
+        if table_name in self.sqlite_export_tables:
+            self.export_to_sqlite(table_name)
+
+    def export_to_sqlite(self, table_name):
+        '''
+        Writes the table to the SQLite db, replacing it, SQLITE_INSERT_BATCH_SIZE
+        rows of the mapped file at a time. Returns the number of rows written.
+        '''
+        table = self.read_arrow(table_name)
+        chunks = (table.slice(start, SQLITE_INSERT_BATCH_SIZE).to_pandas()
+                  for start in range(0, max(table.num_rows, 1), SQLITE_INSERT_BATCH_SIZE))
+        return self.sqlite_storage.write_chunks(chunks, table_name)
+
+    def drop_table(self, table_name):
+        manifest = self.manifest(table_name)
+        if manifest is not None:
+            os.remove(self.manifest_path(table_name))
+            remove_file(os.path.join(self.directory, manifest["file"]))
+
+    def table_columns(self, table_name):
+        # no columns for a missing table, like sqlite's table_info
+        manifest = self.manifest(table_name)
+        return manifest["columns"] if manifest is not None else []
+
+
+###############################################################################
+# Define the function to pick the storage backend
+# ##############################################################################
+
+STORAGE_BACKENDS = ['sqlite', 'parquet', 'arrow']
+
+def get_storage(storage_backend, db_full_path, parquet_directory, arrow_directory=None, sqlite_export_tables=()):
+    '''
+    Returns the storage for the backend named in constants.py: 'sqlite'
+    stores the tables in the db file at db_full_path, 'parquet' as Parquet
+    files in parquet_directory and 'arrow' as memory-mapped Arrow files in
+    arrow_directory, also writing the sqlite_export_tables to the db file.
+
+    SAMPLE USAGE
+        storage = get_storage(STORAGE_BACKEND, os.path.join(DB_PATH, DB_FILE_NAME), PARQUET_DIRECTORY,
+                              ARROW_DIRECTORY, SQLITE_EXPORT_TABLES)
+    '''
+    if storage_backend == 'sqlite':
+        return SQLiteStorage(db_full_path)
+    if storage_backend == 'parquet':
+        return ParquetStorage(parquet_directory)
+    if storage_backend == 'arrow':
+        return ArrowStorage(arrow_directory, db_full_path, sqlite_export_tables)
+    raise ValueError(f"Unknown storage backend '{storage_backend}', expected one of {STORAGE_BACKENDS}")
+
+
+def insert_rows(conn, table_name, df, batch_size=None):
+    """
+    Appends the rows of df to an existing table, one executemany per batch
+    of batch_size rows, SQLITE_INSERT_BATCH_SIZE by default.
+    """
+    batch_size = batch_size or SQLITE_INSERT_BATCH_SIZE
+    placeholders = ", ".join("?" * len(df.columns))
+    for start in range(0, len(df), batch_size):
+        batch = df.iloc[start:start + batch_size]
+        columns = [column_values(batch[col]) for col in batch.columns]
+        conn.executemany(f'INSERT INTO "{table_name}" VALUES ({placeholders})', zip(*columns))
+
+
+def column_values(series):
+    """Converts a column to a list of python objects sqlite can bind, nulls as None."""
+    if series.dtype.kind in "biuf":
+        # numpy numbers convert in one go; sqlite stores a NaN as NULL
+        return series.to_numpy().tolist()
+    return series.astype(object).where(series.notna(), None).tolist()
+
+
+def chunk_schema(chunk):
+    """
+    Schema of the first chunk of a table written in chunks, which the next
+    chunks are cast to. A column of the chunk that only holds nulls is typed
+    as strings rather than as nulls: pandas reads an all null text column as
+    objects, and the later chunks hold its text.
+    """
+    schema = pa.Schema.from_pandas(chunk, preserve_index=False)
+    for index, field in enumerate(schema):
+        if pa.types.is_null(field.type):
+            schema = schema.set(index, field.with_type(pa.string()))
+    return schema
+
+
+def remove_file(path):
+    """Removes the file at path, if it is still there."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
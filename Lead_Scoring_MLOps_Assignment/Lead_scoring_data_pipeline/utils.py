@@ -4,13 +4,18 @@
 
 
 import pandas as pd
+import numpy as np
 import os
 import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from multiprocessing import get_all_start_methods, get_context
 from sqlite3 import Error
 
 from Lead_scoring_data_pipeline.constants import *
 from Lead_scoring_data_pipeline.schema import *
-from Lead_scoring_data_pipeline.mapping.mapping import *
+from Lead_scoring_data_pipeline.storage import SQLiteStorage, get_storage
 from Lead_scoring_data_pipeline.mapping.city_tier_mapping import *
 from Lead_scoring_data_pipeline.mapping.significant_categorical_level import *
 
@@ -77,6 +82,15 @@ def load_data_into_db():
         If the table with the same name already exsists then the function 
         replaces it.
 
+        If LOAD_DATA_IN_CHUNKS is set in constants.py the csv is streamed
+        into the db chunk by chunk, see stream_data_into_db().
+
+        If PRUNE_UNUSED_COLUMNS is set only the columns the cleaning steps
+        need are read from the csv, see plan_source_columns().
+
+        If DEDUP_ROW_FINGERPRINTS is set the duplicate rows are dropped
+        before they are saved, see drop_duplicate_rows().
+
 
     SAMPLE USAGE
         load_data_into_db()
@@ -84,27 +98,98 @@ def load_data_into_db():
     csv_file_path = os.path.join(DATA_DIRECTORY, DATA_FILE_NAME)
     if USE_INFERENCE_DATA:
         csv_file_path = os.path.join(DATA_DIRECTORY, DATA_INFERENCE_FILE_NAME)
+    usecols = None
+    if PRUNE_UNUSED_COLUMNS:
+        # the inference data has no 'app_complete_flag', hence the callable
+        usecols = set(plan_source_columns()).__contains__
+    if LOAD_DATA_IN_CHUNKS:
+        try:
+            stream_data_into_db(csv_file_path, LOAD_DATA_CHUNK_SIZE, usecols)
+        except Exception as e:
+            print("Error in loading data into DB ", e)
+        return
     try:
         # Load the CSV data
         print("reading data from path: ", csv_file_path)
-        df = pd.read_csv(csv_file_path)
+        df = pd.read_csv(csv_file_path, usecols=usecols)
         
         # Replace null values in total_leads_droppped, referred_lead columns
         df["total_leads_droppped"].fillna(0, inplace=True)
         df["referred_lead"].fillna(0, inplace=True)
         
-        # Connect to the database and save the data
-        conn = connect_to_db()
-        if conn:
-            df.to_sql("loaded_data", conn, if_exists="replace", index=False)
-            conn.close()
-            print("Data successfully loaded into the database.")
-        else:
-            print("Error getting connection from the database")
+        # Save the data in the storage backend
+        storage = connect_to_storage()
+        deduplicated = {}
+        if DEDUP_ROW_FINGERPRINTS:
+            df = next(drop_duplicate_rows([df], read_fingerprint_index(storage), deduplicated))
+        storage.write_table(df, "loaded_data")
+        if DEDUP_ROW_FINGERPRINTS:
+            record_deduplication(storage, deduplicated)
+        print("Data successfully loaded into the database.")
     except Exception as e:
         print("Error in loading data into DB ", e)
 
 
+###############################################################################
+# Define function to stream the csv file into the database in chunks
+###############################################################################
+
+def stream_data_into_db(csv_file_path, chunk_size, usecols=None):
+    '''
+    This function is the streaming variant of load_data_into_db. Instead of
+    reading the whole csv in memory it reads 'chunk_size' rows at a time,
+    replaces the nulls in 'total_leads_droppped' and 'referred_lead' of
+    that chunk with 0 and appends it to the 'loaded_data' table. Peak memory
+    is therefore bounded by one chunk, whatever the size of the file.
+
+    The previous 'loaded_data' table is only replaced once the last chunk is
+    in, so a failure half way leaves it untouched. The chunks are read by
+    read_raw_chunks(), so that they all have the same dtypes.
+
+    If DEDUP_ROW_FINGERPRINTS is set the duplicate rows are dropped as the
+    chunks are read, see drop_duplicate_rows().
+
+
+    INPUTS
+        csv_file_path : path of the csv file to be loaded
+        chunk_size : number of rows read and written per chunk
+        usecols : columns to read from the csv, as accepted by pd.read_csv.
+                  All of them when None
+
+
+    OUTPUT
+        Replaces the 'loaded_data' table in the db and returns the number of
+        rows loaded. The ingestion rate in rows/sec is printed, and the
+        number of duplicate rows dropped.
+
+
+    SAMPLE USAGE
+        stream_data_into_db(csv_file_path, 100000)
+    '''
+    print("streaming data from path: ", csv_file_path)
+    start = time.perf_counter()
+
+    def chunks():
+        for chunk in read_raw_chunks(csv_file_path, chunk_size, usecols):
+            chunk["total_leads_droppped"] = chunk["total_leads_droppped"].fillna(0)
+            chunk["referred_lead"] = chunk["referred_lead"].fillna(0)
+            yield chunk
+
+    storage = connect_to_storage()
+    deduplicated = {}
+    if DEDUP_ROW_FINGERPRINTS:
+        rows = storage.write_chunks(drop_duplicate_rows(chunks(), read_fingerprint_index(storage), deduplicated),
+                                    "loaded_data")
+        record_deduplication(storage, deduplicated)
+    else:
+        rows = storage.write_chunks(chunks(), "loaded_data")
+
+    elapsed = time.perf_counter() - start
+    print(f"Loaded {rows} rows into loaded_data in {elapsed:.2f}s "
+          f"({rows / max(elapsed, 1e-9):.0f} rows/sec)")
+    return rows
+
+
 ###############################################################################
 # Define function to map cities to their respective tiers
 ###############################################################################
@@ -134,22 +219,17 @@ def map_city_tier():
     SAMPLE USAGE
         map_city_tier()
     '''    
-    # Connect to the database and load data
-    conn = connect_to_db()
-    if conn:
-        df = pd.read_sql_query("SELECT * FROM loaded_data", conn)
-        
-        # Map city to its respective tier
-        df["city_tier"] = df["city_mapped"].map(city_tier_mapping).fillna(3.0)
-        df=df.drop('city_mapped',axis=1)
-        
-        # Save the processed dataframe
-        df.to_sql("city_tier_mapped", conn, if_exists="replace", index=False)
-        conn.close()
-        
-        print("City tier mapping completed and saved to database.")
-    else:
-        print("Error getting connection from the database")
+    # Connect to the storage and load data
+    storage = connect_to_storage()
+    df = apply_schema(storage.read_table("loaded_data"))
+
+    # Map city to its respective tier
+    df = apply_city_tier_mapping(df)
+
+    # Save the processed dataframe
+    storage.write_table(plain_dtypes(df), "city_tier_mapped")
+
+    print("City tier mapping completed and saved to database.")
 
 ###############################################################################
 # Define function to map insignificant categorial variables to "others"
@@ -186,24 +266,13 @@ def map_categorical_vars():
     SAMPLE USAGE
         map_categorical_vars()
     '''
-    conn = connect_to_db()
-    if conn:
-        df = pd.read_sql("SELECT * FROM city_tier_mapped", conn)
-
-        df = concatenate_df(df, "first_platform_c", list_platform)
-        df = concatenate_df(df, "first_utm_medium_c", list_medium)
-        df = concatenate_df(df, "first_utm_source_c", list_source)
-        
-        df['total_leads_droppped'] = df['total_leads_droppped'].fillna(0)
-        df['referred_lead'] = df['referred_lead'].fillna(0)
+    storage = connect_to_storage()
+    df = apply_schema(storage.read_table("city_tier_mapped"))
 
-        df = df.drop_duplicates()
+    df = apply_categorical_mapping(df)
 
-        df.to_sql("categorical_variables_mapped", conn, if_exists="replace", index=False)
-        conn.close()
-        print("Significant categorical variables mapped.")
-    else:
-        print("Error getting connection from the database")
+    storage.write_table(plain_dtypes(df), "categorical_variables_mapped")
+    print("Significant categorical variables mapped.")
 
 
 ##############################################################################
@@ -242,45 +311,773 @@ def interactions_mapping():
         It also drops all the features that are not requried for training model and 
         writes it in a table named 'model_input'
 
+        With PRUNE_UNUSED_COLUMNS set the interaction columns are only loaded
+        if BUILD_INTERACTIONS_MAPPED is set too, see plan_source_columns(), so
+        'interactions_mapped' is only written then: it would hold no
+        interaction group otherwise.
+
     
     SAMPLE USAGE
         interactions_mapping()
     '''
-    conn = connect_to_db()
-    if conn:
-        df = pd.read_sql("SELECT * FROM categorical_variables_mapped", conn)
+    storage = connect_to_storage()
+    df = apply_schema(storage.read_table("categorical_variables_mapped"))
+
+    df = apply_interactions_mapping(df)
+
+    if not PRUNE_UNUSED_COLUMNS or BUILD_INTERACTIONS_MAPPED:
+        storage.write_table(plain_dtypes(df), "interactions_mapped")
+    else:
+        print("Skipped 'interactions_mapped', the interaction columns were pruned, see BUILD_INTERACTIONS_MAPPED")
+
+    storage.write_table(plain_dtypes(select_model_input(df)), "model_input")
+
+
+###############################################################################
+# Define function that runs all the cleaning steps in a single pass
+###############################################################################
+
+def clean_data():
+    '''
+    This function runs map_city_tier, map_categorical_vars and
+    interactions_mapping as one in-memory pass. 'loaded_data' is read once
+    and only 'model_input' is written back, instead of writing and reading
+    back the full table through the db between every step.
+
+
+    INPUTS
+        DB_FILE_NAME : Name of the database file
+        DB_PATH : path where the db file should be present
+        WRITE_INTERMEDIATE_TABLES : if True the intermediate tables
+                                    'city_tier_mapped', 'categorical_variables_mapped'
+                                    and 'interactions_mapped' are written as well,
+                                    which is useful for debugging
+        PRUNE_UNUSED_COLUMNS : if True only the columns of 'loaded_data'
+                               that model_input_schema needs are read, see
+                               plan_source_columns()
+        BUILD_INTERACTIONS_MAPPED : if True the interaction columns are kept
+                                    and 'interactions_mapped' is written too
+
+
+    OUTPUT
+        Saves the model's input in the db in a table named 'model_input'.
+        If the table with the same name already exsists then the function
+        replaces it.
+
+
+    SAMPLE USAGE
+        clean_data()
+    '''
+    storage = connect_to_storage()
+    df = apply_schema(storage.read_table("loaded_data", columns=loaded_data_columns(storage)))
+
+    city_tier_mapped, categorical_variables_mapped, df = apply_cleaning(df, WRITE_INTERMEDIATE_TABLES)
+    if WRITE_INTERMEDIATE_TABLES:
+        storage.write_table(plain_dtypes(city_tier_mapped), "city_tier_mapped")
+        storage.write_table(plain_dtypes(categorical_variables_mapped), "categorical_variables_mapped")
+
+    if WRITE_INTERMEDIATE_TABLES or BUILD_INTERACTIONS_MAPPED:
+        storage.write_table(plain_dtypes(df), "interactions_mapped")
+
+    storage.write_table(plain_dtypes(select_model_input(df)), "model_input")
+    print("Data cleaning completed and model input saved to database.")
+
+
+###############################################################################
+# Define function that loads and cleans only the new or changed days
+###############################################################################
+
+def load_new_days():
+    '''
+    This function is the incremental variant of load_data_into_db followed
+    by clean_data, for a raw csv that grows by a day of leads every day.
+    The rows are partitioned by the day of their 'created_date', and only
+    the days that are new or whose rows changed since the last run are
+    loaded and cleaned; the tables are then updated day by day and the rows
+    of the untouched days are reused as they are. This gives the same rows
+    as a full run since every cleaning step works within a day: the
+    interactions mapping groups the rows on 'created_date'.
+
+    A day changed when the checksum of its raw rows, see scan_days(),
+    differs from the one stored in PARTITIONS_TABLE by the previous run.
+    The rows of the days the previous run didn't load are kept while the
+    checksums are computed, so the csv is only read once unless a day
+    loaded before was edited.
+    Days that are no longer in the csv are deleted. PARTITIONS_TABLE is
+    written last, so a run that fails half way is simply done again by the
+    next one, and running the pipeline again on the same csv changes nothing.
+
+
+    INPUTS
+        DB_FILE_NAME : Name of the database file
+        DB_PATH : path where the db file should be present
+        DATA_DIRECTORY : path of the directory where 'leadscoring.csv'
+                        file is present
+        PARTITIONS_TABLE : table holding the checksum of every day loaded
+        LOAD_DATA_CHUNK_SIZE : number of rows of the csv read at a time
+        PRUNE_UNUSED_COLUMNS : if True only the columns the cleaning steps
+                               need are read from the csv
+        WRITE_INTERMEDIATE_TABLES, BUILD_INTERACTIONS_MAPPED : as in clean_data
+        DEDUP_ROW_FINGERPRINTS : if True the duplicate rows of the days
+                                 loaded are dropped by their fingerprint. A
+                                 day's rows are all loaded again when it
+                                 changes, so FINGERPRINT_INDEX_TABLE isn't
+                                 needed here
+
+
+    OUTPUT
+        Replaces the rows of the new, changed and removed days in
+        'loaded_data' and 'model_input', which keeps 'created_date' as the
+        key of the days, and prints how many days were loaded and reused.
+        On the first run, or when every day changed, the tables are
+        replaced as a whole.
+
+
+    SAMPLE USAGE
+        load_new_days()
+    '''
+    csv_file_path = os.path.join(DATA_DIRECTORY, DATA_FILE_NAME)
+    if USE_INFERENCE_DATA:
+        csv_file_path = os.path.join(DATA_DIRECTORY, DATA_INFERENCE_FILE_NAME)
+    usecols = None
+    if PRUNE_UNUSED_COLUMNS:
+        usecols = set(plan_source_columns()).__contains__
+    storage = connect_to_storage()
+    start = time.perf_counter()
+
+    previous = {}
+    if storage.table_columns(PARTITIONS_TABLE):
+        previous = dict(storage.read_table(PARTITIONS_TABLE, columns=['day', 'checksum']).itertuples(index=False))
+    checksums, df = scan_days(csv_file_path, LOAD_DATA_CHUNK_SIZE, usecols, set(previous))
+
+    changed = sorted(day for day, (checksum, rows) in checksums.items() if previous.get(day) != checksum)
+    removed = sorted(set(previous) - set(checksums))
+    if not changed and not removed:
+        print(f"No new or changed days in {csv_file_path}, {len(checksums)} days reused.")
+        return
+
+    # read the rows of the edited days again
+    changed_days = set(changed)
+    edited_days = changed_days & set(previous)
+    if edited_days:
+        df = pd.concat([df] + [chunk[chunk['created_date'].str[:10].isin(edited_days)]
+                               for chunk in read_raw_chunks(csv_file_path, LOAD_DATA_CHUNK_SIZE, usecols)],
+                       ignore_index=True)
+    df["total_leads_droppped"] = df["total_leads_droppped"].fillna(0)
+    df["referred_lead"] = df["referred_lead"].fillna(0)
+    if DEDUP_ROW_FINGERPRINTS:
+        # the days loaded replace their rows, which have the same fingerprints
+        deduplicated = {}
+        df = next(drop_duplicate_rows([df], np.array([], dtype=np.uint64), deduplicated))
+        print(f"Dropped {deduplicated['duplicates']} duplicate rows of the days loaded")
+
+    if not previous or changed_days >= set(previous):
+        write = storage.write_table
+    else:
+        def write(frame, table_name):
+            storage.replace_days(frame, table_name, 'created_date', changed + removed)
+
+    write(df, "loaded_data")
+
+    city_tier_mapped, categorical_variables_mapped, df = apply_cleaning(apply_schema(df), WRITE_INTERMEDIATE_TABLES)
+    if WRITE_INTERMEDIATE_TABLES:
+        write(plain_dtypes(city_tier_mapped), "city_tier_mapped")
+        write(plain_dtypes(categorical_variables_mapped), "categorical_variables_mapped")
+    if WRITE_INTERMEDIATE_TABLES or BUILD_INTERACTIONS_MAPPED:
+        write(plain_dtypes(df), "interactions_mapped")
+    write(plain_dtypes(select_model_input(df)), "model_input")
+
+    storage.write_table(pd.DataFrame([(day, checksum, rows) for day, (checksum, rows) in sorted(checksums.items())],
+                                     columns=['day', 'checksum', 'rows']), PARTITIONS_TABLE)
+    print(f"Loaded {len(changed)} new or changed days ({sum(checksums[day][1] for day in changed)} rows), "
+          f"removed {len(removed)} and reused {len(checksums) - len(changed)} days "
+          f"in {time.perf_counter() - start:.2f}s")
+
+
+def read_raw_chunks(csv_file_path, chunk_size, usecols=None):
+    '''
+    Reads the raw csv chunk_size rows at a time. The text columns are read as
+    strings even when a chunk only holds nulls, and the numeric columns of
+    raw_data_schema as floats even when a chunk only holds integers, but for
+    the 0/1 'app_complete_flag', so that a row reads the same whatever chunk
+    it falls in and every chunk has the dtypes of the first one.
+    '''
+    text_columns = ['created_date', 'city_mapped', *significant_levels]
+    dtypes = {column: float for column in raw_data_schema if column != 'app_complete_flag'}
+    dtypes.update({column: str for column in text_columns})
+    return pd.read_csv(csv_file_path, chunksize=chunk_size, usecols=usecols, dtype=dtypes)
+
+
+def scan_days(csv_file_path, chunk_size, usecols=None, known_days=()):
+    '''
+    Returns {day: (checksum, rows)} for every day of 'created_date' in the
+    raw csv, read chunk_size rows at a time, and a dataframe of the rows of
+    the days that aren't in known_days. The checksum of a day is the
+    sum, modulo 2**64, of the 64 bit hashes of its rows, as a hex string: it
+    doesn't depend on the order of the rows and changes when a row of the
+    day is added, removed or edited. Rows without a 'created_date' are
+    skipped, the interactions mapping drops them anyway.
+
+    SAMPLE USAGE
+        checksums, new_rows = scan_days(csv_file_path, 100000, known_days={'2021-07-01'})
+    '''
+    sums = {}
+    counts = {}
+    new_rows = []
+    for chunk in read_raw_chunks(csv_file_path, chunk_size, usecols):
+        # hash the numbers as floats, a column read as int in one chunk may be float in another
+        numeric = [column for column in chunk.columns if chunk[column].dtype.kind in "biuf"]
+        hashes = pd.util.hash_pandas_object(chunk.astype({column: float for column in numeric}), index=False).to_numpy()
+        codes, days = pd.factorize(chunk['created_date'].str[:10])
+        dated = codes >= 0
+        # the code of a row without a date is -1, which picks the appended True
+        known = np.append(days.isin(list(known_days)), True)
+        new_rows.append(chunk[~known[codes]])
+        day_sums = np.zeros(len(days), dtype=np.uint64)
+        np.add.at(day_sums, codes[dated], hashes[dated])
+        day_counts = np.bincount(codes[dated], minlength=len(days))
+        for day, day_sum, day_count in zip(days, day_sums.tolist(), day_counts.tolist()):
+            sums[day] = (sums.get(day, 0) + day_sum) % 2 ** 64
+            counts[day] = counts.get(day, 0) + day_count
+    checksums = {day: (f"{sums[day]:016x}", counts[day]) for day in sums}
+    return checksums, pd.concat(new_rows, ignore_index=True)
+
+
+###############################################################################
+# Define the functions that drop the duplicate rows by their fingerprint
+###############################################################################
+
+def fingerprint_rows(df):
+    '''
+    Returns the 64 bit fingerprint of every row of df, raw rows as loaded, as
+    a uint64 array. It is a hash of the row as apply_categorical_mapping sees
+    it when it drops the duplicate rows, with 'city_tier' in place of
+    'city_mapped' and the insignificant levels mapped to "others", so two rows
+    have the same fingerprint when the cleaning steps would drop one of them
+    (but for a collision of the hashes, once in about 2**64 pairs of rows).
+    The text columns are hashed as strings and the others as floats, so that
+    a row gets the same fingerprint whatever chunk of the csv it is read in.
+
+    SAMPLE USAGE
+        fingerprints = fingerprint_rows(chunk)
+    '''
+    df = collapse_insignificant_levels(apply_city_tier_mapping(df.copy()), significant_levels)
+    df['total_leads_droppped'] = df['total_leads_droppped'].fillna(0)
+    df['referred_lead'] = df['referred_lead'].fillna(0)
+    text_columns = ['created_date', *significant_levels]
+    df = df.astype({column: object if column in text_columns else float for column in df.columns})
+    return pd.util.hash_pandas_object(df, index=False).to_numpy()
+
+
+def drop_duplicate_rows(chunks, remembered, deduplicated):
+    '''
+    Yields the chunks of raw rows without the rows whose fingerprint, see
+    fingerprint_rows(), an earlier row of the chunks has, or that is in
+    remembered, the sorted fingerprints of the rows loaded by earlier runs.
+    This is the one pass that drops the duplicate rows: the cleaning steps
+    don't drop them again when DEDUP_ROW_FINGERPRINTS is set.
+
+    The number of rows dropped as duplicates and as re-delivered from an
+    earlier run, and with REMEMBER_ROW_FINGERPRINTS the fingerprints and
+    days of the rows kept, are collected in the dict deduplicated for
+    record_deduplication(). The fingerprints kept so far are held in sorted
+    uint64 runs, see add_sorted_run(), 8 bytes a row of the file.
+
+    SAMPLE USAGE
+        deduplicated = {}
+        rows = storage.write_chunks(drop_duplicate_rows(chunks, remembered, deduplicated), "loaded_data")
+    '''
+    deduplicated.update(fingerprints=[], days=[], duplicates=0, redelivered=0)
+    seen = []
+    for chunk in chunks:
+        fingerprints = fingerprint_rows(chunk)
+        redelivered = in_sorted_runs([remembered], fingerprints)
+        duplicate = pd.Series(fingerprints).duplicated().to_numpy() | in_sorted_runs(seen, fingerprints)
+        keep = ~(redelivered | duplicate)
+
+        deduplicated['redelivered'] += int(redelivered.sum())
+        deduplicated['duplicates'] += int((duplicate & ~redelivered).sum())
+        if REMEMBER_ROW_FINGERPRINTS:
+            deduplicated['fingerprints'].append(fingerprints[keep])
+            deduplicated['days'].append(chunk['created_date'][keep].astype(object).str[:10])
+        add_sorted_run(seen, np.sort(fingerprints[keep]))
+        yield chunk[keep]
+
+
+def add_sorted_run(runs, fingerprints):
+    '''
+    Adds the sorted array fingerprints to runs, a list of sorted arrays that
+    are at least as long as the next one, merging the last runs until they
+    are again. A file of n rows is then held in at most log2(n) runs, and
+    every row is merged about log2(n) times.
+    '''
+    if len(fingerprints):
+        runs.append(fingerprints)
+    while len(runs) > 1 and len(runs[-2]) <= len(runs[-1]):
+        last = runs.pop()
+        runs[-1] = np.sort(np.concatenate([runs[-1], last]), kind='stable')
+
+
+def in_sorted_runs(runs, fingerprints):
+    # whether each fingerprint is in one of the sorted arrays of runs
+    found = np.zeros(len(fingerprints), dtype=bool)
+    for run in runs:
+        if len(run):
+            positions = np.searchsorted(run, fingerprints).clip(max=len(run) - 1)
+            found |= run[positions] == fingerprints
+    return found
+
+
+def read_fingerprint_index(storage):
+    '''
+    Returns the sorted fingerprints of FINGERPRINT_INDEX_TABLE when
+    REMEMBER_ROW_FINGERPRINTS is set, and none otherwise.
+    '''
+    if not REMEMBER_ROW_FINGERPRINTS or not storage.table_columns(FINGERPRINT_INDEX_TABLE):
+        return np.array([], dtype=np.uint64)
+    fingerprints = storage.read_table(FINGERPRINT_INDEX_TABLE, columns=['fingerprint'])['fingerprint']
+    return np.unique(fingerprints.to_numpy(dtype=np.int64).view(np.uint64))
+
+
+def record_deduplication(storage, deduplicated):
+    '''
+    Prints the number of rows drop_duplicate_rows() dropped and, when
+    REMEMBER_ROW_FINGERPRINTS is set, appends the fingerprints of the rows
+    loaded to FINGERPRINT_INDEX_TABLE, with the day of their 'created_date'.
+    It is called once the rows are saved, so that a load which fails is
+    simply done again by the next run. Returns the number of rows dropped.
+    '''
+    if REMEMBER_ROW_FINGERPRINTS:
+        fingerprints = np.concatenate(deduplicated['fingerprints'] or [np.array([], dtype=np.uint64)])
+        index = pd.DataFrame({'fingerprint': fingerprints.view(np.int64),
+                              'day': pd.concat(deduplicated['days'] or [pd.Series([], dtype=object)],
+                                               ignore_index=True)})
+        storage.append_table(index, FINGERPRINT_INDEX_TABLE)
+    removed = deduplicated['duplicates'] + deduplicated['redelivered']
+    print(f"Dropped {removed} rows by their fingerprint: {deduplicated['duplicates']} duplicates "
+          f"and {deduplicated['redelivered']} re-delivered rows loaded by an earlier run")
+    return removed
+
+
+###############################################################################
+# Define the functions that clean the data in shards of days mapped to tasks
+###############################################################################
+
+def plan_date_shards():
+    '''
+    This function splits 'loaded_data' into up to DATE_SHARDS ranges of days
+    of 'created_date' holding about as many rows each, so that the cleaning
+    steps run on every range in a task of its own, see clean_date_shard(),
+    and their outputs are merged by merge_date_shards(). A day is never
+    split, since the interactions mapping groups the rows of a day
+    together, so a day holding more rows than a shard makes for fewer
+    shards. The first range is open at the start and also takes the rows
+    without a date, the last one is open at the end.
+
+
+    INPUTS
+        DB_FILE_NAME : Name of the database file
+        DB_PATH : path where the db file should be present
+        DATE_SHARDS : greatest number of shards
+        DATE_SHARDS_TABLE : table the plan is written to
+
+
+    OUTPUT
+        Writes the plan to DATE_SHARDS_TABLE, one row per shard, and returns
+        it as a list of dicts with the shard number, its first and last day
+        and its rows, the op_kwargs of the mapped clean_date_shard tasks.
+
+
+    SAMPLE USAGE
+        shards = plan_date_shards()
+    '''
+    storage = connect_to_storage()
+    days = storage.read_table("loaded_data", columns=['created_date'])['created_date'].str[:10]
+    rows_per_day = days.value_counts().sort_index()
+
+    # a day goes to the shard its first row falls in when the dated rows are
+    # cut in DATE_SHARDS equal parts, the shards left empty are skipped
+    rows_before = rows_per_day.cumsum().to_numpy() - rows_per_day.to_numpy()
+    _, shard_of_day = np.unique(rows_before * DATE_SHARDS // max(rows_per_day.sum(), 1), return_inverse=True)
+    shards = int(shard_of_day.max()) + 1 if len(rows_per_day) else 1
+
+    plan = []
+    for shard in range(shards):
+        shard_days = rows_per_day[shard_of_day == shard]
+        plan.append({'shard': shard,
+                     'first_day': shard_days.index[0] if shard > 0 else None,
+                     'last_day': shard_days.index[-1] if shard < shards - 1 else None,
+                     'rows': int(shard_days.sum())})
+    plan[0]['rows'] += int(days.isna().sum())
+
+    storage.write_table(pd.DataFrame(plan, columns=['shard', 'first_day', 'last_day', 'rows']), DATE_SHARDS_TABLE)
+    print(f"Planned {shards} date shards of {len(days)} rows, "
+          f"{min(shard['rows'] for shard in plan)} to {max(shard['rows'] for shard in plan)} rows each")
+    return plan
+
+
+def clean_date_shard(shard, first_day, last_day, rows):
+    '''
+    This function runs the cleaning steps of clean_data on the rows of
+    'loaded_data' from first_day to last_day, a shard planned by
+    plan_date_shards(), and writes the tables clean_data would write for
+    these rows to '<table>__shard_<shard>'.
+
+
+    INPUTS
+        shard, first_day, last_day, rows : the shard as planned
+        DB_FILE_NAME, DB_PATH, WRITE_INTERMEDIATE_TABLES, PRUNE_UNUSED_COLUMNS,
+        BUILD_INTERACTIONS_MAPPED : as in clean_data
+
+
+    OUTPUT
+        Writes the shard's tables, replacing them. Raises a ValueError if
+        the shard doesn't hold the planned number of rows, which means that
+        'loaded_data' was written again since the shards were planned.
+
+
+    SAMPLE USAGE
+        clean_date_shard(**shards[0])
+    '''
+    storage = connect_to_storage()
+    df = storage.read_days("loaded_data", 'created_date', first_day, last_day, columns=loaded_data_columns(storage))
+    if len(df) != rows:
+        raise ValueError(f"Date shard {shard} holds {len(df)} rows of 'loaded_data' instead of the {rows} "
+                         f"planned, 'loaded_data' changed since the shards were planned")
+
+    city_tier_mapped, categorical_variables_mapped, df = apply_cleaning(apply_schema(df), WRITE_INTERMEDIATE_TABLES)
+    tables = {"city_tier_mapped": city_tier_mapped, "categorical_variables_mapped": categorical_variables_mapped,
+              "interactions_mapped": df, "model_input": select_model_input(df)}
+    for table_name in cleaned_table_names():
+        storage.write_table(plain_dtypes(tables[table_name]), f"{table_name}__shard_{shard}")
+    print(f"Cleaned date shard {shard} ({first_day} to {last_day}, {rows} rows)")
+
+
+def merge_date_shards():
+    '''
+    This function checks the outputs of the date shards planned in
+    DATE_SHARDS_TABLE and merges them, a shard at a time, into the tables
+    clean_data writes. Every shard must have written every table with the
+    same columns, and the dated rows of a shard must fall within its range;
+    all the shard tables are checked before the first table is written.
+
+    The shards are merged in the order of their days. 'created_date' is the
+    first of the index columns the interactions mapping sorts its groups
+    by, so 'interactions_mapped' and 'model_input' come out as the ones of
+    clean_data; the rows of the intermediate tables are in the order of
+    'loaded_data' within every shard. The shard tables are dropped once
+    merged.
+
+
+    INPUTS
+        DB_FILE_NAME, DB_PATH, DATE_SHARDS_TABLE, WRITE_INTERMEDIATE_TABLES,
+        BUILD_INTERACTIONS_MAPPED : as in plan_date_shards and clean_data
+
+
+    OUTPUT
+        Saves the model's input in 'model_input', and the intermediate tables
+        if they are written, replacing them. Raises a ValueError if a shard
+        is missing or doesn't match its plan, leaving the tables untouched.
+
+
+    SAMPLE USAGE
+        merge_date_shards()
+    '''
+    storage = connect_to_storage()
+    plan = storage.read_table(DATE_SHARDS_TABLE)
+    plan = plan.astype(object).where(plan.notna(), None).to_dict('records')
+
+    # every shard table is checked before any table is replaced
+    for table_name in cleaned_table_names():
+        shard_tables = [f"{table_name}__shard_{shard['shard']}" for shard in plan]
+        columns = [storage.table_columns(shard_table) for shard_table in shard_tables]
+        for shard, shard_table, shard_columns in zip(plan, shard_tables, columns):
+            if shard_columns != columns[0] or not shard_columns:
+                raise ValueError(f"Date shard table '{shard_table}' is missing or its columns differ from "
+                                 f"'{shard_tables[0]}', run the cleaning of the shards again")
+            if 'created_date' in shard_columns:
+                created_date = storage.read_table(shard_table, columns=['created_date'])['created_date']
+                check_date_shard(created_date, shard, shard_table)
+
+    for table_name in cleaned_table_names():
+        shard_tables = [f"{table_name}__shard_{shard['shard']}" for shard in plan]
+        rows = storage.write_chunks((storage.read_table(shard_table, read_only=True) for shard_table in shard_tables), table_name)
+        print(f"Merged {len(plan)} date shards into '{table_name}' ({rows} rows)")
+
+    for table_name in cleaned_table_names():
+        for shard in plan:
+            storage.drop_table(f"{table_name}__shard_{shard['shard']}")
+
+
+def check_date_shard(created_date, shard, shard_table):
+    # the rows of shard_table are within the range of the shard, as read by
+    # storage.read_days: only the first shard takes the rows without a date
+    days = created_date.str[:10]
+    inside = days.notna()
+    if shard['first_day'] is not None:
+        inside &= days >= shard['first_day']
+    if shard['last_day'] is not None:
+        inside &= days <= shard['last_day']
+    if shard['first_day'] is None:
+        inside |= days.isna()
+    if not inside.all():
+        raise ValueError(f"Date shard table '{shard_table}' holds rows outside of "
+                         f"{shard['first_day']} to {shard['last_day']}")
+
+
+def cleaned_table_names():
+    '''
+    Names of the tables clean_data writes, in the order it writes them.
+    '''
+    table_names = []
+    if WRITE_INTERMEDIATE_TABLES:
+        table_names += ["city_tier_mapped", "categorical_variables_mapped"]
+    if WRITE_INTERMEDIATE_TABLES or BUILD_INTERACTIONS_MAPPED:
+        table_names.append("interactions_mapped")
+    return table_names + ["model_input"]
+
+
+def loaded_data_columns(storage):
+    '''
+    Columns of 'loaded_data' the cleaning steps read: the ones planned by
+    plan_source_columns() with PRUNE_UNUSED_COLUMNS set, None for all.
+    '''
+    if not PRUNE_UNUSED_COLUMNS:
+        return None
+    source_columns = set(plan_source_columns())
+    return [column for column in storage.table_columns("loaded_data") if column in source_columns]
+
+
+###############################################################################
+# Define the in-memory transformations used by the cleaning steps
+###############################################################################
+
+def plan_source_columns():
+    '''
+    Works out which columns of the raw data the cleaning steps need to
+    produce the columns of model_input_schema, and every interaction group
+    as well when BUILD_INTERACTIONS_MAPPED is set.
+
+    The index columns of the current mode are always needed since the
+    interactions mapping groups the rows on them, 'city_tier' is derived from
+    'city_mapped' and every interaction group from its interaction columns in
+    'interaction_mapping.csv'. Since NOT_FEATURES drops all the interaction
+    groups from 'model_input', none of the interaction columns are needed
+    by default and apply_interactions_mapping, which only sums the
+    interaction columns present, has nothing left to do but group the rows.
+
+    SAMPLE USAGE
+        df = pd.read_csv(csv_file_path, usecols=plan_source_columns())
+    '''
+    index_columns = INDEX_COLUMNS_INFERENCE if USE_INFERENCE_DATA else INDEX_COLUMNS_TRAINING
+    interaction_columns, interaction_groups, group_matrix = compile_interaction_mapping(INTERACTION_MAPPING)
+
+    outputs = set(model_input_schema) | set(index_columns)
+    if BUILD_INTERACTIONS_MAPPED:
+        outputs |= set(interaction_groups)
+
+    # source columns of the derived columns, the others are read as they are
+    sources = {'city_tier': ['city_mapped']}
+    for group, group_column in zip(interaction_groups, group_matrix.T):
+        sources[group] = [column for column, in_group in zip(interaction_columns, group_column) if in_group]
+
+    needed = {source for column in outputs for source in sources.get(column, [column])}
+    return [column for column in raw_data_schema if column in needed]
+
+
+def apply_schema(df):
+    '''
+    Casts the lead columns of df to the dtypes declared in schema.py, so that
+    they are carried as compact dtypes through every step: the categorical
+    source columns become categoricals ('first_platform_c', 'first_utm_medium_c'
+    and 'first_utm_source_c' with their fixed significant levels once these
+    have been collapsed), 'city_tier' a categorical over city_tier_levels and
+    the interaction counts interaction_count_dtype. Columns not in df are
+    skipped.
+
+    SAMPLE USAGE
+        df = apply_schema(storage.read_table("loaded_data"))
+    '''
+    interaction_columns, _, _ = compile_interaction_mapping(INTERACTION_MAPPING)
+    dtypes = {column: interaction_count_dtype for column in interaction_columns}
+    dtypes.update({column: "category" for column in categorical_columns})
+    for column, levels in significant_levels.items():
+        if column in df.columns and df[column].isin(levels + ["others"]).all():
+            dtypes[column] = pd.CategoricalDtype(sorted(set(levels) | {"others"}))
+    dtypes["city_tier"] = pd.CategoricalDtype(city_tier_levels)
+    return df.astype({column: dtype for column, dtype in dtypes.items() if column in df.columns}, copy=False)
+
+
+def plain_dtypes(df):
+    '''
+    Casts the categorical columns of df back to the dtype of their categories,
+    which is what is stored in the db tables.
+    '''
+    categorical = [column for column in df.columns if isinstance(df[column].dtype, pd.CategoricalDtype)]
+    return df.astype({column: df[column].cat.categories.dtype for column in categorical}, copy=False)
+
+
+def apply_cleaning(df, keep_intermediate=False):
+    '''
+    Runs the city tier, categorical and interactions mappings on df and
+    returns the city tier mapped, categorical variables mapped and
+    interactions mapped dataframes, the first two only if keep_intermediate
+    is set (None otherwise). With CLEANING_SHARDS above 1 the mappings run
+    on that many shards of df in parallel, see apply_cleaning_in_shards().
+
+    SAMPLE USAGE
+        _, _, df = apply_cleaning(apply_schema(storage.read_table("loaded_data")))
+    '''
+    if CLEANING_SHARDS > 1 and len(df) > 0:
+        return apply_cleaning_in_shards(df, CLEANING_SHARDS, keep_intermediate)
+    return apply_cleaning_steps(df, keep_intermediate)
+
+
+def apply_cleaning_steps(df, keep_intermediate=False):
+    '''
+    Serial version of apply_cleaning(), also run on every shard.
+    '''
+    df = apply_city_tier_mapping(df)
+    # the categorical mapping collapses the levels in place
+    city_tier_mapped = df.copy() if keep_intermediate else None
+    df = apply_categorical_mapping(df)
+    categorical_variables_mapped = df if keep_intermediate else None
+    return city_tier_mapped, categorical_variables_mapped, apply_interactions_mapping(df)
+
+
+def apply_cleaning_in_shards(df, shards, keep_intermediate=False):
+    '''
+    Runs apply_cleaning_steps() on shards of df in a pool of processes and
+    merges their results into exactly what the serial run gives.
+
+    The rows are sharded by a hash of their 'created_date'. It is one of the
+    index columns in both modes and isn't changed by the mappings, so all
+    the rows the interactions mapping groups together, and all the copies
+    of a duplicate row, fall into the same shard. The row by row results
+    are then put back in the order of df by their index, and the groups in
+    the sorted order of the index columns the serial groupby gives.
+
+    The workers are forked, so that they share the loaded mappings and the
+    constants of the parent process. Where fork isn't available (Windows)
+    the steps run serially instead.
+    '''
+    if "fork" not in get_all_start_methods():
+        # spawned workers would load constants.py again, not share the ones set here
+        print("fork is not available, cleaning in a single process")
+        return apply_cleaning_steps(df, keep_intermediate)
+    index_columns = INDEX_COLUMNS_INFERENCE if USE_INFERENCE_DATA else INDEX_COLUMNS_TRAINING
+    shard_of_rows = pd.util.hash_array(df['created_date'].to_numpy(dtype=object)) % shards
+    parts = [df[shard_of_rows == shard] for shard in range(shards)]
+    parts = [part for part in parts if len(part)]
+
+    with ProcessPoolExecutor(len(parts), mp_context=get_context("fork")) as pool:
+        results = list(pool.map(apply_cleaning_steps, parts, [keep_intermediate] * len(parts)))
+
+    city_tier_mapped = categorical_variables_mapped = None
+    if keep_intermediate:
+        city_tier_mapped = pd.concat([result[0] for result in results]).sort_index()
+        categorical_variables_mapped = pd.concat([result[1] for result in results]).sort_index()
+    interactions_mapped = pd.concat([result[2] for result in results]).sort_values(index_columns, ignore_index=True)
+    interactions_mapped.columns.name = 'interaction_mapping'
+    return city_tier_mapped, categorical_variables_mapped, interactions_mapped
+
+
+def apply_city_tier_mapping(df):
+    '''
+    Maps 'city_mapped' to 'city_tier' using city_tier_mapping (unmapped
+    cities are tier 3.0) and drops 'city_mapped'.
+    '''
+    city_tier = df["city_mapped"].map(city_tier_mapping).astype(float).fillna(3.0)
+    df["city_tier"] = pd.Categorical(city_tier, categories=city_tier_levels)
+    return df.drop('city_mapped', axis=1)
+
+
+def apply_categorical_mapping(df):
+    '''
+    Maps the insignificant levels of 'first_platform_c', 'first_utm_medium_c'
+    and 'first_utm_source_c' to "others", fills the nulls in
+    'total_leads_droppped' and 'referred_lead' and drops duplicate rows,
+    unless DEDUP_ROW_FINGERPRINTS is set: they were dropped when loaded.
+    '''
+    df = collapse_insignificant_levels(df, significant_levels)
+
+    df['total_leads_droppped'] = df['total_leads_droppped'].fillna(0)
+    df['referred_lead'] = df['referred_lead'].fillna(0)
+
+    if DEDUP_ROW_FINGERPRINTS:
+        return df
+    return df.drop_duplicates()
+
+
+def apply_interactions_mapping(df):
+    '''
+    Sums the interaction columns into the interaction types of
+    'interaction_mapping.csv', grouping on the index columns of the current
+    mode (training or inference).
+
+    This gives the same result as melting the interaction columns to long
+    format, merging them with the mapping file and pivoting back with a sum,
+    without materialising the long frame: the wide interaction values are
+    multiplied by the compiled column-to-group matrix and the per-row group
+    sums are then summed over the index columns.
+    '''
+    if not DEDUP_ROW_FINGERPRINTS:
         df = df.drop_duplicates()
-        
-        interaction_mapping = pd.read_csv(INTERACTION_MAPPING)
-        if USE_INFERENCE_DATA:
-            df = df.melt(id_vars=INDEX_COLUMNS_INFERENCE, var_name="interaction_type", value_name="interaction_value")
-        else:
-            df = df.melt(id_vars=INDEX_COLUMNS_TRAINING, var_name="interaction_type", value_name="interaction_value")
-        # handle the nulls in the interaction value column
-        df['interaction_value'] = df['interaction_value'].fillna(0)
-
-        # map interaction type column with the mapping file to get interaction mapping
-        df = df.merge(interaction_mapping, on="interaction_type", how="left")
-
-        #dropping the interaction type column as it is not needed
-        df = df.drop(['interaction_type'], axis=1)
-
-        if USE_INFERENCE_DATA:
-            df = df.pivot_table(index=INDEX_COLUMNS_INFERENCE, values="interaction_value", columns='interaction_mapping', aggfunc='sum').reset_index()
-        else:
-            df = df.pivot_table(index=INDEX_COLUMNS_TRAINING, values="interaction_value", columns='interaction_mapping', aggfunc='sum').reset_index()
-        
-        df.to_sql("interactions_mapped", conn, if_exists="replace", index=False)
-        
-        if 'app_complete_flag' in df.columns:
-            feature_columns = [col for col in df.columns if col not in NOT_FEATURES]
-        else:
-            feature_columns = [col for col in df.columns if col not in NOT_FEATURES and col != 'app_complete_flag']
-        
-        df[feature_columns].to_sql("model_input", conn, if_exists="replace", index=False)
-        conn.close()
+    index_columns = INDEX_COLUMNS_INFERENCE if USE_INFERENCE_DATA else INDEX_COLUMNS_TRAINING
+    interaction_columns, interaction_groups, group_matrix = compile_interaction_mapping(INTERACTION_MAPPING)
+
+    # only the interaction columns present in df, and the groups they feed, take part
+    present = [i for i, column in enumerate(interaction_columns)
+               if column in df.columns and column not in index_columns]
+    group_matrix = group_matrix[present]
+    fed_groups = group_matrix.any(axis=0)
+
+    # handle the nulls in the interaction columns and sum them per group
+    values = df[[interaction_columns[i] for i in present]].to_numpy(dtype=float, na_value=0.0)
+    values = values @ group_matrix[:, fed_groups]
+
+    df = pd.concat([df[index_columns].reset_index(drop=True),
+                    pd.DataFrame(values, columns=[group for group, fed in zip(interaction_groups, fed_groups) if fed])],
+                   axis=1)
+    df = df.groupby(index_columns, sort=True, dropna=True, observed=True).sum().reset_index()
+    df.columns.name = 'interaction_mapping'
+    return df
+
+
+def select_model_input(df):
+    '''
+    Drops the NOT_FEATURES columns from the interactions mapped dataframe.
+    When preparing inference data with KEEP_CREATED_DATE_FOR_INFERENCE set,
+    'created_date' is kept as the key the inference pipeline scores new
+    leads by. The incremental pipeline, see load_new_days(), keeps it in
+    both modes as the key of the days of 'model_input'.
+    '''
+    not_features = NOT_FEATURES
+    if INCREMENTAL_DATA_PIPELINE or (USE_INFERENCE_DATA and KEEP_CREATED_DATE_FOR_INFERENCE):
+        not_features = [col for col in NOT_FEATURES if col != 'created_date']
+    if 'app_complete_flag' in df.columns:
+        feature_columns = [col for col in df.columns if col not in not_features]
     else:
-        print("Error getting connection from the database")
+        feature_columns = [col for col in df.columns if col not in not_features and col != 'app_complete_flag']
+    return df[feature_columns]
+
+@lru_cache(maxsize=None)
+def compile_interaction_mapping(interaction_mapping_file):
+    '''
+    Compiles 'interaction_mapping.csv' into the list of interaction columns,
+    the sorted list of interaction groups and a read-only column-to-group
+    matrix whose row i is the one-hot group of interaction column i. The
+    result is cached, so the file is only read once per process.
+    '''
+    interaction_mapping = pd.read_csv(interaction_mapping_file)
+    interaction_groups = sorted(interaction_mapping["interaction_mapping"].dropna().unique())
+    group_codes = pd.Categorical(interaction_mapping["interaction_mapping"], categories=interaction_groups).codes
+
+    group_matrix = np.zeros((len(interaction_mapping), len(interaction_groups)))
+    mapped = np.flatnonzero(group_codes >= 0)
+    group_matrix[mapped, group_codes[mapped]] = 1.0
+    group_matrix.setflags(write=False)
+    return tuple(interaction_mapping["interaction_type"]), tuple(interaction_groups), group_matrix
 
 def create_database(db_full_path):
     """Creates an SQLite database if it doesn't exist."""    
@@ -290,14 +1087,31 @@ def create_database(db_full_path):
     except Error as e:
         print(f"Error creating database: {e}")
 
-def connect_to_db(db_full_path):
-    conn = sqlite3.connect(db_full_path)
-    print("connecting to db from path: ", db_full_path)
-    return conn
-
-def concatenate_df(df, column, significant_categorical_list):
-    new_df = df[~df[column].isin(significant_categorical_list)] # get rows for levels which are not present in significant_categorical_list
-    new_df[column] = "others" # replace the value of these levels to others
-    old_df = df[df[column].isin(significant_categorical_list)] # get rows for levels which are present in significant_categorical_list
-    df = pd.concat([new_df, old_df])
-    return df
\ No newline at end of file
+def connect_to_db():
+    # same tuned connection as the sqlite storage
+    return SQLiteStorage(os.path.join(DB_PATH, DB_FILE_NAME)).connect()
+
+def connect_to_storage():
+    '''
+    Returns the storage of the pipeline's tables for the STORAGE_BACKEND set
+    in constants.py, see storage.py.
+    '''
+    return get_storage(STORAGE_BACKEND, os.path.join(DB_PATH, DB_FILE_NAME), PARQUET_DIRECTORY,
+                       ARROW_DIRECTORY, SQLITE_EXPORT_TABLES)
+
+def collapse_insignificant_levels(df, levels):
+    '''
+    Maps, in place, every level of the columns in 'levels' that isn't one of
+    their significant levels (nulls included) to "others". Each column
+    becomes a categorical whose categories are its significant levels and
+    "others", sorted so that the categorical sorts like the strings did.
+    Rows keep their order and the rest of the frame isn't copied.
+
+    SAMPLE USAGE
+        collapse_insignificant_levels(df, significant_levels)
+    '''
+    for column, significant_levels_of_column in levels.items():
+        categories = pd.CategoricalDtype(sorted(set(significant_levels_of_column) | {"others"}))
+        df[column] = df[column].astype(categories).fillna("others")
+    return df
+
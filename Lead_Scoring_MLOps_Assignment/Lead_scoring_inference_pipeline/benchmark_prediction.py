@@ -0,0 +1,74 @@
+'''
+filename: benchmark_prediction.py
+functions: benchmark, main
+version: 1
+
+Times the pyfunc model against the NativeLightGBMModel of the version of
+MODEL_NAME in STAGE, on the rows of 'features_inference' repeated to 10k,
+1M and 10M rows (or the row counts given as arguments). The rows are scored
+CHUNK_ROWS at a time so that 10M rows fit in memory, and the predictions of
+both paths are checked to be the same.
+
+SAMPLE USAGE
+    python -m Lead_scoring_inference_pipeline.benchmark_prediction
+    python -m Lead_scoring_inference_pipeline.benchmark_prediction 10000 1000000
+'''
+
+###############################################################################
+# Import necessary modules
+# ##############################################################################
+
+import sys
+import time
+
+import mlflow
+import numpy as np
+
+from Lead_scoring_inference_pipeline import utils
+from Lead_scoring_inference_pipeline.constants import *
+
+ROW_COUNTS = [10_000, 1_000_000, 10_000_000]
+CHUNK_ROWS = 1_000_000
+
+
+###############################################################################
+# Define the benchmark
+# ##############################################################################
+
+def benchmark(models, features, rows, chunk_rows=CHUNK_ROWS):
+    '''
+    Scores rows rows, built by repeating features, with every model of the
+    dict models and returns {name: seconds spent in predict}.
+    '''
+    seconds = dict.fromkeys(models, 0.0)
+    for start in range(0, rows, chunk_rows):
+        size = min(chunk_rows, rows - start)
+        chunk = features.iloc[np.arange(start, start + size) % len(features)].reset_index(drop=True)
+        predictions = {}
+        for name, model in models.items():
+            begin = time.perf_counter()
+            predictions[name] = np.asarray(model.predict(chunk))
+            seconds[name] += time.perf_counter() - begin
+        first, *others = predictions.values()
+        if any(not np.array_equal(first, other) for other in others):
+            raise AssertionError(f"predictions differ between {list(models)}")
+    return seconds
+
+
+def main(row_counts=ROW_COUNTS):
+    mlflow.set_tracking_uri(TRACKING_URI)
+    version = utils.model_cache.latest_version(MODEL_NAME, STAGE)
+    models = {"pyfunc": utils.model_cache.load_version(MODEL_NAME, version),
+              "native": utils.model_cache.load_version(MODEL_NAME, version, "lightgbm")}
+    features = utils.connect_to_storage().read_table("features_inference")[ONE_HOT_ENCODED_FEATURES]
+
+    print(f"'{MODEL_NAME}' version {version}, num_threads={BOOSTER_NUM_THREADS}")
+    print(f"{'rows':>12} {'pyfunc s':>10} {'native s':>10} {'speedup':>8}")
+    for rows in row_counts:
+        seconds = benchmark(models, features, rows)
+        print(f"{rows:>12} {seconds['pyfunc']:>10.3f} {seconds['native']:>10.3f} "
+              f"{seconds['pyfunc'] / seconds['native']:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main([int(rows) for rows in sys.argv[1:]] or ROW_COUNTS)
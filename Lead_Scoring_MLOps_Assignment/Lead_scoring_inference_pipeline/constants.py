@@ -1,6 +1,16 @@
 DB_PATH = "/Users/rpandey1/airflow/dags/Lead_scoring_data_pipeline/db"
 DB_FILE_NAME = "lead_scoring_data_cleaning.db"
 
+# backend storing the pipeline's tables, must match the data pipeline's
+# 'sqlite' (the db file above), 'parquet' (one Parquet file per table in
+# PARQUET_DIRECTORY) or 'arrow' (one memory-mapped Arrow file per table in
+# ARROW_DIRECTORY). With 'arrow' the tables in SQLITE_EXPORT_TABLES are also
+# written to the db file
+STORAGE_BACKEND = 'sqlite'
+PARQUET_DIRECTORY = "/Users/rpandey1/airflow/dags/Lead_scoring_data_pipeline/db/parquet"
+ARROW_DIRECTORY = "/Users/rpandey1/airflow/dags/Lead_scoring_data_pipeline/db/arrow"
+SQLITE_EXPORT_TABLES = ['predictions']
+
 DB_FILE_MLFLOW = "Lead_scoring_mlflow_production.db"
 
 FILE_PATH = "/Users/rpandey1/airflow/dags/Lead_scoring_inference_pipeline/"
@@ -12,6 +22,44 @@ MODEL_NAME = "LightGBM"
 STAGE = "production"
 EXPERIMENT = "Lead_scoring_mlflow_production"
 
+# keep the downloaded models in MODEL_CACHE_DIRECTORY, one directory per
+# registered version, and the last MODEL_CACHE_SIZE loaded models in memory
+USE_MODEL_CACHE = False
+MODEL_CACHE_DIRECTORY = "/Users/rpandey1/airflow/dags/Lead_scoring_inference_pipeline/model_cache"
+MODEL_CACHE_SIZE = 2
+
+# score with the LightGBM booster of the registered classifier on numpy arrays
+# instead of the pyfunc model, which stays the fallback. BOOSTER_NUM_THREADS
+# is LightGBM's num_threads, 0 for one thread per core
+USE_NATIVE_BOOSTER = False
+BOOSTER_NUM_THREADS = 0
+
+# score with the trees of the registered classifier flattened into numpy
+# arrays, memory-mapped from the model cache and shared by the workers. Needs
+# USE_MODEL_CACHE; slower than the booster, but a worker only needs numpy
+USE_FLAT_TREES = False
+
+# score only the leads that aren't in 'predictions' yet and append their
+# predictions. The leads of 'model_input' from LATE_LEAD_DAYS days before the
+# latest WATERMARK_COLUMN in 'predictions' on are read, and the ones whose
+# LEAD_KEY_COLUMN, a hash of their 'model_input' row, is in 'predictions' are
+# skipped: leads sharing the watermark or arriving up to LATE_LEAD_DAYS late
+# are still scored, once. 'created_date' compares chronologically as text
+INCREMENTAL_INFERENCE = False
+WATERMARK_COLUMN = 'created_date'
+LEAD_KEY_COLUMN = 'lead_key'
+LATE_LEAD_DAYS = 7
+
+# score every distinct feature row once and copy its prediction to the
+# leads sharing it
+DEDUPLICATE_FEATURE_ROWS = False
+# keep the predictions of the distinct feature rows scored by the version in
+# the stage in SCORE_CACHE_FILE_NAME, in DB_PATH, across runs. At most
+# SCORE_CACHE_SIZE predictions are kept, the least recently used are evicted
+USE_SCORE_CACHE = False
+SCORE_CACHE_FILE_NAME = "score_cache.db"
+SCORE_CACHE_SIZE = 1000000
+
 # list of the features that needs to be there in the final encoded dataframe
 ONE_HOT_ENCODED_FEATURES = ['total_leads_droppped', 'referred_lead', 'city_tier_1.0',
        'city_tier_2.0', 'city_tier_3.0', 'first_platform_c_Level0',
@@ -34,4 +82,26 @@ ONE_HOT_ENCODED_FEATURES = ['total_leads_droppped', 'referred_lead', 'city_tier_
        'first_utm_source_c_Level7', 'first_utm_source_c_others']
 
 # list of features that need to be one-hot encoded
-FEATURES_TO_ENCODE = ['city_tier','first_platform_c','first_utm_medium_c','first_utm_source_c']
\ No newline at end of file
+FEATURES_TO_ENCODE = ['city_tier','first_platform_c','first_utm_medium_c','first_utm_source_c']
+
+# levels of the features that need to be one-hot encoded, in the order of their
+# one-hot encoded columns. The features are cast to categoricals over these levels
+FEATURE_LEVELS = {'city_tier': [1.0, 2.0, 3.0],
+                  'first_platform_c': ['Level0', 'Level1', 'Level2', 'Level3', 'Level7', 'Level8', 'others'],
+                  'first_utm_medium_c': ['Level0', 'Level10', 'Level11', 'Level13', 'Level15', 'Level16', 'Level2',
+                                         'Level20', 'Level26', 'Level3', 'Level30', 'Level33', 'Level4', 'Level43',
+                                         'Level5', 'Level6', 'Level8', 'Level9', 'others'],
+                  'first_utm_source_c': ['Level0', 'Level14', 'Level16', 'Level2', 'Level4', 'Level5', 'Level6',
+                                         'Level7', 'others']}
+
+# scoring service, see scoring_service.py. It listens on SCORING_SERVICE_SOCKET
+# if set (a unix socket path) and on SCORING_SERVICE_HOST:SCORING_SERVICE_PORT otherwise
+SCORING_SERVICE_HOST = "127.0.0.1"
+SCORING_SERVICE_PORT = 8765
+SCORING_SERVICE_SOCKET = None
+# a micro-batch is scored once it holds SCORING_MAX_BATCH_SIZE leads or
+# SCORING_MAX_WAIT_MS after its first request, whichever comes first
+SCORING_MAX_BATCH_SIZE = 256
+SCORING_MAX_WAIT_MS = 5
+# number of most recent requests the p50/p99 latencies are computed on
+SCORING_LATENCY_WINDOW = 10000
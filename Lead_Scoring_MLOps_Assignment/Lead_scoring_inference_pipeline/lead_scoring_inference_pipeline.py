@@ -33,7 +33,9 @@ def module_from_file(module_name, file_path):
     spec.loader.exec_module(module)
     return module
 
-utils = module_from_file("utils", "/home/airflow/dags/Lead_scoring_inference_pipeline/utils.py")
+lazy_module = module_from_file("lazy_module", "/home/airflow/dags/Lead_scoring_data_pipeline/lazy_module.py")
+
+utils = lazy_module.lazy_module_from_file("utils", "/home/airflow/dags/Lead_scoring_inference_pipeline/utils.py")
 constants= module_from_file("constants", "/home/airflow/dags/Lead_scoring_inference_pipeline/constants.py")
 
 ###############################################################################
@@ -0,0 +1,206 @@
+'''
+filename: model_cache.py
+functions: ModelCache, valid_checksum, publish_directory, directory_checksum
+version: 1
+'''
+
+###############################################################################
+# Import necessary modules
+# ##############################################################################
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import uuid
+from collections import OrderedDict
+
+import mlflow
+from mlflow import MlflowClient
+
+from Lead_scoring_inference_pipeline.native_model import NativeLightGBMModel
+from Lead_scoring_training_pipeline.flat_trees import FlatTreeEnsemble, export_flat_trees
+
+
+###############################################################################
+# Define the model cache used by the inference pipeline
+# ##############################################################################
+
+class ModelCache:
+    '''
+    Cache of the models loaded from the mlflow model registry, so that a
+    model is only downloaded and unpickled again when the registry serves a
+    new version of it.
+
+    Every load first asks the registry which version is in the requested
+    stage, which is a single metadata call. The artifacts of every version
+    are downloaded once into cache_directory/<model name>/<version>, next to
+    a manifest holding the sha256 checksum of the artifacts; a cached copy
+    whose checksum no longer matches is downloaded again. On top of that the
+    last max_models loaded models are kept in memory, keyed by model name,
+    version and flavor, for long lived workers that score many times; the
+    checksum is only verified when a model is loaded from the disk. A
+    version is published in the cache with a single rename, which fails
+    rather than replace a copy another worker published first, so workers
+    sharing cache_directory never remove a copy one of them is loading.
+    The 'lightgbm' flavor loads the booster of the model as a
+    NativeLightGBMModel scoring with num_threads threads. The 'flat' flavor
+    loads it as a FlatTreeEnsemble, exported once per version into
+    cache_directory/<model name>/<version>/flat_trees and memory-mapped, so
+    that all the workers using the cache share one copy of the trees.
+
+    SAMPLE USAGE
+        model_cache = ModelCache(MODEL_CACHE_DIRECTORY, MODEL_CACHE_SIZE)
+        model = model_cache.load_model(MODEL_NAME, STAGE)
+    '''
+
+    def __init__(self, cache_directory, max_models, num_threads=0):
+        self.cache_directory = cache_directory
+        self.max_models = max_models
+        self.num_threads = num_threads
+        self.models = OrderedDict()
+
+    def load_model(self, model_name, stage, flavor="pyfunc"):
+        '''
+        Returns the pyfunc model of the version of model_name in stage, its
+        NativeLightGBMModel for the 'lightgbm' flavor or its FlatTreeEnsemble
+        for the 'flat' flavor.
+        '''
+        return self.load_version(model_name, self.latest_version(model_name, stage), flavor)
+
+    def load_version(self, model_name, version, flavor="pyfunc"):
+        '''
+        Returns the pyfunc model of the given version of model_name, its
+        NativeLightGBMModel for the 'lightgbm' flavor or its FlatTreeEnsemble
+        for the 'flat' flavor.
+        '''
+        key = (model_name, str(version), flavor)
+        if key in self.models:
+            self.models.move_to_end(key)
+            print(f"Using model '{model_name}' version {version} from memory")
+            return self.models[key]
+
+        model_directory, checksum = self.cached_artifacts(model_name, version)
+        if flavor == "lightgbm":
+            model = NativeLightGBMModel.from_model_uri(model_directory, self.num_threads)
+        elif flavor == "flat":
+            model = FlatTreeEnsemble.load(self.flat_trees(model_directory, model_name, version))
+        else:
+            model = mlflow.pyfunc.load_model(model_directory)
+        self.models[key] = model
+        if len(self.models) > self.max_models:
+            self.models.popitem(last=False)
+        return model
+
+    def latest_version(self, model_name, stage):
+        versions = MlflowClient().get_latest_versions(model_name, stages=[stage])
+        if not versions:
+            raise LookupError(f"No version of model '{model_name}' in stage '{stage}'")
+        return versions[0].version
+
+    def flat_trees(self, model_directory, model_name, version):
+        '''
+        Returns the directory of the flat trees of the cached model version,
+        exporting them from its booster first unless they are there.
+        '''
+        flat_trees_directory = os.path.join(os.path.dirname(model_directory), "flat_trees")
+        if not os.path.exists(os.path.join(flat_trees_directory, "manifest.json")):
+            native_model = NativeLightGBMModel.from_model_uri(model_directory)
+            export_directory = f"{flat_trees_directory}.{uuid.uuid4().hex}"
+            export_flat_trees(native_model.booster, export_directory, native_model.classes)
+            publish_directory(export_directory, flat_trees_directory)
+            print(f"Exported the trees of model '{model_name}' version {version} to the cache")
+        return flat_trees_directory
+
+    def cached_artifacts(self, model_name, version):
+        '''
+        Returns the local directory of the artifacts of the model version and
+        their checksum, downloading them first unless a valid copy is cached.
+        '''
+        version_directory = os.path.join(self.cache_directory, model_name, str(version))
+        model_directory = os.path.join(version_directory, "model")
+        manifest_path = os.path.join(version_directory, "manifest.json")
+
+        checksum = valid_checksum(version_directory)
+        if checksum is not None:
+            print(f"Using cached model '{model_name}' version {version}")
+            return model_directory, checksum
+        if os.path.exists(version_directory):
+            print(f"Cached model '{model_name}' version {version} is corrupted, downloading it again")
+            # moved aside in one rename first, so the new copy can take its place
+            stale_directory = f"{version_directory}.stale.{uuid.uuid4().hex}"
+            try:
+                os.rename(version_directory, stale_directory)
+            except FileNotFoundError:
+                pass
+            shutil.rmtree(stale_directory, ignore_errors=True)
+
+        # download next to the cache and move it in place in one rename, so
+        # that a concurrent or interrupted run never sees a partial copy
+        os.makedirs(os.path.dirname(version_directory), exist_ok=True)
+        download_directory = tempfile.mkdtemp(dir=os.path.dirname(version_directory))
+        try:
+            mlflow.artifacts.download_artifacts(artifact_uri=f"models:/{model_name}/{version}",
+                                                dst_path=os.path.join(download_directory, "model"))
+            checksum = directory_checksum(os.path.join(download_directory, "model"))
+            with open(os.path.join(download_directory, "manifest.json"), "w") as file:
+                json.dump({"model_name": model_name, "version": str(version), "checksum": checksum}, file)
+            if not publish_directory(download_directory, version_directory):
+                # another worker published the version first, its copy is used
+                checksum = valid_checksum(version_directory)
+                if checksum is None:
+                    raise RuntimeError(f"Cached model '{model_name}' version {version} is corrupted")
+        finally:
+            shutil.rmtree(download_directory, ignore_errors=True)
+        print(f"Downloaded model '{model_name}' version {version} to the cache")
+        return model_directory, checksum
+
+
+def valid_checksum(version_directory):
+    '''
+    Returns the checksum of the cached model version in version_directory if
+    it matches the one of its manifest, None if it doesn't or isn't cached.
+    '''
+    try:
+        with open(os.path.join(version_directory, "manifest.json")) as file:
+            checksum = json.load(file)["checksum"]
+    except FileNotFoundError:
+        return None
+    if directory_checksum(os.path.join(version_directory, "model")) != checksum:
+        return None
+    return checksum
+
+
+def publish_directory(directory, target_directory):
+    '''
+    Renames directory to target_directory unless that exists already, in
+    which case directory is removed. Returns whether it was published. The
+    rename fails on a target another process published, it never replaces it.
+    '''
+    try:
+        if not os.path.exists(target_directory):
+            os.rename(directory, target_directory)
+            return True
+    except OSError:
+        if not os.path.exists(target_directory):
+            raise
+    shutil.rmtree(directory, ignore_errors=True)
+    return False
+
+
+def directory_checksum(directory):
+    '''
+    sha256 over the relative paths and the contents of all the files in
+    directory, in sorted order.
+    '''
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            digest.update(os.path.relpath(path, directory).encode())
+            with open(path, "rb") as file:
+                for block in iter(lambda: file.read(1 << 20), b""):
+                    digest.update(block)
+    return digest.hexdigest()
@@ -0,0 +1,104 @@
+'''
+filename: native_model.py
+functions: NativeLightGBMModel, ClassifierProbabilityModel, predicted_labels
+version: 1
+'''
+
+###############################################################################
+# Import necessary modules
+# ##############################################################################
+
+import mlflow.sklearn
+import numpy as np
+import pandas as pd
+
+
+###############################################################################
+# Define the native LightGBM model used by the inference pipeline
+# ##############################################################################
+
+class NativeLightGBMModel:
+    '''
+    The LightGBM booster of the LGBMClassifier registered by the training
+    pipeline, scoring numpy arrays directly. This skips the pyfunc wrapper
+    and the sklearn classifier, which convert the features to a DataFrame
+    and back and check them on every call, and lets LightGBM use
+    num_threads threads (0 for its default, one per core).
+
+    predict gives the same labels as the registered model's predict:
+    class 1 when its probability is above that of class 0.
+
+    SAMPLE USAGE
+        model = NativeLightGBMModel.from_model_uri(f"models:/{MODEL_NAME}/{version}", BOOSTER_NUM_THREADS)
+        probabilities = model.predict_proba(df[ONE_HOT_ENCODED_FEATURES])
+    '''
+
+    def __init__(self, booster, classes, num_threads=0):
+        self.booster = booster
+        self.feature_names = booster.feature_name()
+        self.classes = np.asarray(classes)
+        self.num_threads = num_threads
+
+    @classmethod
+    def from_model_uri(cls, model_uri, num_threads=0):
+        '''
+        Loads the classifier logged with mlflow.sklearn at model_uri, a
+        'models:/' uri or a local directory, and keeps its booster.
+        '''
+        classifier = mlflow.sklearn.load_model(model_uri)
+        return cls(classifier.booster_, classifier.classes_, num_threads)
+
+    def predict_proba(self, features):
+        '''
+        Returns the probability of class 1 of every row of features, an
+        array with the columns in training order or a DataFrame, whose
+        columns are taken by name in training order.
+        '''
+        return self.booster.predict(to_array(features, self.feature_names), num_threads=self.num_threads)
+
+    def predict_raw(self, features):
+        '''
+        Returns the raw scores (log odds of class 1) of every row of features.
+        '''
+        return self.booster.predict(to_array(features, self.feature_names), raw_score=True, num_threads=self.num_threads)
+
+    def predict(self, features):
+        return predicted_labels(self.classes, self.predict_proba(features))
+
+
+class ClassifierProbabilityModel:
+    '''
+    Gives the sklearn classifier behind a pyfunc model the interface of
+    NativeLightGBMModel: predict_proba returns the probability of class 1
+    only, and classes the labels of the classes.
+
+    SAMPLE USAGE
+        model = ClassifierProbabilityModel(pyfunc_model.get_raw_model())
+        labels = predicted_labels(model.classes, model.predict_proba(features))
+    '''
+
+    def __init__(self, classifier):
+        self.classifier = classifier
+        self.classes = np.asarray(classifier.classes_)
+
+    def predict_proba(self, features):
+        return self.classifier.predict_proba(features)[:, 1]
+
+    def predict(self, features):
+        return self.classifier.predict(features)
+
+
+def predicted_labels(classes, probabilities):
+    # class 1 when its probability is above that of class 0, as the classifier predicts
+    probabilities = np.asarray(probabilities)
+    return classes[(probabilities > 1.0 - probabilities).astype(np.intp)]
+
+
+def to_array(features, feature_names):
+    # the columns of a DataFrame are taken by name, as FlatTreeEnsemble does
+    if isinstance(features, pd.DataFrame):
+        missing_features = [name for name in feature_names if name not in features.columns]
+        if missing_features:
+            raise ValueError(f"Features missing from the data: {missing_features}")
+        return features[feature_names].to_numpy(dtype=np.float64)
+    return np.asarray(features, dtype=np.float64)
@@ -0,0 +1,164 @@
+'''
+filename: score_cache.py
+functions: ScoreCache, row_fingerprints
+version: 1
+'''
+
+###############################################################################
+# Import necessary modules
+# ##############################################################################
+
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+
+###############################################################################
+# Define the score cache used by the inference pipeline
+# ##############################################################################
+
+class ScoreCache:
+    '''
+    Persistent cache of the probabilities of class 1 given by a registered
+    model version, keyed by the fingerprint of the feature row scored. The feature space of the
+    leads is small, so most of the rows of a run have been scored by an
+    earlier run already and only the new feature rows need the model.
+
+    The cache is a SQLite db at db_full_path holding at most max_entries
+    probabilities. Every run that uses an entry marks it with the run's clock,
+    and once the cache is full the entries used the longest time ago are
+    evicted. The version the entries were scored by is kept in a metadata
+    row, and the cache is only emptied when a lookup or store comes with
+    another version, so moving the stage to a new version invalidates the
+    cache while the lookups of the same version don't touch the old rows.
+
+    SAMPLE USAGE
+        score_cache = ScoreCache(os.path.join(DB_PATH, SCORE_CACHE_FILE_NAME), SCORE_CACHE_SIZE)
+        probabilities, stats = score_cache.predict_proba(model, "LightGBM/3", features)
+    '''
+
+    def __init__(self, db_full_path, max_entries):
+        self.db_full_path = db_full_path
+        self.max_entries = max_entries
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_full_path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("""CREATE TABLE IF NOT EXISTS scores (
+                            model_version TEXT NOT NULL,
+                            fingerprint INTEGER NOT NULL,
+                            probability REAL,
+                            last_used INTEGER NOT NULL,
+                            PRIMARY KEY (model_version, fingerprint))""")
+        conn.execute("CREATE INDEX IF NOT EXISTS scores_last_used ON scores (last_used)")
+        conn.execute("CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT)")
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS wanted (fingerprint INTEGER PRIMARY KEY)")
+        return conn
+
+    def predict_proba(self, model, model_version, features):
+        '''
+        Returns the probability of class 1 of every row of features, given
+        by model.predict_proba for only the distinct rows that aren't in the
+        cache yet and stored, and the hit rates: the share of the distinct
+        rows and the share of all the rows whose probability was cached.
+        '''
+        codes, fingerprints = pd.factorize(row_fingerprints(features))
+        _, first_rows = np.unique(codes, return_index=True)
+
+        probabilities = self.lookup(model_version, fingerprints)
+        missing = np.flatnonzero(np.isnan(probabilities))
+        if len(missing):
+            probabilities[missing] = model.predict_proba(features.iloc[first_rows[missing]])
+            self.store(model_version, fingerprints[missing], probabilities[missing])
+        hits = np.ones(len(fingerprints), dtype=bool)
+        hits[missing] = False
+        stats = {"rows": len(codes), "unique_rows": len(fingerprints), "scored_rows": len(missing),
+                 "unique_hit_rate": hits.mean(), "row_hit_rate": hits[codes].mean()}
+        return probabilities[codes], stats
+
+    def lookup(self, model_version, fingerprints):
+        '''
+        Returns the cached probabilities of model_version for the fingerprints,
+        NaN for the ones not in the cache, and marks them as used.
+        '''
+        conn = self.connect()
+        try:
+            conn.execute("BEGIN")
+            self.use_version(conn, model_version)
+            conn.execute("DELETE FROM wanted")
+            conn.executemany("INSERT INTO wanted VALUES (?)", ((fingerprint,) for fingerprint in fingerprints.tolist()))
+            clock = self.clock(conn)
+            conn.execute("UPDATE scores SET last_used = ? WHERE model_version = ? "
+                         "AND fingerprint IN (SELECT fingerprint FROM wanted)", (clock, model_version))
+            cached = conn.execute("SELECT fingerprint, probability FROM scores WHERE model_version = ? "
+                                  "AND fingerprint IN (SELECT fingerprint FROM wanted)", (model_version,)).fetchall()
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        probabilities = np.full(len(fingerprints), np.nan)
+        if cached:
+            cached_fingerprints, cached_probabilities = zip(*cached)
+            positions = pd.Index(fingerprints).get_indexer(cached_fingerprints)
+            probabilities[positions] = np.array(cached_probabilities, dtype=float)
+        return probabilities
+
+    def store(self, model_version, fingerprints, probabilities):
+        '''
+        Stores the probabilities of model_version for the fingerprints and
+        evicts the least recently used entries beyond max_entries.
+        '''
+        conn = self.connect()
+        try:
+            conn.execute("BEGIN")
+            self.use_version(conn, model_version)
+            clock = self.clock(conn)
+            conn.executemany("INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?)",
+                             zip([model_version] * len(fingerprints), fingerprints.tolist(),
+                                 np.asarray(probabilities, dtype=float).tolist(), [clock] * len(fingerprints)))
+            excess = conn.execute("SELECT COUNT(*) FROM scores").fetchone()[0] - self.max_entries
+            if excess > 0:
+                conn.execute("DELETE FROM scores WHERE rowid IN "
+                             "(SELECT rowid FROM scores ORDER BY last_used LIMIT ?)", (excess,))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def use_version(self, conn, model_version):
+        '''
+        Empties the cache when model_version isn't the version its entries
+        were scored by, and records it as the cached version.
+        '''
+        cached_version = conn.execute("SELECT value FROM metadata WHERE key = 'model_version'").fetchone()
+        if cached_version is None or cached_version[0] != model_version:
+            # another version is in the stage now
+            conn.execute("DELETE FROM scores")
+            conn.execute("INSERT OR REPLACE INTO metadata VALUES ('model_version', ?)", (model_version,))
+
+    def clock(self, conn):
+        # ticks with every lookup and store
+        return conn.execute("SELECT COALESCE(MAX(last_used), 0) FROM scores").fetchone()[0] + 1
+
+    def size(self):
+        conn = self.connect()
+        try:
+            return conn.execute("SELECT COUNT(*) FROM scores").fetchone()[0]
+        finally:
+            conn.close()
+
+
+def row_fingerprints(features):
+    '''
+    64 bit hash of every row of features, as signed integers SQLite can
+    store. The hash depends on the dtypes of the columns, a change of dtype
+    only costs cache misses.
+    '''
+    return pd.util.hash_pandas_object(features, index=False).to_numpy().view(np.int64)
@@ -0,0 +1,295 @@
+'''
+filename: scoring_service.py
+functions: MicroBatcher, encode_request, score_encoded_leads, make_server, main
+version: 1
+
+Long lived scoring service. It loads the production model once, listens on
+a local TCP port or Unix socket and scores the leads posted to it. Requests
+arriving together are coalesced into micro-batches of at most
+SCORING_MAX_BATCH_SIZE leads, waiting at most SCORING_MAX_WAIT_MS for a
+batch to fill, so that the model predicts on many leads at once.
+
+    POST /score   body: a lead or a list of leads as json objects with the
+                  raw lead fields ('city_mapped', 'first_platform_c', ...)
+                  returns {"predictions": [...]}
+    GET  /stats   returns the request and batch counts and the p50/p99
+                  latency in milliseconds
+    GET  /health  returns {"status": "ok"}
+
+SAMPLE USAGE
+    python -m Lead_scoring_inference_pipeline.scoring_service
+    curl -d '{"city_mapped": "mumbai", "first_platform_c": "Level0", ...}' http://127.0.0.1:8765/score
+'''
+
+###############################################################################
+# Import necessary modules
+# ##############################################################################
+
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import mlflow
+import numpy as np
+import pandas as pd
+
+from Lead_scoring_inference_pipeline import utils
+from Lead_scoring_inference_pipeline.constants import *
+
+
+###############################################################################
+# Define the micro-batcher
+# ##############################################################################
+
+class InvalidLeads(ValueError):
+    '''
+    Raised by MicroBatcher.score for leads its prepare function rejects.
+    '''
+
+
+class MicroBatcher:
+    '''
+    Coalesces the leads of concurrent requests into batches scored with a
+    single call to score_batch, a function from a list of leads to the list
+    of their predictions. A batch is scored as soon as it holds
+    max_batch_size leads or max_wait_ms after its first request arrived,
+    whichever comes first; a single request larger than max_batch_size is
+    scored on its own. The latency of the last latency_window requests is
+    kept for the stats.
+
+    prepare, if given, is run on the leads of every request in the thread
+    of the request, before it is queued, e.g. to encode them; score_batch
+    then gets the prepared leads. A request that prepare rejects fails with
+    InvalidLeads on its own, instead of failing the batch it would have
+    been merged into. An error of score_batch fails the requests of its
+    batch only, the next batches are scored as usual.
+
+    SAMPLE USAGE
+        batcher = MicroBatcher(score_batch, 256, 5, 10000)
+        predictions = batcher.score([lead])
+    '''
+
+    def __init__(self, score_batch, max_batch_size, max_wait_ms, latency_window, prepare=None):
+        self.score_batch = score_batch
+        self.prepare = prepare
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=latency_window)
+        self.request_count = 0
+        self.batch_count = 0
+        self.lead_count = 0
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def score(self, leads):
+        '''
+        Scores the leads with the next batch, blocking until it is done.
+        Raises InvalidLeads if they can't be prepared.
+        '''
+        start = time.perf_counter()
+        try:
+            leads = self.prepare(leads) if self.prepare else leads
+            leads = list(leads)
+        except Exception as e:
+            raise InvalidLeads(str(e)) from e
+        request = {"leads": leads, "done": threading.Event()}
+        self.requests.put(request)
+        request["done"].wait()
+        with self.lock:
+            self.latencies.append(time.perf_counter() - start)
+            self.request_count += 1
+        if "error" in request:
+            raise request["error"]
+        return request["predictions"]
+
+    def run(self):
+        carried = None
+        while True:
+            batch = [carried or self.requests.get()]
+            carried = None
+            try:
+                size = len(batch[0]["leads"])
+                deadline = time.perf_counter() + self.max_wait
+                while size < self.max_batch_size:
+                    try:
+                        request = self.requests.get(timeout=max(deadline - time.perf_counter(), 0))
+                    except queue.Empty:
+                        break
+                    if size + len(request["leads"]) > self.max_batch_size:
+                        # starts the next batch instead
+                        carried = request
+                        break
+                    batch.append(request)
+                    size += len(request["leads"])
+                self.score_requests(batch)
+            except Exception as e:
+                # the thread must survive, or every later request waits forever
+                self.fail_requests(batch, e)
+
+    def score_requests(self, batch):
+        leads = [lead for request in batch for lead in request["leads"]]
+        try:
+            predictions = list(self.score_batch(leads))
+        except Exception as e:
+            self.fail_requests(batch, e)
+            return
+        with self.lock:
+            self.batch_count += 1
+            self.lead_count += len(leads)
+        start = 0
+        for request in batch:
+            request["predictions"] = predictions[start:start + len(request["leads"])]
+            start += len(request["leads"])
+            request["done"].set()
+
+    def fail_requests(self, batch, error):
+        for request in batch:
+            if not request["done"].is_set():
+                request["error"] = error
+                request["done"].set()
+
+    def stats(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            stats = {"requests": self.request_count, "batches": self.batch_count,
+                     "mean_batch_size": self.lead_count / self.batch_count if self.batch_count else 0.0}
+        if len(latencies):
+            stats["p50_ms"], stats["p99_ms"] = np.percentile(latencies, [50, 99]).tolist()
+        return stats
+
+
+###############################################################################
+# Define the function to encode the raw leads
+# ##############################################################################
+
+def encode_request(leads):
+    '''
+    Checks that the leads of a request are json objects and encodes them
+    with the pandas free row_encoder, which gives the same features as the
+    cleaning steps of the data pipeline and encode_features at a fraction
+    of their cost on small batches. Returns their feature matrix, one row
+    per lead.
+    '''
+    for lead in leads:
+        if not isinstance(lead, dict):
+            raise ValueError(f"a lead must be a json object, not {json.dumps(lead)}")
+    return utils.row_encoder.encode_batch(leads)
+
+
+def score_encoded_leads(model, rows):
+    '''
+    Scores the feature rows of leads encoded by encode_request.
+    '''
+    columns = utils.row_encoder.columns
+    features = pd.DataFrame(np.array(rows, dtype=float).reshape(len(rows), len(columns)), columns=columns)
+    return model.predict(features).tolist()
+
+
+###############################################################################
+# Define the http server
+# ##############################################################################
+
+class ScoringRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.send_json(200, {"status": "ok"})
+        elif self.path == "/stats":
+            self.send_json(200, self.server.batcher.stats())
+        else:
+            self.send_json(404, {"error": f"unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/score":
+            self.send_json(404, {"error": f"unknown path {self.path}"})
+            return
+        try:
+            leads = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        except ValueError as e:
+            self.send_json(400, {"error": f"invalid json: {e}"})
+            return
+        if isinstance(leads, dict):
+            leads = [leads]
+        if not isinstance(leads, list) or not all(isinstance(lead, dict) for lead in leads):
+            self.send_json(400, {"error": "the body must be a lead or a list of leads, as json objects"})
+            return
+        try:
+            predictions = self.server.batcher.score(leads)
+        except InvalidLeads as e:
+            self.send_json(400, {"error": f"invalid leads: {e}"})
+            return
+        except Exception as e:
+            self.send_json(500, {"error": str(e)})
+            return
+        self.send_json(200, {"predictions": predictions})
+
+    def send_json(self, status, body):
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # the client address of a unix socket is an empty string
+        return str(self.client_address[0]) if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ScoringHTTPServer(ThreadingHTTPServer):
+    # bursts of concurrent clients are what the micro-batching is for
+    request_queue_size = 1024
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def make_server(batcher, host=SCORING_SERVICE_HOST, port=SCORING_SERVICE_PORT, socket_path=SCORING_SERVICE_SOCKET):
+    '''
+    Returns the http server scoring with batcher, listening on socket_path
+    if it is set and on host:port otherwise.
+    '''
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, ScoringRequestHandler)
+    else:
+        server = ScoringHTTPServer((host, port), ScoringRequestHandler)
+    server.batcher = batcher
+    return server
+
+
+def main():
+    '''
+    Loads the production model and serves it until interrupted.
+    '''
+    mlflow.set_tracking_uri(TRACKING_URI)
+    model, version = utils.load_production_model()
+    print(f"Loaded model '{MODEL_NAME}' version {version} from MLflow stage: {STAGE}")
+
+    batcher = MicroBatcher(lambda rows: score_encoded_leads(model, rows), SCORING_MAX_BATCH_SIZE, SCORING_MAX_WAIT_MS,
+                           SCORING_LATENCY_WINDOW, prepare=encode_request)
+    server = make_server(batcher)
+    print(f"Scoring service listening on {SCORING_SERVICE_SOCKET or f'{SCORING_SERVICE_HOST}:{SCORING_SERVICE_PORT}'}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print("Scoring service stopped, latency stats:", batcher.stats())
+
+
+if __name__ == "__main__":
+    main()
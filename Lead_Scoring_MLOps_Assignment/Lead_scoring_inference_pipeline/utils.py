@@ -11,14 +11,29 @@ version: 1
 
 import mlflow
 import mlflow.sklearn
+import numpy as np
 import pandas as pd
 
-import sqlite3
-
 import os
 
 from datetime import datetime
 from Lead_scoring_inference_pipeline.constants import *
+from Lead_scoring_data_pipeline.storage import SQLiteStorage, get_storage
+from Lead_scoring_inference_pipeline.model_cache import ModelCache
+from Lead_scoring_inference_pipeline.native_model import NativeLightGBMModel, ClassifierProbabilityModel, predicted_labels
+from Lead_scoring_inference_pipeline.score_cache import ScoreCache, row_fingerprints
+from Lead_scoring_training_pipeline.feature_encoder import OneHotEncoder, RowEncoder
+from Lead_scoring_data_pipeline.mapping.city_tier_mapping import city_tier_mapping
+from Lead_scoring_data_pipeline.mapping.significant_categorical_level import significant_levels
+
+# one hot encoder over the fixed vocabulary of constants.py, built once
+encoder = OneHotEncoder(ONE_HOT_ENCODED_FEATURES, FEATURES_TO_ENCODE, FEATURE_LEVELS)
+# same encoding straight from raw leads given as dicts, for scoring single leads
+row_encoder = RowEncoder(ONE_HOT_ENCODED_FEATURES, FEATURES_TO_ENCODE, FEATURE_LEVELS,
+                         city_tier_mapping, significant_levels)
+
+# models loaded from the registry, cached on disk and in memory
+model_cache = ModelCache(MODEL_CACHE_DIRECTORY, MODEL_CACHE_SIZE, BOOSTER_NUM_THREADS)
 
 ###############################################################################
 # Define the function to train the model
@@ -41,34 +56,36 @@ def encode_features():
     OUTPUT
         1. Save the encoded features in a table - features
 
+        If INCREMENTAL_INFERENCE is set only the leads that aren't in
+        'predictions' yet are encoded: the leads from LATE_LEAD_DAYS days
+        before the watermark, the latest WATERMARK_COLUMN in 'predictions',
+        on, less the ones whose key, see lead_keys(), is in 'predictions'.
+        WATERMARK_COLUMN and LEAD_KEY_COLUMN are kept in 'features_inference'.
+        A 'predictions' table without LEAD_KEY_COLUMN is scored again whole.
+
     SAMPLE USAGE
         encode_features()
     '''
-    conn = connect_to_db()
-    if conn:
-        model_input_data = pd.read_sql("select * from model_input",conn)
-        df_encoded = pd.DataFrame(columns=ONE_HOT_ENCODED_FEATURES)
-        df_placeholder= pd.DataFrame()
-        for feature in FEATURES_TO_ENCODE:
-            if feature in model_input_data.columns:
-                encode = pd.get_dummies(model_input_data[feature])
-                encode = encode.add_prefix(feature+'_')
-                df_placeholder = pd.concat([df_placeholder,encode],axis=1)
-            else:
-                print("feature not found", feature)
-        
-        for feature in ONE_HOT_ENCODED_FEATURES:
-            if feature in df_placeholder.columns:
-                df_encoded[feature]= df_placeholder[feature]
-            if feature in model_input_data.columns:
-                df_encoded[feature]=model_input_data[feature]
-                
-        df_encoded=df_encoded.fillna(0)
-        df_encoded.to_sql('features_inference',con=conn,index=False,if_exists='replace')
-        conn.close()
-        print("Features Encoding done")
+    storage = connect_to_storage()
+    watermark = None
+    if INCREMENTAL_INFERENCE and LEAD_KEY_COLUMN in storage.table_columns("predictions"):
+        watermark = storage.column_max("predictions", WATERMARK_COLUMN)
+    if watermark is None:
+        model_input_data = storage.read_table("model_input", read_only=True)
     else:
-        print("Error getting connection from the database")
+        first_day = (pd.Timestamp(watermark[:10]) - pd.Timedelta(days=LATE_LEAD_DAYS)).strftime("%Y-%m-%d")
+        model_input_data = storage.read_days("model_input", WATERMARK_COLUMN, first_day, None)
+        scored = storage.read_days("predictions", WATERMARK_COLUMN, first_day, None, columns=[LEAD_KEY_COLUMN])
+        new_leads = ~np.isin(lead_keys(model_input_data), scored[LEAD_KEY_COLUMN].to_numpy(dtype=np.int64))
+        print(f"Encoding the {new_leads.sum()} leads from {first_day} on that aren't scored yet, "
+              f"{len(model_input_data) - new_leads.sum()} are, watermark {watermark}")
+        model_input_data = model_input_data[new_leads]
+    df_encoded = encoder.transform(model_input_data)
+    if INCREMENTAL_INFERENCE and WATERMARK_COLUMN in model_input_data.columns:
+        df_encoded[WATERMARK_COLUMN] = model_input_data[WATERMARK_COLUMN]
+        df_encoded[LEAD_KEY_COLUMN] = lead_keys(model_input_data)
+    storage.write_table(df_encoded,'features_inference')
+    print("Features Encoding done")
 
 ###############################################################################
 # Define the function to load the model from mlflow model registry
@@ -91,36 +108,133 @@ def get_models_prediction():
     OUTPUT
         Store the predicted values along with input data into a table
 
+        If USE_MODEL_CACHE is set the model is only downloaded when a new
+        version is in the stage, see model_cache.py.
+
+        If USE_NATIVE_BOOSTER is set the model's LightGBM booster scores the
+        features directly, see load_production_model().
+
+        If INCREMENTAL_INFERENCE is set the predictions of the new leads
+        encoded by encode_features are appended to the table instead, which
+        also advances the watermark in the same transaction.
+
+        If DEDUPLICATE_FEATURE_ROWS is set the model only scores the
+        distinct feature rows, see predict_unique_rows(), and the dedup
+        ratio is printed.
+
+        If USE_SCORE_CACHE is set the probabilities of the distinct feature
+        rows already scored by the version in the stage are taken from the
+        score cache instead, see score_cache.py, the labels predicted from
+        them and the hit rates printed.
+
     SAMPLE USAGE
         load_model()
     '''
     try:
+        # Load input data from the storage
+        storage = connect_to_storage()
+        df = storage.read_table("features_inference", read_only=True)
+        print("Loaded features inference data from database.")
+        if df.empty:
+            print("No new leads to score.")
+            return
+
         mlflow.set_tracking_uri(TRACKING_URI)
         # Load the model from MLflow Model Registry
-        model_uri = f"models:/{MODEL_NAME}/{STAGE}"
-        model = mlflow.pyfunc.load_model(model_uri)
-        print(f"Successfully loaded model '{MODEL_NAME}' from MLflow stage: {STAGE}")
-        
-        # Load input data from SQLite database
-        conn = connect_to_db()
-        if conn:
-            query = "SELECT * FROM features_inference"
-            df = pd.read_sql(query, conn)
-            print("Loaded features inference data from database.")
-            
-            # Make predictions
-            df["predictions"] = model.predict(df)
-            
-            # Store predictions in the database
-            df.to_sql("predictions", conn, if_exists="replace", index=False)
-            print("Predictions stored successfully in database.")
-            
-            conn.close()
+        model, version = load_production_model()
+        print(f"Successfully loaded model '{MODEL_NAME}' version {version} from MLflow stage: {STAGE}")
+
+        # Make predictions
+        if USE_SCORE_CACHE:
+            score_cache = ScoreCache(os.path.join(DB_PATH, SCORE_CACHE_FILE_NAME), SCORE_CACHE_SIZE)
+            model = probability_model(model)
+            probabilities, stats = score_cache.predict_proba(model, f"{MODEL_NAME}/{version}",
+                                                             df[ONE_HOT_ENCODED_FEATURES])
+            df["predictions"] = predicted_labels(model.classes, probabilities)
+            print(f"Score cache hit rate: {stats['unique_hit_rate']:.1%} of {stats['unique_rows']} distinct "
+                  f"feature rows, {stats['row_hit_rate']:.1%} of {stats['rows']} leads; "
+                  f"scored {stats['scored_rows']} feature rows")
+        elif DEDUPLICATE_FEATURE_ROWS:
+            df["predictions"], unique_rows = predict_unique_rows(model, df[ONE_HOT_ENCODED_FEATURES])
+            print(f"Scored {unique_rows} distinct feature rows for {len(df)} leads, "
+                  f"dedup ratio: {len(df) / unique_rows:.1f}")
         else:
-            print("Error getting connection from the database")
+            df["predictions"] = model.predict(df[ONE_HOT_ENCODED_FEATURES])
+
+        # Store predictions in the storage
+        if INCREMENTAL_INFERENCE and LEAD_KEY_COLUMN in df.columns \
+                and LEAD_KEY_COLUMN in storage.table_columns("predictions"):
+            storage.append_table(df, "predictions")
+        else:
+            storage.write_table(df, "predictions")
+        print("Predictions stored successfully in database.")
     except Exception as e:
         print(f"Error occurred: {str(e)}")
 
+def load_production_model():
+    '''
+    Loads the version of MODEL_NAME in STAGE and returns it with its version
+    number. With USE_NATIVE_BOOSTER set this is a NativeLightGBMModel
+    scoring with the booster of the registered classifier on
+    BOOSTER_NUM_THREADS threads, and the pyfunc model if the booster can't
+    be loaded (a model that isn't a LightGBM classifier); otherwise the
+    pyfunc model. With USE_FLAT_TREES and USE_MODEL_CACHE set it is the
+    FlatTreeEnsemble of the classifier, memory-mapped from the cache, with
+    the same fallbacks.
+
+    SAMPLE USAGE
+        model, version = load_production_model()
+    '''
+    version = model_cache.latest_version(MODEL_NAME, STAGE)
+    model_uri = f"models:/{MODEL_NAME}/{version}"
+    if USE_FLAT_TREES and USE_MODEL_CACHE:
+        try:
+            return model_cache.load_version(MODEL_NAME, version, "flat"), version
+        except Exception as e:
+            print(f"Unable to load the flat trees of '{MODEL_NAME}' version {version}: {e}")
+    if USE_NATIVE_BOOSTER:
+        try:
+            if USE_MODEL_CACHE:
+                return model_cache.load_version(MODEL_NAME, version, "lightgbm"), version
+            return NativeLightGBMModel.from_model_uri(model_uri, BOOSTER_NUM_THREADS), version
+        except Exception as e:
+            print(f"Unable to load the LightGBM booster of '{MODEL_NAME}' version {version}, using pyfunc: {e}")
+    if USE_MODEL_CACHE:
+        return model_cache.load_version(MODEL_NAME, version), version
+    return mlflow.pyfunc.load_model(model_uri), version
+
+
+def probability_model(model):
+    '''
+    Returns model if it gives the probability of class 1 itself, as
+    NativeLightGBMModel and FlatTreeEnsemble do, otherwise the classifier
+    behind the pyfunc model as a ClassifierProbabilityModel.
+    '''
+    if hasattr(model, "classes"):
+        return model
+    return ClassifierProbabilityModel(model.get_raw_model())
+
+
+def predict_unique_rows(model, features):
+    '''
+    Scores every distinct row of features once and broadcasts the
+    predictions back to all the rows. The leads only differ by two counts
+    and four low cardinality categoricals, so many of them share the same
+    feature row. Rows are matched by their 64 bit hash.
+
+    OUTPUT
+        the predictions of all the rows, in order, and the number of
+        distinct rows scored
+
+    SAMPLE USAGE
+        predictions, unique_rows = predict_unique_rows(model, df[ONE_HOT_ENCODED_FEATURES])
+    '''
+    codes, _ = pd.factorize(row_fingerprints(features))
+    # codes number the distinct rows in order of first appearance
+    _, first_rows = np.unique(codes, return_index=True)
+    predictions = np.asarray(model.predict(features.iloc[first_rows]))
+    return predictions[codes], len(first_rows)
+
 ###############################################################################
 # Define the function to check the distribution of output column
 # ##############################################################################
@@ -150,31 +264,25 @@ def prediction_ratio_check():
     output_file = os.path.expanduser("~/airflow/dags/Lead_scoring_inference_pipeline/prediction_distribution.txt")
     
     try:
-        # Connect to the database
-        conn = connect_to_db()
-        if conn:
-            query = "SELECT * FROM predictions;"  # Assuming the predictions table has 'prediction' column
-            df = pd.read_sql(query, conn)
-            conn.close()
-
-            # Calculate ratio
-            total = len(df)
-            if total == 0:
-                ratio_1 = ratio_0 = 0.0
-            else:
-                ratio_1 = (df['predictions'].sum() / total) * 100  # Assuming 1s represent positives
-                ratio_0 = 100 - ratio_1
-            
-            # Write results to file
-            with open(output_file, "a") as file:
-                file.write(f"Timestamp: {datetime.now()}\n")
-                file.write(f"Percentage of 1s: {ratio_1:.2f}%\n")
-                file.write(f"Percentage of 0s: {ratio_0:.2f}%\n")
-                file.write("-" * 40 + "\n")
-            
-            print("Prediction distribution written successfully.")
+        # Only the 'predictions' column of the predictions table is read
+        df = connect_to_storage().read_table("predictions", columns=["predictions"], read_only=True)
+
+        # Calculate ratio
+        total = len(df)
+        if total == 0:
+            ratio_1 = ratio_0 = 0.0
         else:
-            print("Error getting connection from the database")
+            ratio_1 = (df['predictions'].sum() / total) * 100  # Assuming 1s represent positives
+            ratio_0 = 100 - ratio_1
+
+        # Write results to file
+        with open(output_file, "a") as file:
+            file.write(f"Timestamp: {datetime.now()}\n")
+            file.write(f"Percentage of 1s: {ratio_1:.2f}%\n")
+            file.write(f"Percentage of 0s: {ratio_0:.2f}%\n")
+            file.write("-" * 40 + "\n")
+
+        print("Prediction distribution written successfully.")
     except Exception as e:
         print(f"Error: {e}")
 
@@ -204,21 +312,37 @@ def input_features_check():
     SAMPLE USAGE
         input_col_check()
     '''
-    conn = connect_to_db()
-    if conn:
-        df_new_data = pd.read_sql("select * from features_inference",conn)
-        if(set(df_new_data)==set(ONE_HOT_ENCODED_FEATURES)):
-            print("All the models input are present")
-        else:
-            print("Some of the models inputs are missing")
+    # only the column names are needed, the table itself isn't read
+    table_columns = set(connect_to_storage().table_columns("features_inference")) - {WATERMARK_COLUMN, LEAD_KEY_COLUMN}
+    if(table_columns==set(ONE_HOT_ENCODED_FEATURES)):
+        print("All the models input are present")
     else:
-        print("Error getting connection from the database")
+        print("Some of the models inputs are missing")
 
 def connect_to_db():
     try:
-        db_full_path = os.path.join(DB_PATH, DB_FILE_NAME)
-        conn = sqlite3.connect(db_full_path)
-        print("connecting to db from path: ", db_full_path)
-        return conn
+        # same tuned connection as the sqlite storage
+        return SQLiteStorage(os.path.join(DB_PATH, DB_FILE_NAME)).connect()
     except Exception as e:
-        print(e)
\ No newline at end of file
+        print(e)
+
+def lead_keys(model_input_data):
+    '''
+    Key of every lead of 'model_input', the 64 bit hash of its row as a
+    signed integer. The text columns are hashed as strings and the others
+    as floats, so that the key of a lead doesn't depend on the dtypes its
+    row is read with.
+    '''
+    text_columns = [column for column in model_input_data.columns if model_input_data[column].dtype.kind not in "biuf"]
+    df = model_input_data.astype({column: object if column in text_columns else float
+                                  for column in model_input_data.columns})
+    return pd.util.hash_pandas_object(df, index=False).to_numpy().view(np.int64)
+
+
+def connect_to_storage():
+    '''
+    Returns the storage of the pipeline's tables for the STORAGE_BACKEND set
+    in constants.py.
+    '''
+    return get_storage(STORAGE_BACKEND, os.path.join(DB_PATH, DB_FILE_NAME), PARQUET_DIRECTORY,
+                       ARROW_DIRECTORY, SQLITE_EXPORT_TABLES)
@@ -1,6 +1,16 @@
 DB_PATH = "/Users/rpandey1/airflow/dags/Lead_scoring_data_pipeline/db"
 DB_FILE_NAME = "lead_scoring_data_cleaning.db"
 
+# backend storing the pipeline's tables, must match the data pipeline's
+# 'sqlite' (the db file above), 'parquet' (one Parquet file per table in
+# PARQUET_DIRECTORY) or 'arrow' (one memory-mapped Arrow file per table in
+# ARROW_DIRECTORY). With 'arrow' the tables in SQLITE_EXPORT_TABLES are also
+# written to the db file
+STORAGE_BACKEND = 'sqlite'
+PARQUET_DIRECTORY = "/Users/rpandey1/airflow/dags/Lead_scoring_data_pipeline/db/parquet"
+ARROW_DIRECTORY = "/Users/rpandey1/airflow/dags/Lead_scoring_data_pipeline/db/arrow"
+SQLITE_EXPORT_TABLES = []
+
 DB_FILE_MLFLOW = "Lead_scoring_mlflow_production.db"
 
 TRACKING_URI = "http://0.0.0.0:6006"
@@ -33,3 +43,22 @@ ONE_HOT_ENCODED_FEATURES = ['total_leads_droppped', 'referred_lead', 'app_comple
 
 # list of features that need to be one-hot encoded
 FEATURES_TO_ENCODE = ['city_tier','first_platform_c','first_utm_medium_c','first_utm_source_c']
+
+# levels of the features that need to be one-hot encoded, in the order of their
+# one-hot encoded columns. The features are cast to categoricals over these levels
+FEATURE_LEVELS = {'city_tier': [1.0, 2.0, 3.0],
+                  'first_platform_c': ['Level0', 'Level1', 'Level2', 'Level3', 'Level7', 'Level8', 'others'],
+                  'first_utm_medium_c': ['Level0', 'Level10', 'Level11', 'Level13', 'Level15', 'Level16', 'Level2',
+                                         'Level20', 'Level26', 'Level3', 'Level30', 'Level33', 'Level4', 'Level43',
+                                         'Level5', 'Level6', 'Level8', 'Level9', 'others'],
+                  'first_utm_source_c': ['Level0', 'Level14', 'Level16', 'Level2', 'Level4', 'Level5', 'Level6',
+                                         'Level7', 'others']}
+
+# names of the model's features, i.e. the encoded columns without the target
+FEATURE_NAMES = [feature for feature in ONE_HOT_ENCODED_FEATURES if feature != 'app_complete_flag']
+
+# keep the encoded features as a sparse CSR matrix from the encoder to the model,
+# saved in DB_PATH instead of the dense 'features' and 'target' tables
+USE_SPARSE_FEATURES = False
+SPARSE_FEATURES_FILE = "features.npz"
+TARGET_ARRAY_FILE = "target.npy"
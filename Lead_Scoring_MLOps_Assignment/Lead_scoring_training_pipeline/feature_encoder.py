@@ -0,0 +1,203 @@
+'''
+filename: feature_encoder.py
+functions: OneHotEncoder, RowEncoder
+version: 1
+'''
+
+###############################################################################
+# Import necessary modules
+# ##############################################################################
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+###############################################################################
+# Define the one hot encoder shared by the training and inference pipelines
+# ##############################################################################
+
+class OneHotEncoder:
+    '''
+    One hot encoder with a fixed vocabulary. It is built once from the list of
+    the columns of the encoded dataframe (ONE_HOT_ENCODED_FEATURES), the list
+    of the features to encode (FEATURES_TO_ENCODE) and their levels
+    (FEATURE_LEVELS), and gives the same encoding as calling pd.get_dummies
+    on every feature and copying the wanted columns one by one into an empty
+    ONE_HOT_ENCODED_FEATURES dataframe.
+
+    Every feature level is resolved to its output column up front, so that
+    encoding a dataframe is a single scatter into a preallocated uint8
+    matrix. Levels that have no output column, unknown levels and nulls
+    leave their row at 0. The columns of ONE_HOT_ENCODED_FEATURES that
+    aren't one hot encoded ('total_leads_droppped', 'referred_lead', ...)
+    are copied from the input with their nulls filled with 0, as the
+    fillna(0) over the assembled dataframe did.
+
+    SAMPLE USAGE
+        encoder = OneHotEncoder(ONE_HOT_ENCODED_FEATURES, FEATURES_TO_ENCODE, FEATURE_LEVELS)
+        df_encoded = encoder.transform(model_input_data)
+    '''
+
+    def __init__(self, one_hot_encoded_features, features_to_encode, feature_levels):
+        self.columns = list(one_hot_encoded_features)
+        self.features_to_encode = list(features_to_encode)
+        self.levels = {feature: list(feature_levels[feature]) for feature in self.features_to_encode}
+
+        position = {column: index for index, column in enumerate(self.columns)}
+        # output column of every level of every feature, -1 when it has none.
+        # The extra trailing -1 is what the categorical code -1 (unknown level
+        # or null) picks up.
+        self.level_columns = {
+            feature: np.array([position.get(f"{feature}_{level}", -1) for level in levels] + [-1])
+            for feature, levels in self.levels.items()
+        }
+        encoded = {column for columns in self.level_columns.values() for column in columns if column >= 0}
+        self.passthrough = [column for index, column in enumerate(self.columns) if index not in encoded]
+
+    def transform(self, df):
+        '''
+        Encodes df and returns the ONE_HOT_ENCODED_FEATURES dataframe, whose
+        one hot columns are uint8 views on a single matrix.
+        '''
+        one_hot = np.zeros((len(df), len(self.columns)), dtype=np.uint8)
+        rows, columns = self.one_hot_positions(df)
+        one_hot[rows, columns] = 1
+
+        df_encoded = pd.DataFrame(one_hot, columns=self.columns, index=df.index)
+        for column in self.passthrough:
+            if column in df.columns:
+                df_encoded[column] = df[column].fillna(0)
+        return df_encoded
+
+    def transform_sparse(self, df):
+        '''
+        Same encoding as transform, returned as a float64 CSR matrix over the
+        ONE_HOT_ENCODED_FEATURES columns. Only the non zero entries are ever
+        built, so the dense matrix is never materialised.
+        '''
+        rows, columns = self.one_hot_positions(df)
+        data = [np.ones(len(rows))]
+        rows, columns = [rows], [columns]
+        for column in self.passthrough:
+            if column in df.columns:
+                values = df[column].to_numpy(dtype=float, na_value=0.0)
+                non_zero = np.flatnonzero(values)
+                rows.append(non_zero)
+                columns.append(np.full(len(non_zero), self.columns.index(column)))
+                data.append(values[non_zero])
+
+        return sparse.csr_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(columns))),
+                                 shape=(len(df), len(self.columns)))
+
+    def one_hot_positions(self, df):
+        '''
+        Returns the row and output column indices of the ones of the one hot
+        encoding of df.
+        '''
+        output_columns = []
+        for feature in self.features_to_encode:
+            if feature in df.columns:
+                codes = pd.Categorical(df[feature], categories=self.levels[feature]).codes
+                output_columns.append(self.level_columns[feature][codes])
+            else:
+                print("feature not found", feature)
+
+        if not output_columns:
+            return np.array([], dtype=int), np.array([], dtype=int)
+        output_columns = np.column_stack(output_columns)
+        rows, features = np.nonzero(output_columns >= 0)
+        return rows, output_columns[rows, features]
+
+
+###############################################################################
+# Define the row encoder used to score single leads
+# ##############################################################################
+
+class RowEncoder:
+    '''
+    Encodes raw leads given as dicts straight into feature vectors, without
+    going through pandas. It gives, bit for bit, the same features as
+    running the data pipeline's city tier mapping and level collapsing on a
+    dataframe of the leads and encoding it with OneHotEncoder: a lead
+    without 'city_tier' gets the tier of its 'city_mapped' (3.0 when the
+    city isn't mapped), the insignificant levels and nulls of the other
+    encoded features are "others" and null or missing non encoded
+    features ('total_leads_droppped', 'referred_lead') are 0. The one
+    difference is a feature missing from every lead of a dataframe, which
+    OneHotEncoder leaves all zeros while it is "others" here.
+
+    Every lookup is resolved to its output column when the encoder is built:
+    cities and tiers to the column of their tier, raw levels to the column
+    of their significant level or of "others". Encoding a lead is then a
+    few dict lookups.
+
+    SAMPLE USAGE
+        row_encoder = RowEncoder(ONE_HOT_ENCODED_FEATURES, FEATURES_TO_ENCODE, FEATURE_LEVELS,
+                                 city_tier_mapping, significant_levels)
+        vector = row_encoder.encode(lead)
+        matrix = row_encoder.encode_batch(leads)
+    '''
+
+    def __init__(self, one_hot_encoded_features, features_to_encode, feature_levels,
+                 city_tier_mapping, significant_levels):
+        self.columns = list(one_hot_encoded_features)
+        position = {column: index for index, column in enumerate(self.columns)}
+
+        # output column of every level of every feature, -1 when it has none
+        self.level_columns = {feature: {level: position.get(f"{feature}_{level}", -1) for level in feature_levels[feature]}
+                              for feature in features_to_encode}
+        # levels that aren't significant are "others", and so is a null
+        self.default_columns = {feature: levels.get("others", -1) for feature, levels in self.level_columns.items()}
+        for feature, levels in significant_levels.items():
+            if feature in self.level_columns:
+                self.level_columns[feature] = {level: self.level_columns[feature].get(level, -1) for level in levels}
+        if 'city_tier' in self.level_columns:
+            tier_columns = self.level_columns['city_tier']
+            self.city_columns = {city: tier_columns.get(float(tier), -1) for city, tier in city_tier_mapping.items()}
+            self.default_city_column = tier_columns.get(3.0, -1)
+        else:
+            self.city_columns, self.default_city_column = {}, -1
+
+        encoded = {column for levels in self.level_columns.values() for column in levels.values()}
+        encoded |= set(self.default_columns.values())
+        self.passthrough = [(column, index) for index, column in enumerate(self.columns) if index not in encoded]
+
+    def encode(self, lead):
+        '''
+        Returns the float64 feature vector of the lead, over the columns of
+        ONE_HOT_ENCODED_FEATURES.
+        '''
+        vector = np.zeros(len(self.columns))
+        for feature in self.level_columns:
+            column = self.output_column(feature, lead)
+            if column >= 0:
+                vector[column] = 1.0
+        for column, index in self.passthrough:
+            value = lead.get(column)
+            # nulls are 0, as are NaN which are the only values not equal to themselves
+            if value is not None and value == value:
+                vector[index] = value
+        return vector
+
+    def encode_batch(self, leads):
+        '''
+        Returns the float64 feature matrix of a list of leads, one row per
+        lead. The lookups are done feature by feature and the matrix filled
+        with one scatter per feature.
+        '''
+        matrix = np.zeros((len(leads), len(self.columns)))
+        rows = np.arange(len(leads))
+        for feature in self.level_columns:
+            columns = np.fromiter((self.output_column(feature, lead) for lead in leads), dtype=np.intp, count=len(leads))
+            found = columns >= 0
+            matrix[rows[found], columns[found]] = 1.0
+        for column, index in self.passthrough:
+            values = np.array([lead.get(column) for lead in leads], dtype=float)
+            matrix[:, index] = np.where(np.isnan(values), 0.0, values)
+        return matrix
+
+    def output_column(self, feature, lead):
+        if feature == 'city_tier' and 'city_tier' not in lead:
+            return self.city_columns.get(lead.get('city_mapped'), self.default_city_column)
+        return self.level_columns[feature].get(lead.get(feature), self.default_columns[feature])
@@ -0,0 +1,211 @@
+'''
+filename: flat_trees.py
+functions: export_flat_trees, FlatTreeEnsemble
+version: 1
+
+Flattened, array backed copy of a trained LightGBM binary classifier and a
+numpy evaluator for it, so that scoring workers need neither mlflow, pandas
+nor lightgbm, nor to unpickle the classifier. Only numpy is imported here.
+
+All the nodes of all the trees are stored in arrays of one entry per node:
+the feature and threshold of the split, the index of its right child (the
+left child is the next node, the nodes are in pre-order) and, for leaves,
+the leaf value. A leaf has a NaN threshold, so it sends every row right, to
+itself, and walking a tree for its depth from its root ends on a leaf. The
+arrays are saved as .npy files in a directory, next to a manifest.json, and
+are memory-mapped when loaded, so that the workers of a machine share one
+copy.
+'''
+
+###############################################################################
+# Import necessary modules
+# ##############################################################################
+
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+# missing value handling of a split, as in LightGBM
+MISSING_NONE, MISSING_ZERO, MISSING_NAN = 0, 1, 2
+MISSING_TYPES = {"None": MISSING_NONE, "Zero": MISSING_ZERO, "NaN": MISSING_NAN}
+# LightGBM's kZeroThreshold, values this close to 0 are zero for MISSING_ZERO
+ZERO_THRESHOLD = 1e-35
+NODE_ARRAYS = ["feature", "threshold", "right", "value", "default_left", "missing_type"]
+TREE_ARRAYS = ["roots", "depths"]
+# rows walked through a tree at once
+EVALUATION_BLOCK_ROWS = 1 << 16
+
+
+###############################################################################
+# Define the exporter
+# ##############################################################################
+
+def export_flat_trees(booster, directory, classes=(0, 1)):
+    '''
+    Exports the trees of booster, a lightgbm.Booster of a binary classifier
+    with numerical splits, to directory, replacing it. classes are the
+    labels of the classifier.
+
+    SAMPLE USAGE
+        export_flat_trees(classifier.booster_, flat_trees_directory, classifier.classes_)
+    '''
+    model = booster.dump_model()
+    objective = model["objective"].split()
+    if objective[0] != "binary" or model["num_class"] != 1:
+        raise ValueError(f"Only binary classifiers can be flattened, not '{model['objective']}'")
+    sigmoid = float(dict(parameter.split(":") for parameter in objective[1:]).get("sigmoid", 1.0))
+
+    nodes = {name: [] for name in NODE_ARRAYS}
+    roots, depths = [], []
+    for tree in model["tree_info"]:
+        roots.append(len(nodes["feature"]))
+        depths.append(flatten_tree(tree["tree_structure"], nodes))
+
+    arrays = {"feature": np.array(nodes["feature"], dtype=np.int32),
+              "threshold": np.array(nodes["threshold"], dtype=np.float64),
+              "right": np.array(nodes["right"], dtype=np.int32),
+              "value": np.array(nodes["value"], dtype=np.float64),
+              "default_left": np.array(nodes["default_left"], dtype=bool),
+              "missing_type": np.array(nodes["missing_type"], dtype=np.int8),
+              "roots": np.array(roots, dtype=np.int32),
+              "depths": np.array(depths, dtype=np.int32)}
+    manifest = {"feature_names": model["feature_names"], "classes": np.asarray(classes).tolist(),
+                "sigmoid": sigmoid, "average_output": bool(model.get("average_output", False))}
+
+    # written next to directory and moved in place in one rename
+    parent = os.path.dirname(os.path.abspath(directory))
+    os.makedirs(parent, exist_ok=True)
+    temporary_directory = tempfile.mkdtemp(dir=parent)
+    try:
+        for name, array in arrays.items():
+            np.save(os.path.join(temporary_directory, f"{name}.npy"), array)
+        with open(os.path.join(temporary_directory, "manifest.json"), "w") as file:
+            json.dump(manifest, file)
+        shutil.rmtree(directory, ignore_errors=True)
+        os.replace(temporary_directory, directory)
+    finally:
+        shutil.rmtree(temporary_directory, ignore_errors=True)
+
+
+def flatten_tree(tree, nodes):
+    '''
+    Appends the nodes of a tree of LightGBM's dump_model to the node lists,
+    in pre-order, and returns the depth of the tree.
+    '''
+    index = len(nodes["feature"])
+    if "leaf_value" in tree:
+        for name, value in [("feature", 0), ("threshold", np.nan), ("right", index), ("value", tree["leaf_value"]),
+                            ("default_left", False), ("missing_type", MISSING_NONE)]:
+            nodes[name].append(value)
+        return 0
+    if tree["decision_type"] != "<=":
+        raise ValueError(f"Only numerical splits can be flattened, not '{tree['decision_type']}'")
+
+    for name, value in [("feature", tree["split_feature"]), ("threshold", tree["threshold"]), ("right", -1),
+                        ("value", 0.0), ("default_left", tree["default_left"]),
+                        ("missing_type", MISSING_TYPES[tree["missing_type"]])]:
+        nodes[name].append(value)
+    left_depth = flatten_tree(tree["left_child"], nodes)
+    nodes["right"][index] = len(nodes["feature"])
+    right_depth = flatten_tree(tree["right_child"], nodes)
+    return 1 + max(left_depth, right_depth)
+
+
+###############################################################################
+# Define the evaluator
+# ##############################################################################
+
+class FlatTreeEnsemble:
+    '''
+    Evaluates the trees exported by export_flat_trees on batches of rows.
+    Every tree is walked by a block of rows at once, one level per
+    vectorized step. Gives the same probabilities as the booster the trees
+    were exported from, and the same labels as its classifier.
+
+    SAMPLE USAGE
+        model = FlatTreeEnsemble.load(flat_trees_directory)
+        probabilities = model.predict_proba(features)
+    '''
+
+    def __init__(self, arrays, manifest):
+        for name in NODE_ARRAYS + TREE_ARRAYS:
+            setattr(self, name, arrays[name])
+        self.feature_names = manifest["feature_names"]
+        self.classes = np.asarray(manifest["classes"])
+        self.sigmoid = manifest["sigmoid"]
+        self.average_output = manifest["average_output"]
+        self.has_zero_missing = bool((self.missing_type == MISSING_ZERO).any())
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        '''
+        Loads the trees exported to directory, memory-mapping the arrays
+        unless mmap is False.
+        '''
+        with open(os.path.join(directory, "manifest.json")) as file:
+            manifest = json.load(file)
+        arrays = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r" if mmap else None)
+                  for name in NODE_ARRAYS + TREE_ARRAYS}
+        return cls(arrays, manifest)
+
+    def predict_raw(self, features):
+        '''
+        Returns the raw score of every row of features, a 2d array with the
+        columns in training order or a DataFrame, whose columns are taken
+        by name in training order.
+        '''
+        # a DataFrame, told apart by its columns so that pandas isn't imported here
+        if hasattr(features, "columns"):
+            missing_features = [name for name in self.feature_names if name not in features.columns]
+            if missing_features:
+                raise ValueError(f"Features missing from the data: {missing_features}")
+            features = features[self.feature_names]
+        features = np.asarray(features, dtype=np.float64)
+        raw = np.zeros(len(features))
+        for start in range(0, len(features), EVALUATION_BLOCK_ROWS):
+            # column-major, so that a level reads the block's rows of a few features
+            block = np.ascontiguousarray(features[start:start + EVALUATION_BLOCK_ROWS].T)
+            raw[start:start + block.shape[1]] = self.predict_block(block)
+        if self.average_output:
+            raw /= len(self.roots)
+        return raw
+
+    def predict_block(self, block):
+        # sum of the leaf values of a block of rows, block[feature, row]
+        rows = np.arange(block.shape[1])
+        values = block.ravel()
+        missing = self.has_zero_missing or bool(np.isnan(values).any())
+        raw = np.zeros(len(rows))
+        for root, depth in zip(self.roots.tolist(), self.depths.tolist()):
+            nodes = np.full(len(rows), root, dtype=np.intp)
+            for _ in range(depth):
+                split_values = values[self.feature[nodes] * len(rows) + rows]
+                if missing:
+                    go_left = self.missing_go_left(nodes, split_values)
+                else:
+                    go_left = split_values <= self.threshold[nodes]
+                nodes = np.where(go_left, nodes + 1, self.right[nodes])
+            raw += self.value[nodes]
+        return raw
+
+    def missing_go_left(self, nodes, values):
+        # LightGBM's decision for the splits that see missing values
+        missing_type = self.missing_type[nodes]
+        nan = np.isnan(values)
+        values = np.where(nan & (missing_type != MISSING_NAN), 0.0, values)
+        missing = ((missing_type == MISSING_ZERO) & (np.abs(values) <= ZERO_THRESHOLD)) \
+            | ((missing_type == MISSING_NAN) & nan)
+        return np.where(missing, self.default_left[nodes], values <= self.threshold[nodes])
+
+    def predict_proba(self, features):
+        '''
+        Returns the probability of class 1 of every row of features.
+        '''
+        return 1.0 / (1.0 + np.exp(-self.sigmoid * self.predict_raw(features)))
+
+    def predict(self, features):
+        probabilities = self.predict_proba(features)
+        return self.classes[(probabilities > 1.0 - probabilities).astype(np.intp)]
@@ -9,11 +9,8 @@ version: 1
 # Import necessary modules
 # ##############################################################################
 
-import pandas as pd
 import numpy as np
-
-import sqlite3
-from sqlite3 import Error
+from scipy import sparse
 
 import mlflow
 import mlflow.sklearn
@@ -26,6 +23,11 @@ import os
 import logging
 
 from Lead_scoring_training_pipeline.constants import *
+from Lead_scoring_data_pipeline.storage import SQLiteStorage, get_storage
+from Lead_scoring_training_pipeline.feature_encoder import OneHotEncoder
+
+# one hot encoder over the fixed vocabulary of constants.py, built once
+encoder = OneHotEncoder(ONE_HOT_ENCODED_FEATURES, FEATURES_TO_ENCODE, FEATURE_LEVELS)
 
 ###############################################################################
 # Define the function to encode features
@@ -47,6 +49,10 @@ def encode_features():
         1. Save the encoded features in a table - features
         2. Save the target variable in a separate table - target
 
+        If USE_SPARSE_FEATURES is set, the features are instead saved as a
+        sparse CSR matrix in SPARSE_FEATURES_FILE and the target as a numpy
+        array in TARGET_ARRAY_FILE, both in DB_PATH.
+
 
     SAMPLE USAGE
         encode_features()
@@ -54,34 +60,18 @@ def encode_features():
     **NOTE : You can modify the encode_featues function used in heart disease's inference
         pipeline from the pre-requisite module for this.
     '''
-    conn = connect_to_db()
-    if conn:
-        model_input_data = pd.read_sql("select * from model_input",conn)
-        df_encoded = pd.DataFrame(columns=ONE_HOT_ENCODED_FEATURES)
-        df_placeholder= pd.DataFrame()
-        for feature in FEATURES_TO_ENCODE:
-            if feature in model_input_data.columns:
-                encode = pd.get_dummies(model_input_data[feature])
-                encode = encode.add_prefix(feature+'_')
-                df_placeholder = pd.concat([df_placeholder,encode],axis=1)
-            else:
-                print("feature not found")
-        
-        for feature in ONE_HOT_ENCODED_FEATURES:
-            if feature in df_placeholder.columns:
-                df_encoded[feature]= df_placeholder[feature]
-            if feature in model_input_data.columns:
-                df_encoded[feature]=model_input_data[feature]
-                
-        df_encoded=df_encoded.fillna(0)
-        df_features = df_encoded.drop('app_complete_flag',axis=1)
-        df_target = df_encoded['app_complete_flag']
-        df_features.to_sql('features',con=conn,index=False,if_exists='replace')
-        df_target.to_sql('target',con=conn,index=False,if_exists='replace')
-        conn.close()
+    storage = connect_to_storage()
+    model_input_data = storage.read_table("model_input", read_only=True)
+    if USE_SPARSE_FEATURES:
+        save_sparse_features(model_input_data)
         print("Features Encoding done")
-    else:
-        print("Error getting connection from the database")
+        return
+    df_encoded = encoder.transform(model_input_data)
+    df_features = df_encoded.drop('app_complete_flag',axis=1)
+    df_target = df_encoded[['app_complete_flag']]
+    storage.write_table(df_features,'features')
+    storage.write_table(df_target,'target')
+    print("Features Encoding done")
 
 ###############################################################################
 # Define the function to train the model
@@ -109,37 +99,66 @@ def get_trained_model():
     SAMPLE USAGE
         get_trained_model()
     '''
-    conn = connect_to_db()
-    if conn:
-        X = pd.read_sql("select * from features",conn)
-        y = pd.read_sql("select * from target",conn)
-        X_train,X_test,y_train,y_test = train_test_split(X,y,test_size=0.3,random_state=0)
-        mlflow.set_tracking_uri(TRACKING_URI)
-        try:
-            logging.info("creating mlflow experiment")
-            mlflow.create_experiment(EXPERIMENT)
-        except Exception as e:
-            logging.info(f"Error in creating experiement : {e}")
-        logging.info("setting mlflow experiment")
-        mlflow.set_experiment(EXPERIMENT)
-        with mlflow.start_run(run_name=EXPERIMENT) as run:
-            clf = lgb.LGBMClassifier()
-            clf.set_params(**model_config)
-            clf.fit(X_train,y_train)
-            mlflow.sklearn.log_model(sk_model=clf,artifact_path="models",registered_model_name='LightGBM')
-            mlflow.log_params(model_config)
-            y_pred = clf.predict(X_test)
-            acc = accuracy_score(y_pred,y_test)
-            auc = roc_auc_score(y_pred,y_test)
-            mlflow.log_metric('test_accouracy',acc)
-            mlflow.log_metric('test_auc',auc)
-            runID = run.info.run_uuid
-            print("Inside MLflow Run with id {}".format(runID))
+    if USE_SPARSE_FEATURES:
+        X, y = load_sparse_features()
     else:
-        print("Error getting connection from the database")
+        storage = connect_to_storage()
+        X = storage.read_table('features', read_only=True)
+        y = storage.read_table('target', read_only=True)
+    X_train,X_test,y_train,y_test = train_test_split(X,y,test_size=0.3,random_state=0)
+    mlflow.set_tracking_uri(TRACKING_URI)
+    try:
+        logging.info("creating mlflow experiment")
+        mlflow.create_experiment(EXPERIMENT)
+    except Exception as e:
+        logging.info(f"Error in creating experiement : {e}")
+    logging.info("setting mlflow experiment")
+    mlflow.set_experiment(EXPERIMENT)
+    with mlflow.start_run(run_name=EXPERIMENT) as run:
+        clf = lgb.LGBMClassifier()
+        clf.set_params(**model_config)
+        if USE_SPARSE_FEATURES:
+            clf.fit(X_train,y_train,feature_name=FEATURE_NAMES)
+        else:
+            clf.fit(X_train,y_train)
+        mlflow.sklearn.log_model(sk_model=clf,artifact_path="models",registered_model_name='LightGBM')
+        mlflow.log_params(model_config)
+        y_pred = clf.predict(X_test)
+        acc = accuracy_score(y_pred,y_test)
+        auc = roc_auc_score(y_pred,y_test)
+        mlflow.log_metric('test_accouracy',acc)
+        mlflow.log_metric('test_auc',auc)
+        runID = run.info.run_uuid
+        print("Inside MLflow Run with id {}".format(runID))
    
+def save_sparse_features(model_input_data):
+    '''
+    Encodes model_input_data straight into a sparse CSR matrix and saves
+    the features in SPARSE_FEATURES_FILE and the target in TARGET_ARRAY_FILE.
+    '''
+    encoded = encoder.transform_sparse(model_input_data)
+    target_index = ONE_HOT_ENCODED_FEATURES.index('app_complete_flag')
+    feature_index = [ONE_HOT_ENCODED_FEATURES.index(feature) for feature in FEATURE_NAMES]
+    sparse.save_npz(os.path.join(DB_PATH, SPARSE_FEATURES_FILE), encoded[:, feature_index].tocsr())
+    np.save(os.path.join(DB_PATH, TARGET_ARRAY_FILE), encoded[:, target_index].toarray().ravel())
+
+def load_sparse_features():
+    '''
+    Loads the CSR feature matrix and the target array saved by
+    save_sparse_features.
+    '''
+    X = sparse.load_npz(os.path.join(DB_PATH, SPARSE_FEATURES_FILE))
+    y = np.load(os.path.join(DB_PATH, TARGET_ARRAY_FILE))
+    return X, y
+
 def connect_to_db():
-    db_full_path = os.path.join(DB_PATH, DB_FILE_NAME)
-    conn = sqlite3.connect(db_full_path)
-    print("connecting to db from path: ", db_full_path)
-    return conn
\ No newline at end of file
+    # same tuned connection as the sqlite storage
+    return SQLiteStorage(os.path.join(DB_PATH, DB_FILE_NAME)).connect()
+
+def connect_to_storage():
+    '''
+    Returns the storage of the pipeline's tables for the STORAGE_BACKEND set
+    in constants.py.
+    '''
+    return get_storage(STORAGE_BACKEND, os.path.join(DB_PATH, DB_FILE_NAME), PARQUET_DIRECTORY,
+                       ARROW_DIRECTORY, SQLITE_EXPORT_TABLES)
@@ -0,0 +1,100 @@
+'''
+filename: bench_dag_parsing.py
+functions: parse_one, main
+version: 1
+
+Times how long the Airflow scheduler takes to parse each of the three DAG
+files and lists the heavy modules parsing imports. Every parse runs in a
+fresh process which imports airflow first, as the scheduler's parsing
+processes have, so only the cost of the DAG file itself is measured. With
+--baseline the DAG files of that git revision are parsed as well, to
+compare with the current ones.
+
+Needs airflow installed and the pipelines deployed to /home/airflow/dags,
+where the DAG files load their modules from.
+
+SAMPLE USAGE
+    python benchmarks/bench_dag_parsing.py --repeat 5
+    python benchmarks/bench_dag_parsing.py --baseline HEAD~1
+'''
+
+import argparse
+import os
+import runpy
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+DAG_FILES = [
+    "Lead_scoring_data_pipeline/lead_scoring_data_pipeline.py",
+    "Lead_scoring_training_pipeline/lead_scoring_training_pipeline.py",
+    "Lead_scoring_inference_pipeline/lead_scoring_inference_pipeline.py",
+]
+HEAVY_MODULES = ["pandas", "numpy", "sklearn", "lightgbm", "mlflow", "pyarrow"]
+
+
+def parse_one(dag_file):
+    # imported up front by the scheduler's parsing processes too
+    import airflow
+    from airflow.operators.python import PythonOperator
+
+    start = time.perf_counter()
+    runpy.run_path(dag_file)
+    elapsed = time.perf_counter() - start
+    imported = [module for module in HEAVY_MODULES if module in sys.modules]
+    print(f"{elapsed} {','.join(imported) or '-'}")
+
+
+def time_parses(dag_file, repeat):
+    '''
+    Parses dag_file repeat times, each in a fresh process, and returns the
+    median seconds and the heavy modules imported.
+    '''
+    seconds = []
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, __file__, "--parse-one", dag_file], capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"Parsing {dag_file} failed:\n{result.stderr}")
+        elapsed, imported = result.stdout.split()[-2:]
+        seconds.append(float(elapsed))
+    return statistics.median(seconds), imported
+
+
+def baseline_file(revision, dag_file, directory):
+    # the DAG file as of revision, written to directory
+    source = subprocess.run(["git", "show", f"{revision}:./{dag_file}"], cwd=ROOT, check=True,
+                            capture_output=True, text=True).stdout
+    path = os.path.join(directory, os.path.basename(dag_file))
+    with open(path, "w") as file:
+        file.write(source)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--baseline", help="git revision whose DAG files are parsed too")
+    parser.add_argument("--parse-one", metavar="DAG_FILE", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.parse_one:
+        parse_one(args.parse_one)
+        return
+
+    print(f"{'DAG file':>36} {'revision':>10} {'parse (s)':>10}  heavy modules imported")
+    with tempfile.TemporaryDirectory() as directory:
+        for dag_file in DAG_FILES:
+            versions = [("current", os.path.join(ROOT, dag_file))]
+            if args.baseline:
+                versions.append((args.baseline, baseline_file(args.baseline, dag_file, directory)))
+            for revision, path in versions:
+                seconds, imported = time_parses(path, args.repeat)
+                print(f"{os.path.basename(dag_file):>36} {revision:>10} {seconds:>10.3f}  {imported}")
+
+
+if __name__ == "__main__":
+    main()
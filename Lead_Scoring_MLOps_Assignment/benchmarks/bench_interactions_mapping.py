@@ -0,0 +1,122 @@
+'''
+filename: bench_interactions_mapping.py
+functions: melt_pivot_interactions_mapping, make_input, run_one, main
+version: 1
+
+Compares the vectorized apply_interactions_mapping of the data pipeline with
+the melt/merge/pivot_table implementation it replaced. Every implementation
+runs in a fresh process so that its peak RSS is measured on its own.
+
+SAMPLE USAGE
+    python benchmarks/bench_interactions_mapping.py --rows 100000 1000000
+'''
+
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from Lead_scoring_data_pipeline import utils
+
+utils.INTERACTION_MAPPING = os.path.join(ROOT, "Lead_scoring_data_pipeline", "mapping", "interaction_mapping.csv")
+utils.USE_INFERENCE_DATA = False
+
+
+def melt_pivot_interactions_mapping(df):
+    '''
+    The original implementation of the interactions mapping, kept as the
+    reference for the benchmark.
+    '''
+    df = df.drop_duplicates()
+    index_columns = utils.INDEX_COLUMNS_TRAINING
+
+    interaction_mapping = pd.read_csv(utils.INTERACTION_MAPPING)
+    df = df.melt(id_vars=index_columns, var_name="interaction_type", value_name="interaction_value")
+    df['interaction_value'] = df['interaction_value'].fillna(0)
+    df = df.merge(interaction_mapping, on="interaction_type", how="left")
+    df = df.drop(['interaction_type'], axis=1)
+    return df.pivot_table(index=index_columns, values="interaction_value", columns='interaction_mapping', aggfunc='sum').reset_index()
+
+
+IMPLEMENTATIONS = {
+    "melt_pivot": melt_pivot_interactions_mapping,
+    "vectorized": utils.apply_interactions_mapping,
+}
+
+
+def make_input(rows, seed=0):
+    '''
+    Builds a 'categorical_variables_mapped'-like frame: significant levels,
+    city tiers and sparse interaction counts.
+    '''
+    rng = np.random.default_rng(seed)
+    interaction_columns, _, _ = utils.compile_interaction_mapping(utils.INTERACTION_MAPPING)
+    created = pd.Timestamp("2021-07-01") + pd.to_timedelta(rng.integers(0, 200 * 86400, rows), unit="s")
+    df = pd.DataFrame({
+        "created_date": created.astype(str),
+        "first_platform_c": rng.choice(utils.list_platform + ["others"], rows),
+        "first_utm_medium_c": rng.choice(utils.list_medium + ["others"], rows),
+        "first_utm_source_c": rng.choice(utils.list_source + ["others"], rows),
+        "total_leads_droppped": rng.integers(0, 5, rows).astype(float),
+        "referred_lead": rng.integers(0, 2, rows).astype(float),
+    })
+    for column in interaction_columns:
+        values = rng.integers(1, 10, rows).astype(float)
+        df[column] = np.where(rng.random(rows) < 0.05, values, np.nan)
+    df["city_tier"] = rng.choice([1.0, 2.0, 3.0], rows)
+    df["app_complete_flag"] = rng.integers(0, 2, rows)
+    return df
+
+
+def max_rss_mb():
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return max_rss / 2 ** 20 if sys.platform == "darwin" else max_rss / 2 ** 10
+
+
+def run_one(implementation, rows):
+    df = make_input(rows)
+    rss_before = max_rss_mb()
+    start = time.perf_counter()
+    IMPLEMENTATIONS[implementation](df)
+    elapsed = time.perf_counter() - start
+    print(f"{elapsed} {rss_before} {max_rss_mb()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[100000, 300000])
+    parser.add_argument("--run-one", nargs=2, metavar=("IMPLEMENTATION", "ROWS"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        run_one(args.run_one[0], int(args.run_one[1]))
+        return
+
+    df = make_input(1000)
+    pd.testing.assert_frame_equal(melt_pivot_interactions_mapping(df), utils.apply_interactions_mapping(df))
+    print("outputs identical on the check sample\n")
+
+    print(f"{'rows':>10} {'implementation':>15} {'time (s)':>10} {'peak RSS (MB)':>14} {'RSS added (MB)':>15}")
+    for rows in args.rows:
+        for implementation in IMPLEMENTATIONS:
+            result = subprocess.run([sys.executable, __file__, "--run-one", implementation, str(rows)],
+                                    capture_output=True, text=True)
+            if result.returncode != 0:
+                # typically the melt running out of memory on large inputs
+                print(f"{rows:>10} {implementation:>15} {'failed with exit code ' + str(result.returncode):>41}")
+                continue
+            elapsed, rss_before, rss_after = map(float, result.stdout.split()[-3:])
+            print(f"{rows:>10} {implementation:>15} {elapsed:>10.2f} {rss_after:>14.0f} {rss_after - rss_before:>15.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,10 +2,33 @@
 # Import the necessary modules
 ##############################################################################
 import unittest
+import pytest
+import os
+import sys
+import threading
+import importlib.util
+import json
+import http.client
+import numpy as np
 import pandas as pd
 import sqlite3
 from utils import load_data_into_db, map_city_tier, map_categorical_vars,interactions_mapping
 
+TEST_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(TEST_DIRECTORY, ".."))
+
+from Lead_scoring_data_pipeline import utils as pipeline_utils
+from Lead_scoring_training_pipeline.feature_encoder import OneHotEncoder, RowEncoder
+from Lead_scoring_training_pipeline import utils as training_utils
+from Lead_scoring_inference_pipeline.scoring_service import MicroBatcher, InvalidLeads, encode_request, make_server
+from Lead_scoring_inference_pipeline import utils as inference_utils
+from Lead_scoring_inference_pipeline.score_cache import ScoreCache
+from Lead_scoring_inference_pipeline import model_cache as model_cache_module
+from Lead_scoring_inference_pipeline.native_model import NativeLightGBMModel, ClassifierProbabilityModel, predicted_labels
+from Lead_scoring_training_pipeline.flat_trees import FlatTreeEnsemble, export_flat_trees
+from Lead_scoring_data_pipeline.storage import get_storage, SQLiteStorage
+from Lead_scoring_data_pipeline import storage as storage_module
+
 
 ###############################################################################
 # Write test cases for load_data_into_db() function
@@ -123,3 +146,1119 @@ def test_interactions_mapping():
     assert 'interaction_mapped' in df_mapped.columns, "interaction_mapped column is missing"
     assert df_mapped['interaction_mapped'].tolist() == [1, 2, 3], "Interaction mapping is incorrect"
 
+
+###############################################################################
+# Write test cases for stream_data_into_db() function
+# ##############################################################################
+def test_stream_data_into_db(tmp_path, monkeypatch):
+    """_summary_
+    This function checks that streaming 'leadscoring_test.csv' into the db in
+    small chunks gives the same 'loaded_data' table as loading the whole file
+    with a single to_sql.
+
+    SAMPLE USAGE
+        output=test_stream_data_into_db()
+
+    """
+    monkeypatch.setattr(pipeline_utils, "DB_PATH", str(tmp_path))
+    csv_file_path = os.path.join(TEST_DIRECTORY, "leadscoring_test.csv")
+
+    rows = pipeline_utils.stream_data_into_db(csv_file_path, 7)
+
+    expected = pd.read_csv(csv_file_path)
+    expected["total_leads_droppped"] = expected["total_leads_droppped"].fillna(0)
+    expected["referred_lead"] = expected["referred_lead"].fillna(0)
+    conn = pipeline_utils.connect_to_db()
+    expected.to_sql("expected_data", conn, index=False)
+    loaded = pd.read_sql("SELECT * FROM loaded_data", conn)
+    expected = pd.read_sql("SELECT * FROM expected_data", conn)
+    conn.close()
+
+    assert rows == len(expected), f"Expected {len(expected)} rows, got {rows}"
+    pd.testing.assert_frame_equal(loaded, expected)
+
+
+###############################################################################
+# Write test cases for clean_data() function
+# ##############################################################################
+def use_test_db(tmp_path, monkeypatch):
+    # point the data pipeline at a scratch db loaded with 'leadscoring_test.csv'
+    monkeypatch.setattr(pipeline_utils, "DB_PATH", str(tmp_path))
+    monkeypatch.setattr(pipeline_utils, "USE_INFERENCE_DATA", False)
+    monkeypatch.setattr(pipeline_utils, "INTERACTION_MAPPING", os.path.join(TEST_DIRECTORY, "interaction_mapping.csv"))
+    pipeline_utils.stream_data_into_db(os.path.join(TEST_DIRECTORY, "leadscoring_test.csv"), 1000)
+
+
+def read_table(table_name):
+    conn = pipeline_utils.connect_to_db()
+    df = pd.read_sql(f"SELECT * FROM {table_name}", conn)
+    conn.close()
+    return df
+
+
+def test_clean_data(tmp_path, monkeypatch):
+    """_summary_
+    This function checks that the fused clean_data pass writes the same
+    'model_input' table as running map_city_tier, map_categorical_vars and
+    interactions_mapping one after the other, and that it skips the
+    intermediate tables unless WRITE_INTERMEDIATE_TABLES is set.
+
+    SAMPLE USAGE
+        output=test_clean_data()
+
+    """
+    use_test_db(tmp_path, monkeypatch)
+    pipeline_utils.map_city_tier()
+    pipeline_utils.map_categorical_vars()
+    pipeline_utils.interactions_mapping()
+    expected = read_table("model_input")
+
+    conn = pipeline_utils.connect_to_db()
+    conn.execute("DROP TABLE city_tier_mapped")
+    conn.close()
+    monkeypatch.setattr(pipeline_utils, "WRITE_INTERMEDIATE_TABLES", False)
+    pipeline_utils.clean_data()
+
+    pd.testing.assert_frame_equal(read_table("model_input"), expected)
+    conn = pipeline_utils.connect_to_db()
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    conn.close()
+    assert "city_tier_mapped" not in tables, "intermediate table written without WRITE_INTERMEDIATE_TABLES"
+
+
+def test_interactions_mapping_pruned_columns(tmp_path, monkeypatch):
+    """_summary_
+    This function checks that the per-step interactions_mapping, on data
+    loaded with PRUNE_UNUSED_COLUMNS set, only writes 'interactions_mapped'
+    when BUILD_INTERACTIONS_MAPPED had the interaction columns loaded.
+
+    SAMPLE USAGE
+        output=test_interactions_mapping_pruned_columns()
+
+    """
+    use_test_db(tmp_path, monkeypatch)
+    csv_file_path = os.path.join(TEST_DIRECTORY, "leadscoring_test.csv")
+    monkeypatch.setattr(pipeline_utils, "PRUNE_UNUSED_COLUMNS", True)
+    for build_interactions_mapped in [False, True]:
+        monkeypatch.setattr(pipeline_utils, "BUILD_INTERACTIONS_MAPPED", build_interactions_mapped)
+        pipeline_utils.stream_data_into_db(csv_file_path, 1000, set(pipeline_utils.plan_source_columns()).__contains__)
+        pipeline_utils.map_city_tier()
+        pipeline_utils.map_categorical_vars()
+        pipeline_utils.interactions_mapping()
+        columns = pipeline_utils.connect_to_storage().table_columns("interactions_mapped")
+        if build_interactions_mapped:
+            assert 'career_interaction' in columns and 'syllabus_interaction' in columns
+        else:
+            assert columns == [], "'interactions_mapped' written without its interaction columns"
+        assert 'first_platform_c' in read_table("model_input").columns
+
+
+def test_clean_data_parquet_storage(tmp_path, monkeypatch):
+    """_summary_
+    This function checks that running the data pipeline on the parquet
+    storage backend gives the same 'model_input' table as on sqlite.
+
+    SAMPLE USAGE
+        output=test_clean_data_parquet_storage()
+
+    """
+    use_test_db(tmp_path, monkeypatch)
+    pipeline_utils.clean_data()
+    expected = read_table("model_input")
+
+    monkeypatch.setattr(pipeline_utils, "STORAGE_BACKEND", "parquet")
+    monkeypatch.setattr(pipeline_utils, "PARQUET_DIRECTORY", str(tmp_path / "parquet"))
+    pipeline_utils.stream_data_into_db(os.path.join(TEST_DIRECTORY, "leadscoring_test.csv"), 7)
+    pipeline_utils.clean_data()
+
+    storage = pipeline_utils.connect_to_storage()
+    assert storage.table_columns("model_input") == list(expected.columns)
+    pd.testing.assert_frame_equal(storage.read_table("model_input"), expected, check_dtype=False)
+
+
+def test_clean_data_in_shards(tmp_path, monkeypatch):
+    """_summary_
+    This function checks that running the cleaning steps on shards of the
+    data in a process pool writes the same tables as the serial run, and
+    that it falls back to the serial run where fork isn't available.
+
+    SAMPLE USAGE
+        output=test_clean_data_in_shards()
+
+    """
+    use_test_db(tmp_path, monkeypatch)
+    monkeypatch.setattr(pipeline_utils, "WRITE_INTERMEDIATE_TABLES", True)
+    tables = ["city_tier_mapped", "categorical_variables_mapped", "model_input"]
+    pipeline_utils.clean_data()
+    expected = {table: read_table(table) for table in tables}
+
+    monkeypatch.setattr(pipeline_utils, "CLEANING_SHARDS", 3)
+    pipeline_utils.clean_data()
+
+    for table in tables:
+        pd.testing.assert_frame_equal(read_table(table), expected[table])
+
+    # without fork the steps run serially
+    monkeypatch.setattr(pipeline_utils, "get_all_start_methods", lambda: ["spawn"])
+    monkeypatch.setattr(pipeline_utils, "ProcessPoolExecutor", None)
+    pipeline_utils.clean_data()
+
+    for table in tables:
+        pd.testing.assert_frame_equal(read_table(table), expected[table])
+
+
+def test_clean_date_shards(tmp_path, monkeypatch):
+    """_summary_
+    This function checks that cleaning the data in shards of days, as the
+    mapped tasks of the data DAG do, and merging them writes the same tables
+    as clean_data, and that the merge refuses a missing shard before it
+    replaces any table.
+
+    SAMPLE USAGE
+        output=test_clean_date_shards()
+
+    """
+    use_test_db(tmp_path, monkeypatch)
+    monkeypatch.setattr(pipeline_utils, "WRITE_INTERMEDIATE_TABLES", True)
+    pipeline_utils.clean_data()
+    expected = {table: read_table(table) for table in ["interactions_mapped", "model_input"]}
+    expected_city_tier_mapped = read_table("city_tier_mapped")
+
+    monkeypatch.setattr(pipeline_utils, "DATE_SHARDS", 3)
+    shards = pipeline_utils.plan_date_shards()
+    assert len(shards) == 3
+    assert sum(shard['rows'] for shard in shards) == len(expected_city_tier_mapped)
+    for shard in shards:
+        pipeline_utils.clean_date_shard(**shard)
+    pipeline_utils.merge_date_shards()
+
+    for table, df in expected.items():
+        pd.testing.assert_frame_equal(read_table(table), df)
+    columns = list(expected_city_tier_mapped.columns)
+    pd.testing.assert_frame_equal(read_table("city_tier_mapped").sort_values(columns, ignore_index=True),
+                                  expected_city_tier_mapped.sort_values(columns, ignore_index=True))
+
+    for shard in shards[:2]:
+        pipeline_utils.clean_date_shard(**shard)
+    with pytest.raises(ValueError):
+        pipeline_utils.merge_date_shards()
+
+    # a shard missing from the last table leaves all the tables untouched
+    pipeline_utils.clean_date_shard(**shards[2])
+    pd.DataFrame({'x': [1]}).to_sql("city_tier_mapped", pipeline_utils.connect_to_db(), if_exists="replace", index=False)
+    pipeline_utils.connect_to_storage().drop_table(f"model_input__shard_{shards[2]['shard']}")
+    with pytest.raises(ValueError):
+        pipeline_utils.merge_date_shards()
+    assert read_table("city_tier_mapped")['x'].tolist() == [1]
+    for table, df in expected.items():
+        pd.testing.assert_frame_equal(read_table(table), df)
+
+
+###############################################################################
+# Write test cases for load_new_days() function
+# ##############################################################################
+def test_load_new_days(tmp_path, monkeypatch):
+    """_summary_
+    This function checks that loading the days of the test data in two runs
+    gives the same 'model_input' rows as cleaning all of it at once, that
+    running again changes nothing and that an edited day is loaded again.
+
+    SAMPLE USAGE
+        output=test_load_new_days()
+
+    """
+    use_test_db(tmp_path, monkeypatch)
+    monkeypatch.setattr(pipeline_utils, "INCREMENTAL_DATA_PIPELINE", True)
+    pipeline_utils.clean_data()
+    columns = list(read_table("model_input").columns)
+    expected = read_table("model_input").sort_values(columns, ignore_index=True)
+
+    raw = pd.read_csv(os.path.join(TEST_DIRECTORY, "leadscoring_test.csv"))
+    days = raw['created_date'].str[:10]
+    monkeypatch.setattr(pipeline_utils, "DB_PATH", str(tmp_path / "incremental"))
+    monkeypatch.setattr(pipeline_utils, "DATA_DIRECTORY", str(tmp_path))
+    os.makedirs(tmp_path / "incremental")
+    for data in [raw[days < days.sort_values().iloc[len(days) // 2]], raw, raw]:
+        data.to_csv(tmp_path / pipeline_utils.DATA_FILE_NAME, index=False)
+        pipeline_utils.load_new_days()
+    pd.testing.assert_frame_equal(read_table("model_input").sort_values(columns, ignore_index=True), expected)
+
+    raw.loc[0, 'referred_lead'] = 7.0
+    raw.to_csv(tmp_path / pipeline_utils.DATA_FILE_NAME, index=False)
+    pipeline_utils.load_new_days()
+    model_input = read_table("model_input")
+    assert len(model_input) == len(expected)
+    assert (model_input['referred_lead'] == 7.0).sum() == 1, "edited day not loaded again"
+
+
+###############################################################################
+# Write test cases for drop_duplicate_rows() function
+# ##############################################################################
+def test_drop_duplicate_rows(tmp_path, monkeypatch):
+    """_summary_
+    This function checks that dropping the duplicate rows by their fingerprint
+    as they are loaded writes the same tables as the cleaning steps dropping
+    them, rows that only become duplicates once their levels are mapped to
+    "others" included, and that with REMEMBER_ROW_FINGERPRINTS the rows an
+    earlier run loaded are dropped as re-delivered.
+
+    SAMPLE USAGE
+        output=test_drop_duplicate_rows()
+
+    """
+    raw = pd.read_csv(os.path.join(TEST_DIRECTORY, "leadscoring_test.csv"))
+    collapsed = raw.iloc[:5].assign(first_platform_c="never_seen_level")
+    raw = pd.concat([raw, raw.iloc[10:20], collapsed, collapsed.assign(first_platform_c="other_unseen_level")])
+    raw.to_csv(tmp_path / "duplicates.csv", index=False)
+
+    use_test_db(tmp_path, monkeypatch)
+    monkeypatch.setattr(pipeline_utils, "WRITE_INTERMEDIATE_TABLES", True)
+    pipeline_utils.stream_data_into_db(str(tmp_path / "duplicates.csv"), 7)
+    pipeline_utils.clean_data()
+    expected = {table: read_table(table) for table in ["categorical_variables_mapped", "model_input"]}
+
+    monkeypatch.setattr(pipeline_utils, "DEDUP_ROW_FINGERPRINTS", True)
+    rows = pipeline_utils.stream_data_into_db(str(tmp_path / "duplicates.csv"), 7)
+    pipeline_utils.clean_data()
+    assert rows == len(expected["categorical_variables_mapped"]) <= len(raw) - 15
+    for table, df in expected.items():
+        pd.testing.assert_frame_equal(read_table(table), df)
+
+    monkeypatch.setattr(pipeline_utils, "REMEMBER_ROW_FINGERPRINTS", True)
+    assert pipeline_utils.stream_data_into_db(str(tmp_path / "duplicates.csv"), 7) == rows
+    raw.iloc[:50].to_csv(tmp_path / "delivery.csv", index=False)
+    assert pipeline_utils.stream_data_into_db(str(tmp_path / "delivery.csv"), 7) == 0
+    raw.iloc[:50].assign(referred_lead=3.0).to_csv(tmp_path / "delivery.csv", index=False)
+    assert pipeline_utils.stream_data_into_db(str(tmp_path / "delivery.csv"), 7) == 50
+    assert len(read_table(pipeline_utils.FINGERPRINT_INDEX_TABLE)) == rows + 50
+
+
+
+def test_sorted_runs():
+    """_summary_
+    This function checks that the sorted runs drop_duplicate_rows keeps the
+    fingerprints in find exactly the fingerprints added so far, in fewer
+    runs than log2 of their number.
+
+    SAMPLE USAGE
+        output=test_sorted_runs()
+
+    """
+    rng = np.random.default_rng(0)
+    runs, added = [], set()
+    for _ in range(100):
+        fingerprints = rng.integers(0, 5000, 40).astype(np.uint64)
+        assert pipeline_utils.in_sorted_runs(runs, fingerprints).tolist() == [int(f) in added for f in fingerprints]
+        new = np.unique(fingerprints[~pipeline_utils.in_sorted_runs(runs, fingerprints)])
+        pipeline_utils.add_sorted_run(runs, new)
+        added.update(new.tolist())
+        assert all(np.all(np.diff(run.astype(np.int64)) > 0) for run in runs)
+    assert sum(len(run) for run in runs) == len(added)
+    assert len(runs) <= np.log2(len(added))
+
+###############################################################################
+# Write test cases for plan_source_columns() function
+# ##############################################################################
+def test_plan_source_columns(monkeypatch):
+    """_summary_
+    This function checks that the planner keeps the index columns and the
+    source of 'city_tier', and only asks for the interaction columns when
+    BUILD_INTERACTIONS_MAPPED is set.
+
+    SAMPLE USAGE
+        output=test_plan_source_columns()
+
+    """
+    monkeypatch.setattr(pipeline_utils, "USE_INFERENCE_DATA", False)
+    monkeypatch.setattr(pipeline_utils, "INTERACTION_MAPPING", os.path.join(TEST_DIRECTORY, "interaction_mapping.csv"))
+    monkeypatch.setattr(pipeline_utils, "BUILD_INTERACTIONS_MAPPED", False)
+
+    assert pipeline_utils.plan_source_columns() == ['created_date', 'city_mapped', 'first_platform_c',
+                                                    'first_utm_medium_c', 'first_utm_source_c',
+                                                    'total_leads_droppped', 'referred_lead', 'app_complete_flag']
+
+    monkeypatch.setattr(pipeline_utils, "BUILD_INTERACTIONS_MAPPED", True)
+    assert pipeline_utils.plan_source_columns() == pipeline_utils.raw_data_schema
+
+
+def test_stream_data_dtype_changes(tmp_path, monkeypatch):
+    """_summary_
+    This function checks that the data streams into every storage backend
+    when the dtypes pandas infers change from chunk to chunk: a text column
+    that only holds nulls in the first chunk, an integer column that holds
+    a float later. It also checks that a failed write leaves no temporary
+    file behind.
+
+    SAMPLE USAGE
+        output=test_stream_data_dtype_changes()
+
+    """
+    raw = pd.read_csv(os.path.join(TEST_DIRECTORY, "leadscoring_test.csv"))
+    raw.loc[:9, 'first_utm_source_c'] = None
+    raw['total_leads_droppped'] = raw['total_leads_droppped'].fillna(0).astype(int)
+    raw.loc[50, 'total_leads_droppped'] = 4.5
+    raw.to_csv(tmp_path / "drift.csv", index=False)
+
+    monkeypatch.setattr(pipeline_utils, "DB_PATH", str(tmp_path))
+    monkeypatch.setattr(pipeline_utils, "PARQUET_DIRECTORY", str(tmp_path / "parquet"))
+    monkeypatch.setattr(pipeline_utils, "ARROW_DIRECTORY", str(tmp_path / "arrow"))
+    monkeypatch.setattr(pipeline_utils, "SQLITE_EXPORT_TABLES", [])
+    for backend in ['sqlite', 'parquet', 'arrow']:
+        monkeypatch.setattr(pipeline_utils, "STORAGE_BACKEND", backend)
+        assert pipeline_utils.stream_data_into_db(str(tmp_path / "drift.csv"), 10) == len(raw)
+        loaded = pipeline_utils.connect_to_storage().read_table("loaded_data")
+        assert loaded['total_leads_droppped'].tolist() == raw['total_leads_droppped'].tolist()
+        assert loaded['first_utm_source_c'].isna().sum() == raw['first_utm_source_c'].isna().sum()
+
+    def failing_chunks():
+        yield pd.DataFrame({'x': [1.0]})
+        raise RuntimeError("chunk failed")
+
+    for backend in ['parquet', 'arrow']:
+        storage = get_storage(backend, str(tmp_path / "test.db"), str(tmp_path / "parquet"), str(tmp_path / "arrow"))
+        with pytest.raises(RuntimeError):
+            storage.write_chunks(failing_chunks(), "failed")
+        assert not any(name.startswith("failed") for name in os.listdir(tmp_path / backend))
+
+
+###############################################################################
+# Write test cases for raw_data_content_check() function
+# ##############################################################################
+def load_data_validation_checks(monkeypatch):
+    '''
+    Loads data_validation_checks.py as the data pipeline's DAG does, with its
+    flat imports resolved to the data pipeline's modules rather than to the
+    constants.py and schema.py of this directory.
+    '''
+    for module_name in ["constants", "schema", "storage"]:
+        monkeypatch.setitem(sys.modules, module_name,
+                            importlib.import_module(f"Lead_scoring_data_pipeline.{module_name}"))
+    spec = importlib.util.spec_from_file_location(
+        "data_validation_checks", os.path.join(TEST_DIRECTORY, "..", "Lead_scoring_data_pipeline", "data_validation_checks.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_raw_data_content_check(tmp_path, monkeypatch, capsys):
+    """_summary_
+    This function checks that raw_data_content_check finds the test data in
+    line with the dtypes and null rates of schema.py, flags a column of the
+    wrong dtype and a column with too many nulls, and that
+    raw_data_schema_check only checks the first RAW_DATA_CHECK_SAMPLE_ROWS
+    rows.
+
+    SAMPLE USAGE
+        output=test_raw_data_content_check()
+
+    """
+    data_validation_checks = load_data_validation_checks(monkeypatch)
+    test_file = os.path.join(TEST_DIRECTORY, "leadscoring_test.csv")
+
+    assert data_validation_checks.raw_data_content_check(test_file, None, 30)['in_line'].all()
+
+    df = pd.read_csv(test_file, dtype={'total_leads_droppped': object})
+    df.loc[60:, 'total_leads_droppped'] = 'many'
+    df.loc[60:, 'first_platform_c'] = None
+    df.to_csv(tmp_path / "leadscoring.csv", index=False)
+    report = data_validation_checks.raw_data_content_check(str(tmp_path / "leadscoring.csv"), None, 30)
+    assert report.index[~report['in_line']].tolist() == ['first_platform_c', 'total_leads_droppped']
+    df.assign(app_complete_flag='yes').to_csv(tmp_path / "wrong_dtype.csv", index=False)
+    report = data_validation_checks.raw_data_content_check(str(tmp_path / "wrong_dtype.csv"), 50, 30)
+    assert report.index[~report['in_line']].tolist() == ['app_complete_flag']
+
+    # the rows past the sample aren't read
+    monkeypatch.setattr(data_validation_checks, "DATA_DIRECTORY", str(tmp_path))
+    monkeypatch.setattr(data_validation_checks, "RAW_DATA_CONTENT_CHECK", True)
+    monkeypatch.setattr(data_validation_checks, "RAW_DATA_CHECK_SAMPLE_ROWS", 50)
+    monkeypatch.setattr(data_validation_checks, "RAW_DATA_CHECK_CHUNK_SIZE", 20)
+    data_validation_checks.raw_data_schema_check()
+    output = capsys.readouterr().out
+    assert "Checked dtypes and null rates on 50 rows" in output
+    assert "Raw data content is in line" in output
+
+
+###############################################################################
+# Write test cases for lazy_module_from_file class
+# ##############################################################################
+def test_lazy_module_from_file(tmp_path):
+    """_summary_
+    This function checks that lazy_module_from_file only loads its module
+    when a task runs, and passes each function only the keyword arguments
+    it takes.
+
+    SAMPLE USAGE
+        output=test_lazy_module_from_file()
+
+    """
+    spec = importlib.util.spec_from_file_location(
+        "lazy_module", os.path.join(TEST_DIRECTORY, "..", "Lead_scoring_data_pipeline", "lazy_module.py"))
+    lazy_module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(lazy_module)
+
+    tasks = lazy_module.lazy_module_from_file("tasks", str(tmp_path / "tasks.py"))
+    # the module doesn't exist yet, nothing is loaded before the task runs
+    encode, run = tasks.encode, tasks.run
+    with open(tmp_path / "tasks.py", "w") as file:
+        file.write("def encode(db_path, chunk_size=10):\n    return db_path, chunk_size\n\n"
+                   "def run(**kwargs):\n    return kwargs\n")
+
+    assert encode.__name__ == "encode"
+    assert encode(db_path="db", db_file_name="lead_scoring.db") == ("db", 10)
+    assert run(db_path="db", db_file_name="lead_scoring.db") == {"db_path": "db", "db_file_name": "lead_scoring.db"}
+
+
+###############################################################################
+# Write test cases for SQLiteStorage class
+# ##############################################################################
+def test_sqlite_storage_write(tmp_path, monkeypatch):
+    """_summary_
+    This function checks that SQLiteStorage sets SQLITE_PRAGMAS on its
+    connections, that a table written in several insert batches keeps every
+    row and its column types, that the swap table is renamed over the old
+    table, and that a write failing halfway leaves the old table as it was.
+
+    SAMPLE USAGE
+        output=test_sqlite_storage_write()
+
+    """
+    monkeypatch.setattr(storage_module, "SQLITE_INSERT_BATCH_SIZE", 7)
+    storage = SQLiteStorage(str(tmp_path / "lead_scoring.db"))
+    conn = storage.connect()
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert conn.execute("PRAGMA synchronous").fetchone()[0] == 1
+    assert conn.execute("PRAGMA temp_store").fetchone()[0] == 2
+    conn.close()
+
+    df = pd.DataFrame({'created_date': [f"2021-07-{day % 28 + 1:02d}" for day in range(30)],
+                       'total_leads_droppped': np.arange(30, dtype=float),
+                       'app_complete_flag': np.arange(30) % 2})
+    df.loc[3, ['created_date', 'total_leads_droppped']] = None, np.nan
+    storage.write_table(df.iloc[:5], "model_input")
+    assert storage.write_chunks([df.iloc[:12], df.iloc[12:]], "model_input") == 30
+
+    pd.testing.assert_frame_equal(storage.read_table("model_input"), df)
+    conn = storage.connect()
+    tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+    column_types = [row[2] for row in conn.execute('PRAGMA table_info("model_input")')]
+    conn.close()
+    assert tables == ["model_input"], "swap table left behind"
+    assert column_types == ["TEXT", "REAL", "INTEGER"]
+
+    def failing_chunks():
+        yield df.iloc[:10]
+        raise RuntimeError("chunk failed")
+
+    with pytest.raises(RuntimeError):
+        storage.write_chunks(failing_chunks(), "model_input")
+    pd.testing.assert_frame_equal(storage.read_table("model_input"), df)
+    assert storage.table_columns("model_input__swap") == []
+
+
+###############################################################################
+# Write test cases for the incremental reads and writes of the storages
+# ##############################################################################
+def test_storage_append_and_watermark(tmp_path):
+    """_summary_
+    This function checks, on all the storage backends, that append_table adds
+    rows to a table, that column_max gives the watermark of the table (None
+    for a missing table) and that read_new_rows only reads the rows past it.
+
+    SAMPLE USAGE
+        output=test_storage_append_and_watermark()
+
+    """
+    first = pd.DataFrame({'created_date': ['2021-07-01 10:00:00', '2021-07-02 09:00:00'], 'predictions': [1.0, 0.0]})
+    second = pd.DataFrame({'created_date': ['2021-07-03 08:00:00'], 'predictions': [1.0]})
+    for backend in ['sqlite', 'parquet', 'arrow']:
+        storage = get_storage(backend, str(tmp_path / "test.db"), str(tmp_path / "parquet"), str(tmp_path / "arrow"))
+        assert storage.column_max("predictions", "created_date") is None
+
+        storage.append_table(first, "predictions")
+        storage.append_table(second, "predictions")
+
+        pd.testing.assert_frame_equal(storage.read_table("predictions"),
+                                      pd.concat([first, second], ignore_index=True))
+        assert storage.column_max("predictions", "created_date") == '2021-07-03 08:00:00'
+        new_rows = storage.read_new_rows("predictions", "created_date", '2021-07-01 10:00:00')
+        assert new_rows['created_date'].tolist() == ['2021-07-02 09:00:00', '2021-07-03 08:00:00']
+
+
+def test_arrow_storage_handoff(tmp_path):
+    """_summary_
+    This function checks that the arrow storage publishes a new file of a
+    table on every write through its manifest, that a reader which mapped
+    the previous file still reads it, that a reader which read the manifest
+    before a write maps the new file, that a read only read doesn't copy
+    the numeric columns, and that the tables to export are written to the
+    SQLite db as well.
+
+    SAMPLE USAGE
+        output=test_arrow_storage_handoff()
+
+    """
+    storage = get_storage('arrow', str(tmp_path / "test.db"), None, str(tmp_path / "arrow"), ['features'])
+    first = pd.DataFrame({'created_date': ['2021-07-01', '2021-07-02'], 'x': [1.0, 2.0]})
+    second = pd.DataFrame({'created_date': ['2021-07-03'], 'x': [3.0]})
+
+    storage.write_table(first, "features")
+    mapped = storage.read_arrow("features")
+    storage.write_table(second, "features")
+
+    assert sorted(os.listdir(tmp_path / "arrow")) == sorted(["features.json", storage.manifest("features")["file"]])
+    assert storage.manifest("features")["rows"] == 1
+    assert storage.table_columns("features") == ['created_date', 'x']
+    pd.testing.assert_frame_equal(mapped.to_pandas(), first)
+    pd.testing.assert_frame_equal(storage.read_table("features"), second)
+    pd.testing.assert_frame_equal(get_storage('sqlite', str(tmp_path / "test.db"), None).read_table("features"), second)
+    # a read only read views the numeric columns on the mapped file
+    read_only = storage.read_table("features", read_only=True)
+    pd.testing.assert_frame_equal(read_only, second)
+    assert not read_only['x'].to_numpy().flags.writeable
+    assert storage.read_table("features")['x'].to_numpy().flags.writeable
+
+    # a reader which read the manifest before a publish maps the new file
+    table_path = storage.table_path
+    stale_paths = []
+
+    def table_path_published_meanwhile(table_name):
+        path = table_path(table_name)
+        if not stale_paths:
+            stale_paths.append(path)
+            storage.write_table(first, table_name)
+        return path
+
+    storage.table_path = table_path_published_meanwhile
+    pd.testing.assert_frame_equal(storage.read_table("features"), first)
+    assert not os.path.exists(stale_paths[0])
+    storage.table_path = table_path
+
+    storage.drop_table("features")
+    assert storage.table_columns("features") == [] and os.listdir(tmp_path / "arrow") == []
+
+
+###############################################################################
+# Write test cases for the incremental encode_features() function
+# ##############################################################################
+def test_encode_features_incremental(tmp_path, monkeypatch):
+    """_summary_
+    This function checks that the incremental inference encodes every lead
+    of 'model_input' that isn't in 'predictions' once: a lead created at the
+    watermark and a lead arriving a few days late are encoded, the scored
+    leads and the leads later than LATE_LEAD_DAYS are not.
+
+    SAMPLE USAGE
+        output=test_encode_features_incremental()
+
+    """
+    monkeypatch.setattr(inference_utils, "DB_PATH", str(tmp_path))
+    monkeypatch.setattr(inference_utils, "STORAGE_BACKEND", "sqlite")
+    monkeypatch.setattr(inference_utils, "INCREMENTAL_INFERENCE", True)
+    monkeypatch.setattr(inference_utils, "LATE_LEAD_DAYS", 7)
+    storage = inference_utils.connect_to_storage()
+
+    def leads(created_dates, platform):
+        return pd.DataFrame({'created_date': created_dates, 'city_tier': 1.0, 'first_platform_c': platform,
+                             'first_utm_medium_c': 'others', 'first_utm_source_c': 'others',
+                             'total_leads_droppped': 1.0, 'referred_lead': 0.0})
+
+    scored = leads(['2021-07-01 10:00:00', '2021-07-20 10:00:00'], 'Level0')
+    storage.write_table(scored, "model_input")
+    inference_utils.encode_features()
+    predictions = storage.read_table("features_inference").assign(predictions=1)
+    storage.write_table(predictions, "predictions")
+    assert predictions[inference_utils.LEAD_KEY_COLUMN].is_unique
+
+    new = leads(['2021-07-20 10:00:00', '2021-07-16 09:00:00', '2021-06-01 09:00:00', '2021-07-21 00:00:00'], 'Level3')
+    storage.write_table(pd.concat([scored, new], ignore_index=True), "model_input")
+    inference_utils.encode_features()
+    encoded = storage.read_table("features_inference")
+    assert encoded['created_date'].tolist() == ['2021-07-20 10:00:00', '2021-07-16 09:00:00', '2021-07-21 00:00:00']
+    assert encoded['first_platform_c_Level3'].tolist() == [1, 1, 1]
+
+
+###############################################################################
+# Write test cases for collapse_insignificant_levels() function
+# ##############################################################################
+def test_collapse_insignificant_levels():
+    """_summary_
+    This function checks that collapse_insignificant_levels maps the
+    insignificant levels and the nulls to "others" in place, keeping the
+    order of the rows.
+
+    SAMPLE USAGE
+        output=test_collapse_insignificant_levels()
+
+    """
+    df = pd.DataFrame({'first_platform_c': ['Level0', 'Level5', None, 'Level3'], 'referred_lead': [1, 2, 3, 4]})
+
+    result = pipeline_utils.collapse_insignificant_levels(df, {'first_platform_c': ['Level3', 'Level0']})
+
+    assert result is df, "collapse should happen in place"
+    assert df['first_platform_c'].tolist() == ['Level0', 'others', 'others', 'Level3'], "Categorical mapping is incorrect"
+    assert list(df['first_platform_c'].cat.categories) == ['Level0', 'Level3', 'others']
+    assert df['referred_lead'].tolist() == [1, 2, 3, 4], "Row order changed"
+
+
+###############################################################################
+# Write test cases for OneHotEncoder class
+# ##############################################################################
+def test_one_hot_encoder():
+    """_summary_
+    This function checks that OneHotEncoder gives the same encoding as
+    pd.get_dummies, keeping only the wanted columns, with unknown levels and
+    nulls encoded as all zeros and the nulls of the other columns filled
+    with 0.
+
+    SAMPLE USAGE
+        output=test_one_hot_encoder()
+
+    """
+    one_hot_encoded_features = ['referred_lead', 'total_leads_droppped', 'city_tier_1.0', 'city_tier_3.0',
+                                'first_platform_c_Level0', 'first_platform_c_others']
+    encoder = OneHotEncoder(one_hot_encoded_features, ['city_tier', 'first_platform_c'],
+                            {'city_tier': [1.0, 2.0, 3.0], 'first_platform_c': ['Level0', 'others']})
+    df = pd.DataFrame({'city_tier': [1.0, 2.0, 3.0, None],
+                       'first_platform_c': ['others', 'Level0', 'Level9', None],
+                       'referred_lead': [0.0, 1.0, 0.0, 1.0],
+                       'total_leads_droppped': [1.0, np.nan, 2.0, 0.0]})
+
+    df_encoded = encoder.transform(df)
+
+    assert list(df_encoded.columns) == one_hot_encoded_features
+    assert df_encoded['referred_lead'].tolist() == [0.0, 1.0, 0.0, 1.0]
+    assert df_encoded['total_leads_droppped'].tolist() == [1.0, 0.0, 2.0, 0.0]
+    assert df_encoded['city_tier_1.0'].tolist() == [1, 0, 0, 0]
+    assert df_encoded['city_tier_3.0'].tolist() == [0, 0, 1, 0]
+    assert df_encoded['first_platform_c_Level0'].tolist() == [0, 1, 0, 0]
+    assert df_encoded['first_platform_c_others'].tolist() == [1, 0, 0, 0]
+
+
+def model_input_sample(rows, seed=0):
+    '''
+    Random 'model_input' rows over the levels of the encoded features, with
+    unknown levels and nulls among them, and nulls in 'total_leads_droppped'.
+    '''
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({feature: rng.choice(np.array(levels + ['unknown', None], dtype=object), rows)
+                       for feature, levels in training_utils.FEATURE_LEVELS.items()})
+    df['city_tier'] = rng.choice(training_utils.FEATURE_LEVELS['city_tier'] + [4.0, np.nan], rows)
+    for column in ['total_leads_droppped', 'referred_lead', 'app_complete_flag']:
+        df[column] = rng.integers(0, 3 if column == 'total_leads_droppped' else 2, rows).astype(float)
+    df.loc[df.index % 11 == 0, 'total_leads_droppped'] = np.nan
+    return df
+
+
+def test_one_hot_encoder_sparse():
+    """_summary_
+    This function checks that OneHotEncoder.transform_sparse gives the same
+    matrix as the dense transform.
+
+    SAMPLE USAGE
+        output=test_one_hot_encoder_sparse()
+
+    """
+    df = model_input_sample(500)
+
+    encoded = training_utils.encoder.transform_sparse(df)
+
+    assert encoded.format == "csr" and encoded.dtype == np.float64
+    np.testing.assert_array_equal(encoded.toarray(), training_utils.encoder.transform(df).to_numpy(dtype=float))
+    np.testing.assert_array_equal(training_utils.encoder.transform_sparse(df.iloc[:0]).toarray(),
+                                  np.zeros((0, len(training_utils.ONE_HOT_ENCODED_FEATURES))))
+
+
+def test_sparse_features_round_trip(tmp_path, monkeypatch):
+    """_summary_
+    This function checks that the features and the target saved by
+    save_sparse_features are loaded back by load_sparse_features as they
+    are in the dense 'features' and 'target' tables.
+
+    SAMPLE USAGE
+        output=test_sparse_features_round_trip()
+
+    """
+    monkeypatch.setattr(training_utils, "DB_PATH", str(tmp_path))
+    df = model_input_sample(500, seed=1)
+    df_encoded = training_utils.encoder.transform(df)
+
+    training_utils.save_sparse_features(df)
+    X, y = training_utils.load_sparse_features()
+
+    np.testing.assert_array_equal(X.toarray(), df_encoded[training_utils.FEATURE_NAMES].to_numpy(dtype=float))
+    np.testing.assert_array_equal(y, df_encoded['app_complete_flag'].to_numpy(dtype=float))
+
+
+###############################################################################
+# Write test cases for RowEncoder class
+# ##############################################################################
+def test_row_encoder():
+    """_summary_
+    This function checks that RowEncoder encodes raw leads given as dicts
+    exactly as the city tier mapping, the level collapsing and OneHotEncoder
+    do on a dataframe, for single leads and batches.
+
+    SAMPLE USAGE
+        output=test_row_encoder()
+
+    """
+    one_hot_encoded_features = ['total_leads_droppped', 'city_tier_1.0', 'city_tier_3.0',
+                                'first_platform_c_Level0', 'first_platform_c_others']
+    features_to_encode = ['city_tier', 'first_platform_c']
+    feature_levels = {'city_tier': [1.0, 2.0, 3.0], 'first_platform_c': ['Level0', 'Level3', 'others']}
+    significant_levels = {'first_platform_c': ['Level0', 'Level3']}
+    row_encoder = RowEncoder(one_hot_encoded_features, features_to_encode, feature_levels,
+                             {'mumbai': 1, 'pune': 2}, significant_levels)
+    leads = [{'city_mapped': 'mumbai', 'first_platform_c': 'Level0', 'total_leads_droppped': 2},
+             {'city_mapped': 'pune', 'first_platform_c': 'Level9', 'total_leads_droppped': None},
+             {'city_mapped': None, 'first_platform_c': None, 'total_leads_droppped': float('nan')}]
+
+    df = pd.DataFrame.from_records(leads)
+    df['city_tier'] = df['city_mapped'].map({'mumbai': 1, 'pune': 2}).astype(float).fillna(3.0)
+    pipeline_utils.collapse_insignificant_levels(df, significant_levels)
+    df['total_leads_droppped'] = df['total_leads_droppped'].fillna(0)
+    expected = OneHotEncoder(one_hot_encoded_features, features_to_encode, feature_levels).transform(df)
+
+    np.testing.assert_array_equal(row_encoder.encode_batch(leads), expected.to_numpy(dtype=float))
+    np.testing.assert_array_equal([row_encoder.encode(lead) for lead in leads], expected.to_numpy(dtype=float))
+
+
+###############################################################################
+# Write test cases for MicroBatcher class
+# ##############################################################################
+def test_micro_batcher():
+    """_summary_
+    This function checks that MicroBatcher coalesces concurrent requests into
+    batches of at most max_batch_size leads and hands every request back the
+    predictions of its own leads.
+
+    SAMPLE USAGE
+        output=test_micro_batcher()
+
+    """
+    batch_sizes = []
+
+    def score_batch(leads):
+        batch_sizes.append(len(leads))
+        return [lead * 10 for lead in leads]
+
+    batcher = MicroBatcher(score_batch, 4, 50, 100)
+    results = {}
+    threads = [threading.Thread(target=lambda i=i: results.update({i: batcher.score([i, i + 100])}))
+               for i in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == {i: [i * 10, (i + 100) * 10] for i in range(6)}
+    assert max(batch_sizes) <= 4 and len(batch_sizes) < 6, f"requests not batched: {batch_sizes}"
+    stats = batcher.stats()
+    assert stats["requests"] == 6 and stats["p99_ms"] >= stats["p50_ms"]
+
+
+def test_micro_batcher_errors():
+    """_summary_
+    This function checks that a request whose leads can't be prepared fails
+    on its own, and that a batch failing to score fails its requests only:
+    the batcher keeps scoring the next ones.
+
+    SAMPLE USAGE
+        output=test_micro_batcher_errors()
+
+    """
+    def score_batch(leads):
+        if -1 in leads:
+            raise RuntimeError("batch failed")
+        return [lead * 10 for lead in leads]
+
+    def prepare(leads):
+        return [int(lead) for lead in leads]
+
+    batcher = MicroBatcher(score_batch, 4, 1, 100, prepare=prepare)
+    for bad_leads in [5, None, ["x"]]:
+        with pytest.raises(InvalidLeads):
+            batcher.score(bad_leads)
+    with pytest.raises(RuntimeError):
+        batcher.score([-1])
+    assert batcher.score(["1", 2]) == [10, 20]
+
+
+def test_scoring_service_bad_requests():
+    """_summary_
+    This function checks that the scoring service answers 400 to a body
+    which isn't a lead or a list of leads, or whose leads can't be encoded,
+    and goes on scoring the valid requests.
+
+    SAMPLE USAGE
+        output=test_scoring_service_bad_requests()
+
+    """
+    batcher = MicroBatcher(lambda rows: [float(np.sum(row)) for row in rows], 16, 1, 100, prepare=encode_request)
+    server = make_server(batcher, "127.0.0.1", 0, None)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def post(body):
+        conn = http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=10)
+        conn.request("POST", "/score", body)
+        response = conn.getresponse()
+        result = response.status, json.loads(response.read())
+        conn.close()
+        return result
+
+    try:
+        for body in ["5", "null", "true", "[1]", "not json", '{"total_leads_droppped": "many"}']:
+            assert post(body)[0] == 400, body
+        status, result = post(json.dumps([{"city_mapped": "mumbai", "total_leads_droppped": 2}]))
+        assert status == 200 and len(result["predictions"]) == 1
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+###############################################################################
+# Write test cases for predict_unique_rows() function
+# ##############################################################################
+class SumModel:
+    '''
+    Model scoring a feature row with the sum of its features, which counts
+    the rows it scores.
+    '''
+    def __init__(self):
+        self.scored_rows = 0
+
+    def predict(self, features):
+        self.scored_rows += len(features)
+        return features.sum(axis=1).to_numpy()
+
+    predict_proba = predict
+
+
+def test_predict_unique_rows():
+    """_summary_
+    This function checks that predict_unique_rows scores every distinct
+    feature row once and gives each row the prediction of its features.
+
+    SAMPLE USAGE
+        output=test_predict_unique_rows()
+
+    """
+    features = pd.DataFrame({'total_leads_droppped': [1.0, 2.0, 1.0, 1.0, 0.0],
+                             'city_tier_1.0': [1.0, 0.0, 1.0, 0.0, 0.0]})
+    model = SumModel()
+
+    predictions, unique_rows = inference_utils.predict_unique_rows(model, features)
+
+    assert predictions.tolist() == [2.0, 2.0, 2.0, 1.0, 0.0]
+    assert unique_rows == 4 and model.scored_rows == 4
+
+
+###############################################################################
+# Write test cases for ModelCache class
+# ##############################################################################
+def test_model_cache(tmp_path, monkeypatch):
+    """_summary_
+    This function checks that ModelCache downloads a model version once into
+    its cache directory, serves it from memory without checking its files
+    again, downloads a cached copy whose checksum doesn't match again and
+    only keeps the last max_models models in memory.
+
+    SAMPLE USAGE
+        output=test_model_cache()
+
+    """
+    downloads, loads, checksums = [], [], []
+
+    def download_artifacts(artifact_uri, dst_path):
+        downloads.append(artifact_uri)
+        os.makedirs(dst_path)
+        with open(os.path.join(dst_path, "model.txt"), "w") as file:
+            file.write(artifact_uri)
+        return dst_path
+
+    def load_model(model_directory):
+        loads.append(model_directory)
+        with open(os.path.join(model_directory, "model.txt")) as file:
+            return file.read()
+
+    directory_checksum = model_cache_module.directory_checksum
+    monkeypatch.setattr("mlflow.artifacts.download_artifacts", download_artifacts)
+    # mlflow.pyfunc is imported lazily, on its first attribute access
+    assert model_cache_module.mlflow.pyfunc.load_model
+    monkeypatch.setattr(model_cache_module.mlflow.pyfunc, "load_model", load_model)
+    monkeypatch.setattr(model_cache_module, "directory_checksum",
+                        lambda directory: checksums.append(directory) or directory_checksum(directory))
+
+    cache = model_cache_module.ModelCache(str(tmp_path), 2)
+    assert cache.load_version("model", 1) == "models:/model/1"
+    checksums.clear()
+    assert cache.load_version("model", 1) == "models:/model/1"
+    assert (len(downloads), len(loads), len(checksums)) == (1, 1, 0), "model in memory loaded again"
+
+    # a new worker loads the cached copy from the disk
+    assert model_cache_module.ModelCache(str(tmp_path), 2).load_version("model", 1) == "models:/model/1"
+    assert (len(downloads), len(loads)) == (1, 2)
+
+    with open(tmp_path / "model" / "1" / "model" / "model.txt", "a") as file:
+        file.write("corrupted")
+    assert model_cache_module.ModelCache(str(tmp_path), 2).load_version("model", 1) == "models:/model/1"
+    assert len(downloads) == 2, "corrupted copy not downloaded again"
+    assert sorted(os.listdir(tmp_path / "model")) == ["1"]
+
+    for version in [2, 3]:
+        cache.load_version("model", version)
+    assert list(cache.models) == [("model", "2", "pyfunc"), ("model", "3", "pyfunc")]
+    cache.load_version("model", 1)
+    assert len(loads) == 6, "evicted model not loaded again"
+
+    # a version another worker published first is kept, not replaced
+    download_directory = tmp_path / "download"
+    os.makedirs(download_directory)
+    assert not model_cache_module.publish_directory(str(download_directory), str(tmp_path / "model" / "1"))
+    assert not download_directory.exists() and (tmp_path / "model" / "1" / "manifest.json").exists()
+
+
+###############################################################################
+# Write test cases for ScoreCache class
+# ##############################################################################
+def test_score_cache(tmp_path):
+    """_summary_
+    This function checks that ScoreCache only has the model score the feature
+    rows it hasn't cached yet, evicts the least recently used predictions
+    beyond its size and drops the probabilities of the previous model version.
+
+    SAMPLE USAGE
+        output=test_score_cache()
+
+    """
+    first = pd.DataFrame({'total_leads_droppped': [1.0, 2.0, 1.0], 'referred_lead': [0.0, 0.0, 0.0]})
+    second = pd.DataFrame({'total_leads_droppped': [3.0, 1.0], 'referred_lead': [1.0, 0.0]})
+    score_cache = ScoreCache(str(tmp_path / "score_cache.db"), 2)
+    model = SumModel()
+
+    predictions, stats = score_cache.predict_proba(model, "LightGBM/1", first)
+    assert predictions.tolist() == [1.0, 2.0, 1.0] and model.scored_rows == 2
+    assert stats["unique_hit_rate"] == 0.0
+
+    predictions, stats = score_cache.predict_proba(model, "LightGBM/1", second)
+    assert predictions.tolist() == [4.0, 1.0] and model.scored_rows == 3
+    assert stats["unique_hit_rate"] == 0.5
+    # the row of 2.0 was used least recently
+    assert score_cache.size() == 2
+
+    score_cache.predict_proba(model, "LightGBM/1", second)
+    assert model.scored_rows == 3, "cached rows scored again"
+
+    score_cache.predict_proba(model, "LightGBM/2", second)
+    assert model.scored_rows == 5 and score_cache.size() == 2, "previous version not invalidated"
+    score_cache.predict_proba(model, "LightGBM/2", first)
+    assert model.scored_rows == 6 and score_cache.size() == 2, "entries of the stage version dropped"
+    conn = sqlite3.connect(score_cache.db_full_path)
+    assert conn.execute("SELECT value FROM metadata").fetchall() == [("LightGBM/2",)]
+    conn.close()
+
+
+def test_get_models_prediction_score_cache(tmp_path, monkeypatch):
+    """_summary_
+    This function checks that with USE_SCORE_CACHE set the score cache keeps
+    the probability of class 1 of the feature rows, and that the labels
+    predicted from it are written to 'predictions' as integers.
+
+    SAMPLE USAGE
+        output=test_get_models_prediction_score_cache()
+
+    """
+    class ProbabilityModel:
+        classes = np.array([0, 1])
+
+        def predict_proba(self, features):
+            return features['total_leads_droppped'].to_numpy() / 10
+
+    monkeypatch.setattr(inference_utils, "DB_PATH", str(tmp_path))
+    monkeypatch.setattr(inference_utils, "STORAGE_BACKEND", "sqlite")
+    monkeypatch.setattr(inference_utils, "USE_SCORE_CACHE", True)
+    monkeypatch.setattr(inference_utils, "INCREMENTAL_INFERENCE", False)
+    monkeypatch.setattr(inference_utils, "TRACKING_URI", str(tmp_path / "mlruns"))
+    monkeypatch.setattr(inference_utils, "load_production_model", lambda: (ProbabilityModel(), 3))
+    storage = inference_utils.connect_to_storage()
+    features = pd.DataFrame(0, index=range(4), columns=inference_utils.ONE_HOT_ENCODED_FEATURES)
+    features['total_leads_droppped'] = [2, 7, 2, 9]
+    storage.write_table(features, "features_inference")
+
+    inference_utils.get_models_prediction()
+
+    predictions = storage.read_table("predictions")
+    assert predictions['predictions'].tolist() == [0, 1, 0, 1]
+    assert pd.api.types.is_integer_dtype(predictions['predictions'])
+    conn = sqlite3.connect(tmp_path / inference_utils.SCORE_CACHE_FILE_NAME)
+    assert sorted(row[0] for row in conn.execute("SELECT probability FROM scores")) == [0.2, 0.7, 0.9]
+    conn.close()
+
+
+###############################################################################
+# Write test cases for NativeLightGBMModel class
+# ##############################################################################
+def test_native_lightgbm_model():
+    """_summary_
+    This function checks that NativeLightGBMModel gives the same labels and
+    probabilities as the LGBMClassifier it takes the booster of, whatever
+    the order of the columns of a DataFrame.
+
+    SAMPLE USAGE
+        output=test_native_lightgbm_model()
+
+    """
+    import lightgbm as lgb
+
+    rng = np.random.default_rng(0)
+    features = pd.DataFrame(rng.integers(0, 3, size=(500, 4)).astype(float), columns=list("abcd"))
+    target = (features["a"] + rng.normal(size=500) > 1).astype(int)
+    classifier = lgb.LGBMClassifier(n_estimators=20, verbose=-1).fit(features, target)
+
+    model = NativeLightGBMModel(classifier.booster_, classifier.classes_, num_threads=1)
+
+    assert np.array_equal(model.predict(features), classifier.predict(features))
+    assert np.allclose(model.predict_proba(features.to_numpy()), classifier.predict_proba(features)[:, 1])
+    # the columns of a DataFrame are taken by name
+    assert np.allclose(model.predict_proba(features[list("dcba")]), classifier.predict_proba(features)[:, 1])
+    with pytest.raises(ValueError, match="'c'"):
+        model.predict(features.drop(columns="c"))
+    pyfunc_model = ClassifierProbabilityModel(classifier)
+    assert np.allclose(pyfunc_model.predict_proba(features), model.predict_proba(features))
+    assert np.array_equal(predicted_labels(pyfunc_model.classes, pyfunc_model.predict_proba(features)),
+                          classifier.predict(features))
+
+
+###############################################################################
+# Write test cases for FlatTreeEnsemble class
+# ##############################################################################
+def test_flat_trees(tmp_path):
+    """_summary_
+    This function checks that the FlatTreeEnsemble exported from a
+    LGBMClassifier and memory-mapped back gives the same probabilities and
+    labels as the classifier, with and without missing values, whatever the
+    order of the columns of a DataFrame.
+
+    SAMPLE USAGE
+        output=test_flat_trees()
+
+    """
+    import lightgbm as lgb
+
+    rng = np.random.default_rng(0)
+    features = pd.DataFrame(rng.integers(0, 3, size=(500, 4)).astype(float), columns=list("abcd"))
+    features.loc[features.index % 7 == 0, "b"] = np.nan
+    target = (features["a"] + rng.normal(size=500) > 1).astype(int)
+    classifier = lgb.LGBMClassifier(n_estimators=20, verbose=-1).fit(features, target)
+
+    export_flat_trees(classifier.booster_, str(tmp_path / "flat_trees"), classifier.classes_)
+    model = FlatTreeEnsemble.load(str(tmp_path / "flat_trees"))
+
+    assert isinstance(model.threshold, np.memmap)
+    assert np.array_equal(model.predict(features), classifier.predict(features))
+    assert np.allclose(model.predict_proba(features), classifier.predict_proba(features)[:, 1])
+    assert np.allclose(model.predict_raw(features.fillna(0)), classifier.predict(features.fillna(0), raw_score=True))
+    # the columns of a DataFrame are taken by name
+    assert np.allclose(model.predict_proba(features[list("dcba")]), classifier.predict_proba(features)[:, 1])
+    with pytest.raises(ValueError, match="'c'"):
+        model.predict(features.drop(columns="c"))